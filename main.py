@@ -12,20 +12,32 @@
 #
 # Variables de entorno:
 # DATABASE_URL   (Supabase Pooler, p.ej. ...pooler.supabase.com:6543/postgres)
+# DATABASE_DIRECT_URL (opcional, conexión directa o pooler en modo sesión, p.ej. ...:5432/postgres;
+#                 sólo para el LISTEN de la caché de salas. Sin ella la caché se renueva por TTL)
 # SESSION_SECRET (recomendado)
+# WEB_THREADPOOL_SIZE (opcional, hilos para handlers síncronos; por defecto 40)
+# DB_POOL_MAX    (opcional, conexiones persistentes a Postgres por proceso; por defecto 10)
 
 import os
+import asyncio
+import hashlib
+import html
+import http.client
 import random
+import secrets
 import string
-import math
-import urllib.request
-import urllib.error
+import time
 import urllib.parse
 import mimetypes
 import json
 import re
+import select
+import threading
 import unicodedata
+from contextlib import ExitStack, contextmanager
 from io import BytesIO
+from itertools import chain
+from typing import Any, BinaryIO, Dict, Iterator, List, Optional, Tuple, Union
 
 # Pillow (compresión de imágenes en servidor). Si no está instalado, se mostrará un error claro al subir imágenes.
 PIL_AVAILABLE = True
@@ -36,12 +48,41 @@ except Exception:
 
 MAX_IMG_BYTES = 100 * 1024   # 100 KB por imagen final en Storage
 MAX_IMG_DIM = 1280           # máximo ancho/alto
+WEBP_METHOD = 4              # esfuerzo del encoder WEBP (0 rápido .. 6 lento); 4 ≈ mismo tamaño, bastante más rápido
+_TOKEN_LEN = 5               # bytes aleatorios del sufijo de cada imagen (secrets.token_urlsafe)
+MAX_IMG_INPUT_BYTES = 8 * 1024 * 1024    # tamaño máximo de cada imagen subida (antes de comprimir)
+MAX_NEW_TICKET_BODY = 32 * 1024 * 1024   # cuerpo máximo de POST /trabajador/nuevo (3 imágenes + campos)
+
+def _webp_bytes(img, quality: int) -> bytes:
+    out = BytesIO()
+    img.save(out, format="WEBP", quality=quality, method=WEBP_METHOD)
+    return out.getvalue()
+
+
+def _webp_fit(img, qualities: List[int], target_bytes: int) -> Tuple[Optional[bytes], bytes]:
+    """Búsqueda binaria de la mayor calidad (lista descendente) cuyo WEBP cabe en target_bytes.
+    Devuelve (datos que caben o None, última codificación probada)."""
+    lo, hi = 0, len(qualities) - 1
+    best: Optional[bytes] = None
+    last = b""
+    while lo <= hi:
+        mid = (lo + hi) // 2
+        data = _webp_bytes(img, qualities[mid])
+        last = data
+        if len(data) <= target_bytes:
+            best = data
+            hi = mid - 1
+        else:
+            lo = mid + 1
+    return best, last
 
-def compress_image_to_target(image_bytes: bytes, target_bytes: int = MAX_IMG_BYTES) -> bytes:
-    """Convierte la imagen a WEBP y ajusta tamaño/calidad para intentar <= target_bytes."""
+
+def compress_image_to_target(image: Union[bytes, BinaryIO], target_bytes: int = MAX_IMG_BYTES) -> bytes:
+    """Convierte la imagen a WEBP y ajusta tamaño/calidad para intentar <= target_bytes.
+    Acepta bytes o un fichero ya abierto (p.ej. el spool de un UploadFile) para no copiarlo entero a memoria."""
     if not PIL_AVAILABLE:
         raise RuntimeError("Falta la dependencia Pillow en el servidor. Añade 'Pillow' a requirements.txt y redeploy.")
-    img = Image.open(BytesIO(image_bytes))
+    img = Image.open(BytesIO(image) if isinstance(image, (bytes, bytearray)) else image)
     img = ImageOps.exif_transpose(img)
 
     # Normaliza modo
@@ -56,38 +97,39 @@ def compress_image_to_target(image_bytes: bytes, target_bytes: int = MAX_IMG_BYT
     # Reescalado
     img.thumbnail((MAX_IMG_DIM, MAX_IMG_DIM))
 
-    last = b""
-    for quality in [80, 70, 60, 50, 40, 30, 25, 20]:
-        out = BytesIO()
-        img.save(out, format="WEBP", quality=quality, method=6)
-        data = out.getvalue()
-        last = data
-        if len(data) <= target_bytes:
-            return data
+    data, last = _webp_fit(img, [80, 70, 60, 50, 40, 30, 25, 20], target_bytes)
+    if data is not None:
+        return data
 
     for dim in [1024, 900, 800, 700, 600]:
         tmp = img.copy()
         tmp.thumbnail((dim, dim))
-        for quality in [60, 50, 40, 30, 25, 20]:
-            out = BytesIO()
-            tmp.save(out, format="WEBP", quality=quality, method=6)
-            data = out.getvalue()
-            last = data
-            if len(data) <= target_bytes:
-                return data
+        data, last = _webp_fit(tmp, [60, 50, 40, 30, 25, 20], target_bytes)
+        if data is not None:
+            return data
 
     return last
 from datetime import datetime, timedelta
-from pathlib import Path
-from typing import Any, Dict, List, Optional, Tuple
+from functools import lru_cache
 from zoneinfo import ZoneInfo
 
 import psycopg2
-from psycopg2.extras import RealDictCursor
-
-from fastapi import FastAPI, Request, Form, UploadFile, File
-from fastapi.responses import HTMLResponse, RedirectResponse, FileResponse, PlainTextResponse, Response
+import psycopg2.pool
+from psycopg2.extras import NamedTupleCursor, RealDictCursor, execute_values
+
+from reportlab.lib import colors
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+from reportlab.lib.units import mm
+from reportlab.pdfgen import canvas
+from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle
+from reportlab.platypus.flowables import HRFlowable
+
+from fastapi import APIRouter, FastAPI, Request, Form, UploadFile, File, Depends, HTTPException, Query
+from fastapi.responses import HTMLResponse, RedirectResponse, PlainTextResponse, Response, StreamingResponse
+from starlette.middleware.gzip import GZipMiddleware
 from starlette.middleware.sessions import SessionMiddleware
+from anyio import to_thread as anyio_to_thread
 
 TZ = ZoneInfo("Europe/Madrid")
 
@@ -101,7 +143,6 @@ PRIORIDADES = [
     ("MEDIO", "Medio", "#d97706"),
     ("DEMORABLE", "Demorable", "#15803d"),
 ]
-PRIORIDAD_COLOR = {k: color for (k, _label, color) in PRIORIDADES}
 PRIORIDADES_VALIDAS = {p[0] for p in PRIORIDADES}
 
 def prio_label(prio: str) -> str:
@@ -120,8 +161,12 @@ def prio_css_class(prio: str) -> str:
         return "prio-dem"
     return "prio-med"
 
-def prio_span(prio: str, txt: str) -> str:
+def _build_prio_span(prio: str, txt: str) -> str:
     return f"<span class='{prio_css_class(prio)}'>{h(txt or '')}</span>"
+
+def prio_span(prio: str, txt: str) -> str:
+    # Dominio acotado (prioridad x estado): casi siempre es un acierto en _PRIO_SPAN
+    return _PRIO_SPAN.get((prio, txt)) or _build_prio_span(prio, txt)
 ESTADOS_ENCARGADO = [
     "SIN ESTADO",
     "TRABAJO PENDIENTE/EN COLA",
@@ -131,6 +176,16 @@ ESTADOS_ENCARGADO = [
 ]
 ESTADOS_FINALIZADOS = {"TRABAJO TERMINADO/REPARADO", "TRABAJO DESESTIMADO"}
 
+
+def _sql_in_list(values: List[str]) -> str:
+    return ", ".join("'" + v.replace("'", "''") + "'" for v in values)
+
+
+# Predicados SQL de parte abierto / finalizado, sacados de ESTADOS_ENCARGADO: un estado nuevo entra
+# solo en los listados abiertos. Positivos ("in") para que Postgres use los índices parciales.
+SQL_PARTE_ABIERTO = f"estado_encargado in ({_sql_in_list([e for e in ESTADOS_ENCARGADO if e not in ESTADOS_FINALIZADOS])})"
+SQL_PARTE_FINALIZADO = f"estado_encargado in ({_sql_in_list([e for e in ESTADOS_ENCARGADO if e in ESTADOS_FINALIZADOS])})"
+
 ALL_MARKER = "__TODAS__"  # valor especial en multiselect
 
 
@@ -138,17 +193,15 @@ ALL_MARKER = "__TODAS__"  # valor especial en multiselect
 # DB (Supabase Postgres)
 # =========================
 DATABASE_URL = os.getenv("DATABASE_URL", "").strip()
+# LISTEN es estado de sesión: no funciona a través del pooler en modo transacción de DATABASE_URL
+DATABASE_DIRECT_URL = os.getenv("DATABASE_DIRECT_URL", "").strip()
+WEB_THREADPOOL_SIZE = max(1, int(os.getenv("WEB_THREADPOOL_SIZE", "40") or 40))
 
-
-
-def prio_badge(prio: str) -> str:
-    """Devuelve un span coloreado para el texto de prioridad."""
-    p = (prio or "MEDIO").strip().upper()
-    if p == "URGENTE":
-        return "<span style='font-weight:800;color:#d00;'>Urgente</span>"
-    if p == "DEMORABLE":
-        return "<span style='font-weight:700;color:#1b7a1b;'>Demorable</span>"
-    return "<span style='font-weight:700;color:#d57a00;'>Medio</span>"
+# Pool de conexiones (por proceso): evita un handshake TCP+TLS con Postgres en cada consulta.
+DB_POOL_MAX = max(1, int(os.getenv("DB_POOL_MAX", "10") or 10))
+DB_POOL_TIMEOUT = 30        # segundos esperando conexión libre antes de fallar
+DB_POOL_RECYCLE = 1800      # segundos de vida máxima de una conexión
+DB_POOL_PING_IDLE = 30      # si lleva más que esto sin usarse, "select 1" antes de entregarla
 
 
 def _ensure_db_url() -> str:
@@ -157,21 +210,122 @@ def _ensure_db_url() -> str:
     return DATABASE_URL
 
 
-def db_conn():
-    url = _ensure_db_url()
+def _db_connect_kwargs(url: Optional[str] = None) -> Dict[str, Any]:
+    url = url or _ensure_db_url()
     if "sslmode=" not in url:
-        return psycopg2.connect(url, cursor_factory=RealDictCursor, sslmode="require")
-    return psycopg2.connect(url, cursor_factory=RealDictCursor)
+        return {"dsn": url, "cursor_factory": RealDictCursor, "sslmode": "require"}
+    return {"dsn": url, "cursor_factory": RealDictCursor}
+
+
+def db_connect(url: Optional[str] = None):
+    """Conexión nueva y propia (fuera del pool), a DATABASE_URL o a url. Hay que cerrarla."""
+    return psycopg2.connect(**_db_connect_kwargs(url))
+
+
+_db_pool: Optional[psycopg2.pool.ThreadedConnectionPool] = None
+_db_pool_lock = threading.Lock()
+_db_pool_sem = threading.BoundedSemaphore(DB_POOL_MAX)
+_db_conn_times: Dict[int, List[float]] = {}  # id(conn) -> [creada, último uso]
+
+
+def _get_db_pool() -> psycopg2.pool.ThreadedConnectionPool:
+    global _db_pool
+    if _db_pool is None:
+        with _db_pool_lock:
+            if _db_pool is None:
+                _db_pool = psycopg2.pool.ThreadedConnectionPool(0, DB_POOL_MAX, **_db_connect_kwargs())
+    return _db_pool
+
+
+def _db_discard(pool: psycopg2.pool.ThreadedConnectionPool, conn) -> None:
+    _db_conn_times.pop(id(conn), None)
+    pool.putconn(conn, close=True)
+
 
+def _db_checkout(pool: psycopg2.pool.ThreadedConnectionPool):
+    """Saca una conexión sana: descarta las cerradas o viejas y hace ping a las que llevan rato paradas."""
+    for _ in range(3):
+        conn = pool.getconn()
+        now = time.monotonic()
+        times = _db_conn_times.setdefault(id(conn), [now, now])
+        if conn.closed or now - times[0] > DB_POOL_RECYCLE:
+            _db_discard(pool, conn)
+            continue
+        if now - times[1] > DB_POOL_PING_IDLE:
+            try:
+                with conn.cursor() as cur:
+                    cur.execute("select 1;")
+                conn.rollback()
+            except psycopg2.Error:
+                _db_discard(pool, conn)
+                continue
+        return conn
+    return pool.getconn()
+
+
+@contextmanager
+def db_conn():
+    """Conexión del pool como contexto: commit al salir bien, rollback si hay excepción, y se devuelve al pool."""
+    if not _db_pool_sem.acquire(timeout=DB_POOL_TIMEOUT):
+        raise RuntimeError("No hay conexiones libres con la base de datos")
+    try:
+        pool = _get_db_pool()
+        conn = _db_checkout(pool)
+        broken = False
+        try:
+            with conn:
+                yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        finally:
+            if broken or conn.closed:
+                _db_discard(pool, conn)
+            else:
+                _db_conn_times.setdefault(id(conn), [time.monotonic(), 0.0])[1] = time.monotonic()
+                pool.putconn(conn)
+    finally:
+        _db_pool_sem.release()
 
-def db_all(sql: str, params=()) -> List[Dict[str, Any]]:
+
+def db_all(sql: str, params=(), cursor_factory=None) -> List[Any]:
+    # Por defecto filas dict (RealDictCursor de la conexión); los listados grandes
+    # pueden pedir NamedTupleCursor y desempaquetar por posición.
     with db_conn() as conn:
-        with conn.cursor() as cur:
+        with conn.cursor(cursor_factory=cursor_factory) as cur:
             cur.execute(sql, params)
             rows = cur.fetchall()
             return list(rows or [])
 
 
+def db_iter(sql: str, params=(), cursor_factory=None, itersize: int = 500) -> Iterator[Any]:
+    """Filas con cursor de servidor (named), de itersize en itersize, para exportaciones sin paginar.
+    La consulta se ejecuta y se lee el primer lote ANTES de devolver: un error de BD sale aquí
+    (el handler responde 500) y no a mitad de una respuesta ya empezada.
+    La conexión queda ocupada hasta agotar (o descartar) el iterador."""
+    with ExitStack() as stack:
+        conn = stack.enter_context(db_conn())
+        cur = stack.enter_context(conn.cursor(name=f"iter_{secrets.token_hex(4)}", cursor_factory=cursor_factory))
+        cur.itersize = itersize
+        cur.execute(sql, params)
+        first = cur.fetchmany(itersize)
+        stack = stack.pop_all()
+
+    def gen():
+        with stack:
+            yield None
+            batch = first
+            while batch:
+                yield from batch
+                batch = cur.fetchmany(itersize)
+
+    # Se arranca ya el generador (queda dentro del with): si nunca se consume,
+    # al recogerlo se cierra y la conexión vuelve al pool.
+    it = gen()
+    next(it)
+    return it
+
+
 def db_one(sql: str, params=()) -> Optional[Dict[str, Any]]:
     rows = db_all(sql, params)
     return rows[0] if rows else None
@@ -184,8 +338,6 @@ def db_exec(sql: str, params=()) -> None:
         conn.commit()
 
 
-
-
 def db_exec_safe(sql: str, params=(), label: str = "") -> None:
     """Ejecuta SQL sin tumbar la app (para migraciones suaves)."""
     try:
@@ -208,6 +360,12 @@ def ensure_schema_and_seed() -> None:
     """
     )
 
+    # Códigos únicos sin distinguir mayúsculas (lo usa el "on conflict" de crear usuario)
+    db_exec_safe(
+        "create unique index if not exists wom_users_code_upper_uidx on public.wom_users (upper(code));",
+        label="users_code_upper_uidx",
+    )
+
     # Migración segura de roles (añade TECNICO a la constraint)
     db_exec_safe("alter table public.wom_users drop constraint if exists wom_users_role_check;", label="drop_role_check")
     db_exec_safe(
@@ -380,12 +538,39 @@ def ensure_schema_and_seed() -> None:
     db_exec("create index if not exists wom_hours_worker_idx on public.wom_hours(worker_code);")
     db_exec("create index if not exists wom_hours_entry_idx on public.wom_hours(entry_at desc);")
     db_exec("create index if not exists wom_hours_room_idx on public.wom_hours(room_name);")
+    # Consulta mensual de horas (consultar y PDF): worker_code = ? and entry_at en [inicio, fin)
+    db_exec_safe(
+        "create index if not exists wom_hours_worker_entry_idx on public.wom_hours(worker_code, entry_at);",
+        label="idx_hours_worker_entry",
+    )
 
     
     # Migración suave (si la tabla ya existía)
     db_exec("alter table public.wom_tickets add column if not exists priority text not null default 'MEDIO';")
     db_exec("alter table public.wom_tickets add column if not exists image_url text;")
     db_exec("alter table public.wom_tickets add column if not exists image_path text;")
+    # La referencia se guarda siempre en mayúsculas: así la igualdad usa el índice único
+    # (constraint unique de la tabla) sin necesidad de upper() en las consultas.
+    # Sólo la primera vez: una vez creado el check, ni el update (recorre la tabla) ni el alter
+    # (bloqueo exclusivo y revalidación) se repiten en cada arranque. El advisory lock serializa a
+    # los workers que arrancan a la vez; el segundo ya encuentra el check y no hace nada.
+    db_exec_safe(
+        """
+        do $$
+        begin
+          perform pg_advisory_xact_lock(hashtext('wom_tickets_ref_upper_check'));
+          if not exists (
+            select 1 from pg_constraint
+            where conname = 'wom_tickets_ref_upper_check' and conrelid = 'public.wom_tickets'::regclass
+          ) then
+            update public.wom_tickets set referencia = upper(referencia) where referencia <> upper(referencia);
+            alter table public.wom_tickets add constraint wom_tickets_ref_upper_check check (referencia = upper(referencia));
+          end if;
+        end
+        $$;
+        """,
+        label="ref_upper_check",
+    )
     # Tabla de imágenes por parte (hasta 3)
     db_exec(
         """
@@ -405,12 +590,48 @@ def ensure_schema_and_seed() -> None:
     db_exec(
         "create index if not exists wom_tickets_created_at_idx on public.wom_tickets(created_at desc);"
     )
+    # Listados por estado: compuesto (estado, fecha) + parciales para "en proceso" / "finalizados".
+    # estado_encargado es NOT NULL con check, así que "no finalizado" se expresa en positivo (sargable).
+    db_exec(
+        "create index if not exists wom_tickets_estado_created_idx on public.wom_tickets(estado_encargado, created_at desc);"
+    )
+    db_exec_safe("drop index if exists public.wom_tickets_estado_idx;", label="drop_idx_tickets_estado")
+    # (created_at desc, id desc): mismo orden que la paginación keyset de los listados.
+    db_exec_safe("drop index if exists public.wom_tickets_activos_idx;", label="drop_idx_tickets_activos")
+    db_exec_safe("drop index if exists public.wom_tickets_finalizados_idx;", label="drop_idx_tickets_finalizados")
+    db_exec(
+        f"""
+        create index if not exists wom_tickets_activos_key_idx on public.wom_tickets(created_at desc, id desc)
+        where {SQL_PARTE_ABIERTO};
+        """
+    )
     db_exec(
-        "create index if not exists wom_tickets_estado_idx on public.wom_tickets(estado_encargado);"
+        f"""
+        create index if not exists wom_tickets_finalizados_key_idx on public.wom_tickets(created_at desc, id desc)
+        where {SQL_PARTE_FINALIZADO};
+        """
     )
     db_exec(
         "create index if not exists wom_tickets_user_idx on public.wom_tickets(created_by_code);"
     )
+    # Partes en proceso filtrados por sala (visualizar / PDF del encargado y consulta de jefatura).
+    db_exec(
+        f"""
+        create index if not exists wom_tickets_activos_sala_idx on public.wom_tickets(room_name, created_at desc)
+        where {SQL_PARTE_ABIERTO};
+        """
+    )
+    # Contador de "sin ver" del menú de encargado: sólo indexa los partes abiertos aún no vistos.
+    db_exec(
+        f"""
+        create index if not exists wom_tickets_sin_ver_idx on public.wom_tickets(priority)
+        where {SQL_PARTE_ABIERTO} and visto_por_encargado = false;
+        """
+    )
+    # Sonda del ETag de listados: max(updated_at) por índice, sin recorrer la tabla.
+    db_exec(
+        "create index if not exists wom_tickets_updated_at_idx on public.wom_tickets(updated_at desc);"
+    )
     db_exec(
         "create index if not exists wom_tickets_room_idx on public.wom_tickets(room_name);"
     )
@@ -578,20 +799,106 @@ def formatear_fecha_hora(dt_value) -> Tuple[str, str]:
         return "??/??/????", "??:??"
 
 
+# Fecha/hora de Madrid formateadas ya en Postgres para los listados (to_char en C, una vez por fila).
+SQL_FECHA_HORA = (
+    "to_char(created_at at time zone 'Europe/Madrid', 'DD/MM/YYYY') as fecha_fmt, "
+    "to_char(created_at at time zone 'Europe/Madrid', 'HH24:MI') as hora_fmt"
+)
+
+
+def fecha_hora_de(p: Dict[str, Any]) -> Tuple[str, str]:
+    """(fecha, hora) de una fila de parte: usa fecha_fmt/hora_fmt si la consulta los trae (SQL_FECHA_HORA)."""
+    f = p.get("fecha_fmt")
+    if f is not None:
+        return f, p.get("hora_fmt") or ""
+    return formatear_fecha_hora(p.get("created_at"))
+
+
+def norm_code(code: str) -> str:
+    """Código de usuario normalizado (sin espacios, en mayúsculas), como se guarda en sesión."""
+    return (code or "").strip().upper()
+
+
 def get_user_by_code(code: str) -> Optional[Dict[str, str]]:
-    c = (code or "").strip().upper()
+    c = norm_code(code)
     row = db_one(
-        "select code, name, role from public.wom_users where upper(code)=upper(%s) limit 1;",
+        "select code, name, role from public.wom_users where upper(code)=%s limit 1;",
         (c,),
     )
     if not row:
         return None
-    return {"codigo": row["code"].strip().upper(), "nombre": row["name"], "rol": row["role"]}
+    return {"codigo": norm_code(row["code"]), "nombre": row["name"], "rol": row["role"]}
+
+
+# --- Caché de salas (cambian muy poco; se invalida al añadir una sala) ---
+# Si hay DATABASE_DIRECT_URL, cada proceso escucha el canal SALAS_CHANNEL (LISTEN/NOTIFY) por esa
+# conexión de sesión y vacía su caché en cuanto otro worker inserta una sala. Sin ella (sólo el pooler
+# en modo transacción, donde LISTEN no llega) el mecanismo es el TTL: otros workers tardan como mucho
+# SALAS_CACHE_TTL en ver la sala nueva; el proceso que la inserta vacía la suya al momento.
+SALAS_CACHE_TTL = 60  # segundos
+SALAS_CHANNEL = "salas_changed"
+_salas_cache = None  # (caduca_en, salas, html de <option>)
+_salas_lock = threading.Lock()
+
+
+def _salas_cached():
+    global _salas_cache
+    c = _salas_cache
+    if c is not None and c[0] > time.monotonic():
+        return c
+    # Sólo el primero que la encuentra caducada la rellena; el resto espera al lock y reutiliza esa carga.
+    with _salas_lock:
+        c = _salas_cache
+        now = time.monotonic()
+        if c is None or c[0] <= now:
+            rows = db_all("select name from public.wom_rooms order by name asc;")
+            salas = [r["name"] for r in rows]
+            opts = "".join([f"<option value='{h(s)}'>{h(s)}</option>" for s in salas])
+            c = _salas_cache = (now + SALAS_CACHE_TTL, salas, opts)
+        return c
+
+
+def _salas_listen_loop() -> None:
+    """Hilo de fondo: LISTEN sobre SALAS_CHANNEL por DATABASE_DIRECT_URL y reset de la caché en cada
+    NOTIFY (reconecta si falla)."""
+    while True:
+        conn = None
+        try:
+            conn = db_connect(DATABASE_DIRECT_URL)
+            conn.autocommit = True
+            with conn.cursor() as cur:
+                cur.execute(f"listen {SALAS_CHANNEL};")
+            while True:
+                if select.select([conn], [], [], 60) == ([], [], []):
+                    continue
+                conn.poll()
+                if conn.notifies:
+                    conn.notifies.clear()
+                    salas_cache_reset()
+        except Exception as e:
+            print(f"[salas_listen] {e}")
+            salas_cache_reset()
+            time.sleep(5)
+        finally:
+            if conn is not None:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
 
 
 def get_salas() -> List[str]:
-    rows = db_all("select name from public.wom_rooms order by name asc;")
-    return [r["name"] for r in rows]
+    return list(_salas_cached()[1])
+
+
+def salas_options_html() -> str:
+    """<option> de todas las salas (sin selección), cacheado junto a get_salas()."""
+    return _salas_cached()[2]
+
+
+def salas_cache_reset() -> None:
+    global _salas_cache
+    _salas_cache = None
 
 
 def generar_referencia() -> str:
@@ -605,13 +912,31 @@ def generar_referencia() -> str:
             return ref
 
 
+def norm_ref(ref: str) -> str:
+    return (ref or "").strip().upper()
+
+
 def ticket_por_ref(ref: str) -> Optional[Dict[str, Any]]:
-    r = (ref or "").strip().upper()
-    return db_one("select * from public.wom_tickets where referencia=%s;", (r,))
+    """Parte por referencia, con sus imágenes (wom_ticket_images) ya agregadas en image_urls."""
+    r = norm_ref(ref)
+    return db_one(
+        """
+        select t.*,
+               coalesce(
+                 (select array_agg(i.image_url order by i.position)
+                    from public.wom_ticket_images i
+                   where i.ticket_id=t.id and coalesce(i.image_url,'') <> ''),
+                 '{}'::text[]
+               ) as image_urls
+        from public.wom_tickets t
+        where t.referencia=%s;
+        """,
+        (r,),
+    )
 
 
 def update_ticket(ref: str, set_sql: str, params: Tuple[Any, ...]) -> None:
-    r = (ref or "").strip().upper()
+    r = norm_ref(ref)
     db_exec(
         f"update public.wom_tickets set {set_sql}, updated_at=now() where referencia=%s;",
         params + (r,),
@@ -628,19 +953,41 @@ def _safe_ext(filename: str) -> str:
     return ""
 
 
+# --- Cliente HTTP de Supabase Storage ---
+# Una conexión keep-alive por hilo (las subidas/borrados corren en hilos del executor, que se reutilizan):
+# así varias imágenes seguidas no pagan cada una su handshake TLS.
+_storage_local = threading.local()
+
+
+def _storage_request(method: str, url: str, body: Optional[bytes] = None, headers: Optional[Dict[str, str]] = None) -> Tuple[int, str, bytes]:
+    """Petición a Storage por la conexión persistente del hilo. Devuelve (status, reason, cuerpo)."""
+    parts = urllib.parse.urlsplit(url)
+    target = parts.path + (f"?{parts.query}" if parts.query else "")
+    for attempt in (0, 1):
+        conn = getattr(_storage_local, "conn", None)
+        if conn is None or getattr(_storage_local, "netloc", None) != (parts.scheme, parts.netloc):
+            cls = http.client.HTTPSConnection if parts.scheme == "https" else http.client.HTTPConnection
+            conn = cls(parts.netloc, timeout=30)
+            _storage_local.conn, _storage_local.netloc = conn, (parts.scheme, parts.netloc)
+        try:
+            conn.request(method, target, body=body, headers=headers or {})
+            resp = conn.getresponse()
+            return resp.status, resp.reason, resp.read()
+        except (http.client.HTTPException, OSError):
+            # Conexión caducada por el servidor: se reabre y se reintenta una vez (PUT/DELETE son idempotentes).
+            conn.close()
+            _storage_local.conn = None
+            if attempt:
+                raise
+    raise RuntimeError("unreachable")
+
+
 def supabase_storage_upload(bucket: str, path: str, file_bytes: bytes, content_type: str) -> str:
     """
     Sube un objeto a Supabase Storage usando la API REST. Devuelve URL pública.
     Requiere bucket público, o bien que luego uses URLs firmadas (no implementado aquí).
     """
-    supabase_url = (os.getenv("SUPABASE_URL", "") or "").strip().rstrip("/")
-    key = (
-        (os.getenv("SUPABASE_SERVICE_ROLE_KEY", "") or "").strip()
-        or (os.getenv("SUPABASE_SERVICE_KEY", "") or "").strip()
-        or (os.getenv("SUPABASE_KEY", "") or "").strip()
-    )
-    if not supabase_url or not key:
-        raise RuntimeError("Falta SUPABASE_URL y/o SUPABASE_SERVICE_ROLE_KEY (o SUPABASE_KEY)")
+    supabase_url, key = _supabase_creds()
 
     url = f"{supabase_url}/storage/v1/object/{bucket}/{path}"
     headers = {
@@ -649,19 +996,13 @@ def supabase_storage_upload(bucket: str, path: str, file_bytes: bytes, content_t
         "Content-Type": content_type or "application/octet-stream",
         "x-upsert": "true",
     }
-    req = urllib.request.Request(url, data=file_bytes, headers=headers, method="PUT")
-    try:
-        with urllib.request.urlopen(req, timeout=30) as resp:
-            resp.read()
-    except urllib.error.HTTPError as e:
-        body = (e.read() or b"").decode("utf-8", errors="ignore")
-        raise RuntimeError(f"Error subiendo imagen: {e.code} {e.reason} {body}")
+    status, reason, body = _storage_request("PUT", url, file_bytes, headers)
+    if status >= 300:
+        raise RuntimeError(f"Error subiendo imagen: {status} {reason} {body.decode('utf-8', errors='ignore')}")
 
     return f"{supabase_url}/storage/v1/object/public/{bucket}/{path}"
 
 
-
-
 def _supabase_creds() -> Tuple[str, str]:
     supabase_url = (os.getenv("SUPABASE_URL", "") or "").strip().rstrip("/")
     key = (
@@ -677,8 +1018,9 @@ def _supabase_creds() -> Tuple[str, str]:
 def supabase_storage_remove(bucket: str, paths: List[str]) -> None:
     """
     Elimina uno o varios objetos del bucket (por path) usando la API REST.
-    Usamos DELETE por objeto (robusto) y, si falla, intentamos el endpoint /object/remove.
+    Primero un único DELETE batch ({"prefixes": [...]}); si falla, DELETE por objeto.
     """
+    paths = [p.strip() for p in (paths or []) if (p or "").strip()]
     if not paths:
         return
     supabase_url, key = _supabase_creds()
@@ -689,52 +1031,51 @@ def supabase_storage_remove(bucket: str, paths: List[str]) -> None:
         "apikey": key,
     }
 
-    # 1) DELETE por cada objeto (más compatible)
-    failed: List[str] = []
+    # 1) Batch: todos los objetos en una sola petición
+    url = f"{supabase_url}/storage/v1/object/{bucket}"
+    payload = json.dumps({"prefixes": paths}).encode("utf-8")
+    try:
+        status, reason, body = _storage_request("DELETE", url, payload, {**headers, "Content-Type": "application/json"})
+        if status < 300:
+            return
+        print(f"[storage-delete-batch] HTTPError {status} {reason} body={body.decode('utf-8', errors='ignore')[:500]}")
+    except Exception as e:
+        print(f"[storage-delete-batch] Error err={e}")
+
+    # 2) Fallback: DELETE por cada objeto; todos por la misma conexión
     for p in paths:
-        p = (p or "").strip()
-        if not p:
-            continue
         # encode path pero preservando '/'
         encoded = urllib.parse.quote(p, safe="/")
         url = f"{supabase_url}/storage/v1/object/{bucket}/{encoded}"
-        req = urllib.request.Request(url, headers=headers, method="DELETE")
         try:
-            with urllib.request.urlopen(req, timeout=30) as resp:
-                resp.read()
-        except urllib.error.HTTPError as e:
-            body = (e.read() or b"").decode("utf-8", errors="ignore")
-            print(f"[storage-delete] HTTPError {e.code} {e.reason} path={p} body={body[:500]}")
-            failed.append(p)
+            status, reason, body = _storage_request("DELETE", url, None, headers)
+            if status >= 300:
+                print(f"[storage-delete] HTTPError {status} {reason} path={p} body={body.decode('utf-8', errors='ignore')[:500]}")
         except Exception as e:
             print(f"[storage-delete] Error path={p} err={e}")
-            failed.append(p)
-
-    # 2) Fallback: endpoint remove (batch) si algo falló
-    if failed:
-        url = f"{supabase_url}/storage/v1/object/remove/{bucket}"
-        payload = json.dumps({"prefixes": failed}).encode("utf-8")
-        hdrs = {
-            "Authorization": f"Bearer {key}",
-            "apikey": key,
-            "Content-Type": "application/json",
-        }
-        req2 = urllib.request.Request(url, data=payload, headers=hdrs, method="POST")
-        try:
-            with urllib.request.urlopen(req2, timeout=30) as resp:
-                resp.read()
-        except urllib.error.HTTPError as e:
-            body = (e.read() or b"").decode("utf-8", errors="ignore")
-            print(f"[storage-delete-batch] HTTPError {e.code} {e.reason} body={body[:500]}")
-        except Exception as e:
-            print(f"[storage-delete-batch] Error err={e}")
+
+
+def add_legacy_image_path(paths: List[str], trow: Dict[str, Any], bucket: str) -> None:
+    """Añade a `paths` la imagen de las columnas legacy image_path/image_url de wom_tickets."""
+    legacy_path = (trow.get("image_path") or "").strip()
+    if legacy_path and legacy_path not in paths:
+        paths.append(legacy_path)
+    # Si solo hay URL pero no path, intentamos derivar el path (best-effort)
+    legacy_url = (trow.get("image_url") or "").strip()
+    if legacy_url and not legacy_path:
+        # Esperamos .../storage/v1/object/public/{bucket}/{path}
+        marker = f"/storage/v1/object/public/{bucket}/"
+        if marker in legacy_url:
+            derived = legacy_url.split(marker, 1)[-1].strip()
+            if derived and derived not in paths:
+                paths.append(derived)
 
 
 def cleanup_ticket_images(ticket_id: int) -> None:
     """Elimina imágenes asociadas a un ticket tanto en Supabase Storage como en BD.
-    - Borra objetos por image_path (tabla wom_ticket_images y/o campos legacy en wom_tickets)
-    - Limpia tabla public.wom_ticket_images
-    - Pone image_url/image_path a NULL en public.wom_tickets
+    - Una sola sentencia: borra wom_ticket_images, pone image_url/image_path a NULL en
+      public.wom_tickets y devuelve los paths (tabla y legacy, leídos antes del cambio)
+    - Borra los objetos en Storage con una única llamada batch
     Esta función NUNCA debe romper el flujo (captura excepciones y loguea).
     """
     try:
@@ -746,37 +1087,30 @@ def cleanup_ticket_images(ticket_id: int) -> None:
 
     paths: List[str] = []
     try:
-        rows = db_all(
-            "select image_path from public.wom_ticket_images where ticket_id=%s order by position asc;",
-            (tid,),
-        )
-        for r in rows:
-            p = (r.get("image_path") or "").strip()
+        row = db_one(
+            """
+            with imgs as (
+              delete from public.wom_ticket_images where ticket_id=%s
+              returning position, image_path
+            ), legacy as (
+              select image_path, image_url from public.wom_tickets where id=%s
+            ), upd as (
+              update public.wom_tickets set image_url=null, image_path=null where id=%s
+            )
+            select (select array_agg(image_path order by position) from imgs) as paths,
+                   (select image_path from legacy) as image_path,
+                   (select image_url from legacy) as image_url;
+            """,
+            (tid, tid, tid),
+        ) or {}
+        for p in row.get("paths") or []:
+            p = (p or "").strip()
             if p:
                 paths.append(p)
+        # Fallback: columnas legacy en wom_tickets
+        add_legacy_image_path(paths, row, bucket)
     except Exception as e:
-        print(f"[cleanup_ticket_images] error leyendo wom_ticket_images tid={tid} err={e}")
-
-    # Fallback: columnas legacy en wom_tickets
-    try:
-        trow = db_one(
-            "select image_path, image_url from public.wom_tickets where id=%s;",
-            (tid,),
-        ) or {}
-        legacy_path = (trow.get("image_path") or "").strip()
-        if legacy_path and legacy_path not in paths:
-            paths.append(legacy_path)
-        # Si solo hay URL pero no path, intentamos derivar el path (best-effort)
-        legacy_url = (trow.get("image_url") or "").strip()
-        if legacy_url and not legacy_path:
-            # Esperamos .../storage/v1/object/public/{bucket}/{path}
-            marker = f"/storage/v1/object/public/{bucket}/"
-            if marker in legacy_url:
-                derived = legacy_url.split(marker, 1)[-1].strip()
-                if derived and derived not in paths:
-                    paths.append(derived)
-    except Exception as e:
-        print(f"[cleanup_ticket_images] error leyendo wom_tickets tid={tid} err={e}")
+        print(f"[cleanup_ticket_images] error limpiando imágenes en BD tid={tid} err={e}")
 
     # Borrar en Storage
     try:
@@ -785,19 +1119,33 @@ def cleanup_ticket_images(ticket_id: int) -> None:
     except Exception as e:
         print(f"[cleanup_ticket_images] error borrando storage tid={tid} err={e}")
 
-    # Limpiar BD
-    try:
-        db_exec("delete from public.wom_ticket_images where ticket_id=%s;", (tid,))
-    except Exception as e:
-        print(f"[cleanup_ticket_images] error borrando wom_ticket_images tid={tid} err={e}")
 
-    try:
-        db_exec(
-            "update public.wom_tickets set image_url=null, image_path=null where id=%s;",
-            (tid,),
-        )
-    except Exception as e:
-        print(f"[cleanup_ticket_images] error limpiando legacy wom_tickets tid={tid} err={e}")
+def save_ticket_images(ticket_id: int, image_rows: List[Tuple[int, str, str]]) -> None:
+    """Guarda las imágenes de un parte en un solo round-trip.
+    image_rows: [(position, image_url, image_path), ...]
+    La imagen en posición 1 se copia también a wom_tickets.image_url/image_path (compatibilidad).
+    """
+    if not image_rows:
+        return
+    with db_conn() as conn:
+        with conn.cursor() as cur:
+            execute_values(
+                cur,
+                """
+                with ins as (
+                  insert into public.wom_ticket_images (ticket_id, position, image_url, image_path)
+                  values %s
+                  on conflict (ticket_id, position) do update set image_url=excluded.image_url, image_path=excluded.image_path
+                  returning ticket_id, position, image_url, image_path
+                )
+                update public.wom_tickets t
+                   set image_url=ins.image_url, image_path=ins.image_path
+                  from ins
+                 where t.id=ins.ticket_id and ins.position=1;
+                """,
+                [(int(ticket_id), pos, url, path) for pos, url, path in image_rows],
+            )
+        conn.commit()
 
 
 def sanitize_salas_selection(salas_selected: Optional[List[str]]) -> Optional[List[str]]:
@@ -838,34 +1186,15 @@ def _to_paragraph_text_multiline(s: str) -> str:
 def _query_partes_en_proceso_filtrado(
     salas_filtro: Optional[List[str]],
 ) -> List[Dict[str, Any]]:
-    if salas_filtro:
-        return db_all(
-            """
-            select
-              referencia,
-              created_at,
-              created_by_name,
-              room_name,
-              tipo,
-              priority,
-              descripcion,
-              solucionado_por_usuario,
-              reparacion_usuario,
-              visto_por_encargado,
-              estado_encargado,
-              observaciones_encargado
-            from public.wom_tickets
-            where (estado_encargado is null or estado_encargado not in ('TRABAJO TERMINADO/REPARADO','TRABAJO DESESTIMADO'))
-              and room_name = any(%s)
-            order by created_at desc;
-        """,
-            (salas_filtro,),
-        )
+    # room_name/created_by_name ya están desnormalizados en wom_tickets: no hay join que materializar.
+    # Sin filtro lo sirve wom_tickets_activos_key_idx; con filtro, wom_tickets_activos_sala_idx.
+    salas = list(salas_filtro) if salas_filtro else None
     return db_all(
-        """
+        f"""
         select
           referencia,
           created_at,
+          {SQL_FECHA_HORA},
           created_by_name,
           room_name,
           tipo,
@@ -877,28 +1206,67 @@ def _query_partes_en_proceso_filtrado(
           estado_encargado,
           observaciones_encargado
         from public.wom_tickets
-        where (estado_encargado is null or estado_encargado not in ('TRABAJO TERMINADO/REPARADO','TRABAJO DESESTIMADO'))
-        order by created_at desc;
-    """
+        where {SQL_PARTE_ABIERTO}
+          and (%s::text[] is null or room_name = any(%s::text[]))
+        order by created_at desc, id desc;
+    """,
+        (salas, salas),
     )
 
 
-def generar_pdf_partes_en_proceso(salas_filtro: Optional[List[str]]) -> Path:
-    from reportlab.lib.pagesizes import A4
-    from reportlab.lib.units import mm
-    from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-    from reportlab.lib import colors
-    from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer
-    from reportlab.platypus.flowables import HRFlowable
+def pdf_response(pdf: bytes, filename: str) -> Response:
+    # El PDF se sirve desde memoria: no se deja ningún fichero en disco.
+    return Response(
+        content=pdf,
+        media_type="application/pdf",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
+def pdf_buffer_response(buf: BytesIO, filename: str) -> StreamingResponse:
+    """Como pdf_response, pero envía el buffer ya escrito tal cual (memoryview) sin copiarlo a bytes.
+    El PDF está completo antes de responder, así que cualquier error sale antes del 200."""
+    data = buf.getbuffer()
+    return StreamingResponse(
+        iter((data,)),
+        media_type="application/pdf",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"', "Content-Length": str(data.nbytes)},
+    )
+
+
+# Estilos de los PDF: se construyen una vez al arrancar y se reutilizan en cada informe.
+_PDF_STYLES = getSampleStyleSheet()
+_ST_PARTES_TITLE = ParagraphStyle("title_small", parent=_PDF_STYLES["Heading2"], fontSize=12, leading=14, spaceAfter=6)
+_ST_PARTES_LINE = ParagraphStyle("line", parent=_PDF_STYLES["Normal"], fontSize=8, leading=9, spaceAfter=1)
+_ST_PARTES_LABEL = ParagraphStyle("label", parent=_PDF_STYLES["Normal"], fontSize=8, leading=9, spaceBefore=1, spaceAfter=0)
+_ST_PARTES_MONO = ParagraphStyle("mono", parent=_PDF_STYLES["Normal"], fontName="Courier", fontSize=8.5, leading=10, spaceAfter=1)
+_ST_HORAS_TITLE = ParagraphStyle("t", parent=_PDF_STYLES["Normal"], fontName="Helvetica-Bold", fontSize=16, leading=18)
+_ST_HORAS_MID = ParagraphStyle("m", parent=_PDF_STYLES["Normal"], fontName="Helvetica", fontSize=11, leading=13)
+# Solo usa índices relativos (0 = cabecera, -1 = fila TOTAL): vale para cualquier número de filas
+_HORAS_TABLE_STYLE = TableStyle(
+    [
+        ("FONTNAME", (0, 0), (-1, -1), "Courier"),
+        ("FONTSIZE", (0, 0), (-1, -1), 8),
+        ("LINEBELOW", (0, 0), (-1, 0), 1, colors.black),
+        ("GRID", (0, 0), (-1, -1), 0.25, colors.grey),
+        ("BACKGROUND", (0, 0), (-1, 0), colors.whitesmoke),
+        ("FONTNAME", (0, 0), (-1, 0), "Courier-Bold"),
+        ("FONTNAME", (2, -1), (-1, -1), "Courier-Bold"),
+    ]
+)
+
+
+def generar_pdf_partes_en_proceso(salas_filtro: Optional[List[str]]) -> Tuple[str, bytes]:
+    """Genera el PDF en memoria y devuelve (nombre de fichero, contenido)."""
 
     rows = _query_partes_en_proceso_filtrado(salas_filtro)
 
-    out_dir = Path.cwd()
     ts = now_madrid().strftime("%Y%m%d_%H%M%S")
-    out_path = out_dir / f"relacion_partes_en_proceso_{ts}.pdf"
+    filename = f"relacion_partes_en_proceso_{ts}.pdf"
+    buf = BytesIO()
 
     doc = SimpleDocTemplate(
-        str(out_path),
+        buf,
         pagesize=A4,
         leftMargin=12 * mm,
         rightMargin=12 * mm,
@@ -907,14 +1275,9 @@ def generar_pdf_partes_en_proceso(salas_filtro: Optional[List[str]]) -> Path:
         title="Relación de Partes en Proceso",
     )
 
-    styles = getSampleStyleSheet()
-    st_title = ParagraphStyle("title_small", parent=styles["Heading2"], fontSize=12, leading=14, spaceAfter=6)
-    st_line = ParagraphStyle("line", parent=styles["Normal"], fontSize=8, leading=9, spaceAfter=1)
-    st_label = ParagraphStyle("label", parent=styles["Normal"], fontSize=8, leading=9, spaceBefore=1, spaceAfter=0)
-    st_mono = ParagraphStyle("mono", parent=styles["Normal"], fontName="Courier", fontSize=8.5, leading=10, spaceAfter=1)
+    st_title, st_line, st_label, st_mono = _ST_PARTES_TITLE, _ST_PARTES_LINE, _ST_PARTES_LABEL, _ST_PARTES_MONO
 
-    def e(s: str) -> str:
-        return _xml_escape(s or "").replace("\n", "<br/>")
+    e = _to_paragraph_text_multiline
 
     filtro_txt = "TODAS" if not salas_filtro else ", ".join(salas_filtro)
     story = []
@@ -925,15 +1288,11 @@ def generar_pdf_partes_en_proceso(salas_filtro: Optional[List[str]]) -> Path:
     azul_sala = "#003366"
 
     for p in rows:
-        fecha, hora = formatear_fecha_hora(p.get("created_at"))
+        fecha, hora = fecha_hora_de(p)
         ref = (p.get("referencia") or "").strip()
         sala = p.get("room_name") or ""
         tipo = p.get("tipo") or ""
         prio = (p.get("priority") or "MEDIO").upper()
-        prio_opts_sel = "\n".join([
-            f"<option value='{h(k)}'" + (" selected" if k == prio else "") + f">{h(v)}</option>"
-            for k, v, _ in PRIORIDADES
-        ])
         autor = p.get("created_by_name") or ""
         estado = p.get("estado_encargado") or "SIN ESTADO"
 
@@ -973,100 +1332,157 @@ def generar_pdf_partes_en_proceso(salas_filtro: Optional[List[str]]) -> Path:
         story.append(Spacer(1, 10))
 
     doc.build(story)
-    return out_path
-
-
-    for p in rows:
-        fecha, hora = formatear_fecha_hora(p.get("created_at"))
-        ref = (p.get("referencia") or "").strip()
-        sala = p.get("room_name") or ""
-        tipo = p.get("tipo") or ""
-        autor = p.get("created_by_name") or ""
-        estado = p.get("estado_encargado") or "SIN ESTADO"
-        visto = "Sí" if p.get("visto_por_encargado") else "No"
-        estado = p.get("estado_encargado") or "SIN ESTADO"
-
-        descripcion = p.get("descripcion") or "(Sin descripción)"
-        observaciones = (p.get("observaciones_encargado") or "").strip() or "(Sin observaciones)"
-        reparacion = (p.get("reparacion_usuario") or "").strip() or "(No aplica)"
-
-        story.append(Paragraph(f"<b>Referencia:</b> {_xml_escape(ref)}", label))
-        story.append(Paragraph(f"<b>Fecha/Hora:</b> {_xml_escape(fecha)} {_xml_escape(hora)}", label))
-        story.append(Paragraph(f"<b>Sala:</b> {_xml_escape(sala)}", label))
-        story.append(Paragraph(f"<b>Tipo:</b> {_xml_escape(tipo)}", label))
-        story.append(Paragraph(f"<b>Creado por:</b> {_xml_escape(autor)}", label))
-        story.append(
-            Paragraph(
-                f"<b>Visto:</b> {_xml_escape(visto)} &nbsp;&nbsp; <b>Estado:</b> {_xml_escape(estado)}",
-                label,
-            )
-        )
-        story.append(Spacer(1, 4))
-
-        story.append(Paragraph("<b>Reparación realizada por el trabajador (si aplica):</b>", label))
-        story.append(Paragraph(_to_paragraph_text_multiline(reparacion), block))
-
-        story.append(Paragraph("<b>Observaciones del encargado:</b>", label))
-        story.append(Paragraph(_to_paragraph_text_multiline(observaciones), block))
-
-        story.append(Paragraph("<b>Descripción del parte:</b>", label))
-        story.append(Paragraph(_to_paragraph_text_multiline(descripcion), block))
-
-        story.append(HRFlowable(thickness=0.6, width="100%"))
-        story.append(Spacer(1, 10))
-
-    doc.build(story)
-    return out_path
+    return filename, buf.getvalue()
 
 
 # =========================
 # HTML helpers
 # =========================
-def h(s: Any) -> str:
-    import html
+def h(s: Any, _escape=html.escape) -> str:
+    # Import a nivel de módulo y escape ligado como default: es la función más llamada al pintar listados.
+    if s is None:
+        return ""
+    return _escape(s if type(s) is str else str(s))
 
-    return html.escape("" if s is None else str(s))
 
+# h() memoizado para columnas de pocos valores distintos que se repiten fila tras fila en los
+# listados (tipo de movimiento, ubicación, usuario); descripciones y códigos siguen con h().
+h_repetido = lru_cache(maxsize=512)(h)
 
-def page(title: str, body: str) -> str:
-    return f"""<!doctype html>
+
+# Spans/badges de prioridad precalculados al importar (ver prio_span). Los colores del badge salen
+# sólo de PRIORIDADES; el de por defecto es para prioridades desconocidas.
+_PRIO_SPAN: Dict[Tuple[Optional[str], Optional[str]], str] = {
+    (p, e): _build_prio_span(p, e)
+    for p in [k for k, _label, _c in PRIORIDADES] + [None]
+    for e in ESTADOS_ENCARGADO + [None]
+}
+_PRIO_BADGE = {k: f"<b style='color:{c}'>{h(label)}</b>" for (k, label, c) in PRIORIDADES}
+_PRIO_BADGE_DEFAULT = f"<b style='color:#f39c12'>{h(prio_label(''))}</b>"
+
+
+# Cabecera y cierre del layout son fijos: se guardan como constantes (y ya codificados en UTF-8)
+# para que cada respuesta sólo tenga que escapar el título y pegar el cuerpo.
+_PAGE_PRE = """<!doctype html>
 <html lang="es">
 <head>
   <meta charset="utf-8"/>
   <meta name="viewport" content="width=device-width,initial-scale=1"/>
-  <title>{h(title)}</title>
+  <title>"""
+_PAGE_MID = """</title>
   <style>
-    body{{font-family: -apple-system, system-ui, Arial; margin: 24px; max-width: 980px}}
-    .card{{border:1px solid #ddd; border-radius:12px; padding:16px; margin:12px 0}}
-    .row{{display:flex; gap:12px; flex-wrap:wrap}}
-    .btn{{display:inline-block; padding:10px 14px; border-radius:10px; border:1px solid #333; text-decoration:none; color:#111; background:#fff}}
-    .btn2{{display:inline-block; padding:10px 14px; border-radius:10px; border:1px solid #999; text-decoration:none; color:#111; background:#fff}}
-    .danger{{border-color:#c00; color:#c00}}
-    input, select, textarea{{width:100%; padding:10px; border-radius:10px; border:1px solid #ccc; box-sizing:border-box}}
-    label{{font-weight:600; display:block; margin-top:10px}}
-    textarea{{min-height:140px}}
-    .muted{{color:#666}}
-    .top{{display:flex; justify-content:space-between; align-items:center; gap:10px}}
-    .pill{{display:inline-block; padding:4px 10px; border-radius:999px; border:1px solid #ddd; font-size:12px; margin-right:6px; margin-top:6px}}
-    table{{width:100%; border-collapse:collapse}}
-    th,td{{text-align:left; padding:8px; border-bottom:1px solid #eee; vertical-align:top}}
-    code{{background:#f6f6f6; padding:2px 6px; border-radius:6px}}
-    .ticket{{border:1px solid #eee; border-radius:12px; padding:12px; margin:12px 0}}
-    .ticket h3{{margin:0 0 6px 0}}
-    .hr{{border-top:1px solid #eee; margin:10px 0}}
-.btn-attn{{font-weight:700; color:#8a0041; border-color:#8a0041; background:#ffe4f0}}
-  .prio-urg{{color:#b00000;font-weight:800;}}
-  .prio-med{{color:#d97706;font-weight:800;}}
-  .prio-dem{{color:#15803d;font-weight:800;}}
+    body{font-family: -apple-system, system-ui, Arial; margin: 24px; max-width: 980px}
+    .card{border:1px solid #ddd; border-radius:12px; padding:16px; margin:12px 0}
+    .row{display:flex; gap:12px; flex-wrap:wrap}
+    .btn{display:inline-block; padding:10px 14px; border-radius:10px; border:1px solid #333; text-decoration:none; color:#111; background:#fff}
+    .btn2{display:inline-block; padding:10px 14px; border-radius:10px; border:1px solid #999; text-decoration:none; color:#111; background:#fff}
+    .danger{border-color:#c00; color:#c00}
+    input, select, textarea{width:100%; padding:10px; border-radius:10px; border:1px solid #ccc; box-sizing:border-box}
+    label{font-weight:600; display:block; margin-top:10px}
+    textarea{min-height:140px}
+    .muted{color:#666}
+    .top{display:flex; justify-content:space-between; align-items:center; gap:10px}
+    .pill{display:inline-block; padding:4px 10px; border-radius:999px; border:1px solid #ddd; font-size:12px; margin-right:6px; margin-top:6px}
+    table{width:100%; border-collapse:collapse}
+    th,td{text-align:left; padding:8px; border-bottom:1px solid #eee; vertical-align:top}
+    code{background:#f6f6f6; padding:2px 6px; border-radius:6px}
+    .ticket{border:1px solid #eee; border-radius:12px; padding:12px; margin:12px 0}
+    .ticket h3{margin:0 0 6px 0}
+    .hr{border-top:1px solid #eee; margin:10px 0}
+.btn-attn{font-weight:700; color:#8a0041; border-color:#8a0041; background:#ffe4f0}
+  .prio-urg{color:#b00000;font-weight:800;}
+  .prio-med{color:#d97706;font-weight:800;}
+  .prio-dem{color:#15803d;font-weight:800;}
   </style>
 </head>
 <body>
-{body}
+"""
+_PAGE_POST = """
 </body></html>"""
+_PAGE_PRE_B = _PAGE_PRE.encode("utf-8")
+_PAGE_MID_B = _PAGE_MID.encode("utf-8")
+_PAGE_POST_B = _PAGE_POST.encode("utf-8")
+HTML_MEDIA_TYPE = "text/html; charset=utf-8"
+
+
+def page(title: str, body: str) -> str:
+    return _PAGE_PRE + h(title) + _PAGE_MID + body + _PAGE_POST
+
+
+@lru_cache(maxsize=128)
+def page_head_bytes(title: str) -> bytes:
+    """Layout hasta la apertura de <body>, ya en bytes.
+
+    Los títulos son literales fijos de cada handler, así que la cabecera de cada página se
+    escapa y codifica una sola vez por proceso.
+    """
+    return b"".join((_PAGE_PRE_B, h(title).encode("utf-8"), _PAGE_MID_B))
+
+
+def page_bytes(title: str, body: str) -> bytes:
+    return b"".join((page_head_bytes(title), body.encode("utf-8"), _PAGE_POST_B))
+
+
+def html_page(title: str, body: str, status_code: int = 200) -> Response:
+    """Página completa como Response con el cuerpo ya en bytes.
+
+    Devolver un Response evita que FastAPI pase el str por su serialización de respuesta.
+    """
+    return Response(content=page_bytes(title, body), media_type=HTML_MEDIA_TYPE, status_code=status_code)
+
+
+def static_page(title: str, body: str) -> Tuple[bytes, str]:
+    """Página fija renderizada una vez al importar: (bytes, ETag calculado del contenido)."""
+    page_b = page_bytes(title, body)
+    return page_b, '"' + hashlib.sha1(page_b).hexdigest()[:20] + '"'
+
+
+def page_response(request: Request, page: Tuple[bytes, str]) -> Response:
+    """Sirve una static_page: 304 si el navegador ya la tiene (If-None-Match), si no los bytes con su ETag."""
+    page_b, etag = page
+    return not_modified(request, etag) or with_etag(Response(content=page_b, media_type=HTML_MEDIA_TYPE), etag)
+
+
+# Páginas que sólo cambian por el nombre del usuario (menús): se renderizan una vez con esta marca
+# y en cada petición se sustituye en bytes por el nombre escapado.
+NOMBRE_MARK = "\x00NOMBRE\x00"
+_NOMBRE_MARK_B = NOMBRE_MARK.encode("utf-8")
+
+
+def named_page(page_b: bytes, nombre: str) -> Response:
+    return Response(content=page_b.replace(_NOMBRE_MARK_B, h(nombre or "").encode("utf-8")), media_type=HTML_MEDIA_TYPE)
 
 
 def user_from_session(request: Request):
-    return request.session.get("user")
+    # Memo por petición en request.state: require_login, require_roles, la dependencia y
+    # el handler lo piden varias veces en la misma petición.
+    st = request.state
+    try:
+        return st.user
+    except AttributeError:
+        u = st.user = request.session.get("user")
+        return u
+
+
+def request_now(request: Request) -> datetime:
+    """Hora de Madrid de la petición, leída una vez y memorizada en request.state: los valores por
+    defecto de mes/año y el "Generado:" de un informe salen del mismo instante."""
+    st = request.state
+    try:
+        return st.now
+    except AttributeError:
+        now = st.now = now_madrid()
+        return now
+
+
+def flash_redirect(request: Request, url: str, msg: str) -> RedirectResponse:
+    """Redirección 303 con un mensaje de un solo uso en la sesión (cookie firmada), fuera de la URL."""
+    request.session["flash"] = msg
+    return RedirectResponse(url, status_code=303)
+
+
+def pop_flash(request: Request) -> str:
+    return request.session.pop("flash", "") or ""
 
 
 def require_login(request: Request):
@@ -1083,9 +1499,6 @@ def require_roles(request: Request, allowed_roles: set[str]):
       - a RedirectResponse (to / or to role home) when unauthorized, OR
       - the user dict from session when authorized.
     """
-    resp = require_login(request)
-    if resp is not None:
-        return resp
     u = user_from_session(request)
     if not u:
         return RedirectResponse("/", status_code=303)
@@ -1098,6 +1511,93 @@ def require_roles(request: Request, allowed_roles: set[str]):
     return u
 
 
+def require_role(*roles: str):
+    """Versión dependencia FastAPI de require_roles: devuelve el usuario o corta con el mismo 303."""
+    allowed = set(roles)
+
+    def dep(request: Request) -> Dict[str, Any]:
+        u = require_roles(request, allowed)
+        if isinstance(u, RedirectResponse):
+            raise HTTPException(status_code=303, headers={"Location": u.headers["location"]})
+        return u
+    return dep
+
+
+require_worker = require_role("TRABAJADOR", "TECNICO")
+require_encargado = require_role("ENCARGADO")
+require_jefe = require_role("JEFE")
+# Inventario: lo usan encargados y técnicos; el ajuste rápido de stock también el jefe
+require_inv_user = require_role("ENCARGADO", "TECNICO")
+require_inv_ajuste = require_role("ENCARGADO", "TECNICO", "JEFE")
+
+
+# --- Contadores del menú de encargado (partes sin ver / urgentes sin ver) ---
+# Caché corta por proceso: el menú se recarga mucho y los números cambian a ritmo humano.
+# Los handlers que cambian estos números en este proceso la vacían con menu_counts_reset().
+MENU_COUNTS_TTL = 15  # segundos
+_menu_counts_cache = None  # (caduca_en, sin_ver, urgentes_sin_ver)
+
+
+def menu_counts() -> Tuple[int, int]:
+    global _menu_counts_cache
+    c = _menu_counts_cache
+    now = time.monotonic()
+    if c is None or c[0] <= now:
+        # Un solo viaje: sin ver + urgentes sin ver (índice parcial wom_tickets_sin_ver_idx)
+        row = db_one(
+            f'''
+            select count(*)::int as n,
+                   count(*) filter (where upper(coalesce(priority,'')) = 'URGENTE')::int as u
+            from public.wom_tickets
+            where {SQL_PARTE_ABIERTO}
+              and visto_por_encargado = false;
+        '''
+        ) or {}
+        c = _menu_counts_cache = (now + MENU_COUNTS_TTL, int(row.get("n") or 0), int(row.get("u") or 0))
+    return c[1], c[2]
+
+
+def menu_counts_reset() -> None:
+    global _menu_counts_cache
+    _menu_counts_cache = None
+
+
+# --- Caché HTTP (ETag) para listados que se recargan a menudo ---
+# no-cache: el navegador guarda la página pero revalida siempre con If-None-Match (un parte recién
+# creado aparece al momento; si no hay cambios la respuesta es un 304 sin cuerpo).
+LIST_CACHE_CONTROL = "private, no-cache"
+
+
+def etag_partes_en_proceso() -> str:
+    """ETag débil de los listados de partes en proceso: cambia con cualquier alta/edición/borrado.
+
+    Ambas subconsultas van por índice: max(updated_at) por wom_tickets_updated_at_idx y el conteo
+    por el parcial wom_tickets_activos_key_idx (mismo predicado SQL_PARTE_ABIERTO).
+    """
+    row = db_one(
+        f"""
+        select (select max(updated_at) from public.wom_tickets) as mx,
+               (select count(*) from public.wom_tickets where {SQL_PARTE_ABIERTO})::int as n;
+        """
+    ) or {}
+    raw = f"{row.get('mx')}-{row.get('n')}"
+    return 'W/"' + hashlib.blake2b(raw.encode("utf-8"), digest_size=8).hexdigest() + '"'
+
+
+def not_modified(request: Request, etag: str) -> Optional[Response]:
+    """304 si el navegador ya tiene esta versión (If-None-Match), o None."""
+    inm = request.headers.get("if-none-match") or ""
+    if etag in [t.strip() for t in inm.split(",")]:
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": LIST_CACHE_CONTROL})
+    return None
+
+
+def with_etag(resp: Response, etag: str) -> Response:
+    resp.headers["ETag"] = etag
+    resp.headers["Cache-Control"] = LIST_CACHE_CONTROL
+    return resp
+
+
 def role_home_path(role: str) -> str:
     role = (role or "").upper()
     if role == "ENCARGADO":
@@ -1109,6 +1609,40 @@ def role_home_path(role: str) -> str:
     return "/trabajador"
 
 
+@lru_cache(maxsize=1)
+def _tipos_options_html() -> str:
+    return "".join([f"<option value='{h(t)}'>{h(t)}</option>" for t in TIPOS])
+
+
+# Selector de prioridad del formulario de nuevo parte (MEDIO por defecto): siempre el mismo.
+_PRIO_OPTIONS_HTML = "\n".join([
+    f"<option value='{h(k)}'" + (" selected" if k == "MEDIO" else "") + f" style='color:{c};font-weight:800;'>{h(v)}</option>"
+    for k, v, c in PRIORIDADES
+])
+
+# <option> de meses 01..12, una variante por mes seleccionado (índice 0 = ninguno).
+_MONTH_OPTIONS = [
+    "".join([f"<option value='{m}' {'selected' if m == sel else ''}>{m:02d}</option>" for m in range(1, 13)])
+    for sel in range(0, 13)
+]
+
+
+def month_options_html(selected: Union[int, str, None]) -> str:
+    try:
+        i = int(selected)
+    except (TypeError, ValueError):
+        i = 0
+    return _MONTH_OPTIONS[i if 1 <= i <= 12 else 0]
+
+
+@lru_cache(maxsize=16)
+def _estados_options_html(selected: str) -> str:
+    return "".join([
+        f"<option value='{h(e)}' {'selected' if e==selected else ''}>{h(e)}</option>"
+        for e in ESTADOS_ENCARGADO
+    ])
+
+
 def salas_multiselect_html(salas: List[str], selected: Optional[List[str]], label: str) -> str:
     selected = selected or [ALL_MARKER]
     opts: List[str] = []
@@ -1154,7 +1688,7 @@ def render_ticket_blocks(
     """
     blocks: List[str] = []
     for p in rows:
-        fecha, hora = formatear_fecha_hora(p.get("created_at"))
+        fecha, hora = fecha_hora_de(p)
         ref = (p.get("referencia") or "").strip()
         visto = "Sí" if p.get("visto_por_encargado") else "No"
         estado = p.get("estado_encargado") or "SIN ESTADO"
@@ -1203,20 +1737,203 @@ def render_ticket_blocks(
     return body
 
 
-# =========================
-# FASTAPI APP
-# =========================
+_TICKET_ROW_TPL = (
+    '<tr><td><a href="/parte/{ref}">{ref}</a></td><td>{fecha} {hora}</td><td>{autor}</td>'
+    '<td>{sala}</td><td>{tipo}</td><td>{estado}</td>{visto}</tr>'
+)
+
+
+def _ticket_row(p: Dict[str, Any], con_visto: bool = True, _h=h, _fmt=fecha_hora_de, _prio=prio_span) -> str:
+    """Fila <tr> de los listados de partes: Ref/Fecha/Autor/Sala/Tipo/Estado (+Visto)."""
+    f, hh = _fmt(p)
+    return _TICKET_ROW_TPL.format(
+        ref=_h((p.get("referencia") or "").strip()),
+        fecha=_h(f),
+        hora=_h(hh),
+        autor=_h(p.get("created_by_name", "")),
+        sala=_h(p.get("room_name", "")),
+        tipo=_h(p.get("tipo", "")),
+        estado=_prio(p.get("priority"), p.get("estado_encargado", "SIN ESTADO")),
+        visto=("<td>Sí</td>" if p.get("visto_por_encargado") else "<td>No</td>") if con_visto else "",
+    )
+
+
+# Columnas de SQL_TICKET_FILA en el orden que desempaqueta _ticket_row_nt; los coalesce
+# evitan los .get(..., "") por fila. created_at/id van al final para el cursor de página.
+SQL_TICKET_FILA = (
+    f"referencia, {SQL_FECHA_HORA}, coalesce(created_by_name,'') as created_by_name, "
+    "coalesce(room_name,'') as room_name, coalesce(tipo,'') as tipo, priority, "
+    "coalesce(estado_encargado,'SIN ESTADO') as estado_encargado, visto_por_encargado, created_at, id"
+)
+
+
+def _ticket_row_nt(t: Any, _h=h, _prio=prio_span) -> str:
+    """Como _ticket_row, para filas NamedTupleCursor de SQL_TICKET_FILA."""
+    ref, fecha, hora, autor, sala, tipo, prio, estado, visto, _ca, _id = t
+    return _TICKET_ROW_TPL.format(
+        ref=_h(ref.strip()),
+        fecha=_h(fecha),
+        hora=_h(hora),
+        autor=_h(autor),
+        sala=_h(sala),
+        tipo=_h(tipo),
+        estado=_prio(prio, estado),
+        visto="<td>Sí</td>" if visto else "<td>No</td>",
+    )
+
+
+_DELETE_ROW_TPL = (
+    '<tr><td>{ref}</td><td>{fecha} {hora}</td><td>{autor}</td><td>{sala}</td><td>{estado}</td>'
+    '<td><a class="btn danger" href="/encargado/eliminar_partes/confirmar/{ref}">Eliminar</a></td></tr>'
+)
+
+
+def _delete_row(p: Dict[str, Any], _h=h, _fmt=fecha_hora_de, _prio=prio_span) -> str:
+    """Fila <tr> del listado de eliminar partes: Ref/Fecha/Autor/Sala/Estado + botón Eliminar."""
+    f, hh = _fmt(p)
+    return _DELETE_ROW_TPL.format(
+        ref=_h((p.get("referencia") or "").strip()),
+        fecha=_h(f),
+        hora=_h(hh),
+        autor=_h(p.get("created_by_name", "")),
+        sala=_h(p.get("room_name", "")),
+        estado=_prio(p.get("priority"), p.get("estado_encargado", "SIN ESTADO")),
+    )
+
+
+# --- Paginación keyset de listados de partes (por created_at desc, id desc) ---
+# El cursor lleva "fecha_iso|id": con sólo la fecha, dos partes con el mismo created_at en el borde
+# de página se saltarían.
+PAGE_SIZE = 50
+SQL_KEYSET = "(%s::timestamptz is null or (created_at, id) < (%s, %s))"
+
+
+def parse_cursor(cursor: Optional[str]) -> Tuple[Optional[datetime], Optional[int]]:
+    ts, _, tid = (cursor or "").strip().partition("|")
+    try:
+        return (datetime.fromisoformat(ts), int(tid)) if ts and tid else (None, None)
+    except ValueError:
+        return None, None
+
+
+def keyset_params(cursor: Tuple[Optional[datetime], Optional[int]]) -> Tuple[Any, Any, Any]:
+    """Parámetros para SQL_KEYSET."""
+    return cursor[0], cursor[0], cursor[1]
+
+
+def cursor_of(row: Any) -> str:
+    if isinstance(row, dict):
+        return f"{row['created_at'].isoformat()}|{row['id']}"
+    return f"{row.created_at.isoformat()}|{row.id}"
+
+
+def split_page(rows: List[Any]) -> Tuple[List[Any], Optional[str]]:
+    """Recibe hasta PAGE_SIZE+1 filas; devuelve (filas de la página, cursor de la siguiente o None)."""
+    if len(rows) > PAGE_SIZE:
+        rows = rows[:PAGE_SIZE]
+        return rows, cursor_of(rows[-1])
+    return rows, None
+
+
+def more_link(path: str, params: Dict[str, Any], cursor: Optional[str]) -> str:
+    if not cursor:
+        return ""
+    qs = urllib.parse.urlencode({**params, "cursor": cursor})
+    return f"<p style='margin-top:10px'><a class='btn2' href='{h(path)}?{h(qs)}'>Más</a></p>"
+
+
+class BodySizeLimitMiddleware:
+    """Corta con 413 las peticiones cuyo cuerpo supera el límite de su ruta, antes de que se parsee el formulario.
+
+    FastAPI lee y guarda el multipart entero antes de llamar al handler, así que el límite tiene que ir aquí:
+    se mira Content-Length y, si no viene (chunked), se cuentan los bytes según llegan.
+    """
+
+    def __init__(self, app, limits: Dict[str, int]):
+        self.app = app
+        self.limits = limits
+
+    async def __call__(self, scope, receive, send):
+        limit = self.limits.get(scope.get("path", "")) if scope["type"] == "http" and scope.get("method") == "POST" else None
+        if limit is None:
+            await self.app(scope, receive, send)
+            return
+
+        cl = dict(scope.get("headers") or []).get(b"content-length")
+        try:
+            too_big = cl is not None and int(cl) > limit
+        except ValueError:
+            too_big = False
+        if too_big:
+            await self._reject(send)
+            return
+
+        received = 0
+        overflow = False
+        rejected = False
+
+        async def limited_receive():
+            nonlocal received, overflow
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    # Para el parser como si el cliente se hubiera ido: no se guarda ni un byte más.
+                    overflow = True
+                    return {"type": "http.disconnect"}
+            return message
+
+        async def guarded_send(message):
+            # Tras el corte, FastAPI respondería un 400 de "error parsing the body": se sustituye
+            # por la misma página 413 que con Content-Length.
+            nonlocal rejected
+            if not overflow:
+                await send(message)
+            elif not rejected and message["type"] == "http.response.start":
+                rejected = True
+                await self._reject(send)
+
+        await self.app(scope, limited_receive, guarded_send)
+
+    @staticmethod
+    async def _reject(send):
+        body = page_bytes(
+            "Error",
+            "<div class='card'><h3>La petición es demasiado grande</h3>"
+            "<p class='muted'>Máximo 3 imágenes de 8MB por parte.</p>"
+            "<p><a class='btn2' href='/trabajador/nuevo'>Volver</a></p></div>",
+        )
+        await send({
+            "type": "http.response.start",
+            "status": 413,
+            "headers": [(b"content-type", HTML_MEDIA_TYPE.encode("latin-1")), (b"content-length", str(len(body)).encode("latin-1"))],
+        })
+        await send({"type": "http.response.body", "body": body})
+
+
+# =========================
+# FASTAPI APP
+# =========================
 app = FastAPI()
 app.add_middleware(
     SessionMiddleware,
     secret_key=os.getenv("SESSION_SECRET", "wom_local_secret_key_cambia_esto"),
 )
+app.add_middleware(BodySizeLimitMiddleware, limits={"/trabajador/nuevo": MAX_NEW_TICKET_BODY})
+# Los listados (tablas de partes, movimientos, consultas de inventario) son HTML muy repetitivo:
+# se comprimen si el cliente acepta gzip y pasan de 1 KB. Va la última para envolver a las demás.
+app.add_middleware(GZipMiddleware, minimum_size=1024)
 
 
 @app.on_event("startup")
 def _startup():
+    # Los handlers "def" (casi todos) corren en el threadpool de anyio mientras esperan a Postgres;
+    # su tamaño es el número de peticiones con BD en vuelo a la vez.
+    anyio_to_thread.current_default_thread_limiter().total_tokens = WEB_THREADPOOL_SIZE
     ensure_schema_and_seed()
     ensure_inventory_schema()
+    if DATABASE_DIRECT_URL:
+        threading.Thread(target=_salas_listen_loop, name="salas-listen", daemon=True).start()
 
 
 @app.get("/health")
@@ -1253,7 +1970,7 @@ def login_page(request: Request):
       </p>
     </div>
     '''
-    return page("Login", body)
+    return html_page("Login", body)
 
 
 
@@ -1261,20 +1978,18 @@ def login_page(request: Request):
 def do_login(request: Request, codigo: str = Form(...)):
     info = get_user_by_code(codigo)
     if not info:
-        return HTMLResponse(
-            page(
-                "Login",
-                """
+        return html_page(
+            "Login",
+            """
           <div class='card'>
             <h3>Código no reconocido</h3>
             <p><a class='btn2' href='/'>Volver</a></p>
           </div>
         """,
-            ),
             status_code=400,
         )
 
-    request.session["user"] = info
+    request.session["user"] = request.state.user = info
     return RedirectResponse("/home", status_code=303)
 
 
@@ -1296,20 +2011,13 @@ def logout(request: Request):
 # =========================
 # TRABAJADOR (menú + flujos)
 # =========================
-@app.get("/trabajador", response_class=HTMLResponse)
-def worker_menu(request: Request):
-    r = require_login(request)
-    if r:
-        return r
-    u = user_from_session(request)
-    if u["rol"] not in ("TRABAJADOR","TECNICO"):
-        return RedirectResponse(role_home_path(u["rol"]), status_code=303)
-
-    body = f"""
+_WORKER_MENU_BYTES = page_bytes(
+    "Trabajador",
+    f"""
     <div class="top">
       <div>
         <h2>PARTES DE MANTENIMIENTO DE WOM</h2>
-        <p>Hola <b>{h(u["nombre"])}</b>! Comencemos a dar un parte...</p>
+        <p>Hola <b>{NOMBRE_MARK}</b>! Comencemos a dar un parte...</p>
       </div>
       <div><a class="btn2" href="/logout">Salir</a></div>
     </div>
@@ -1321,23 +2029,22 @@ def worker_menu(request: Request):
         <a class="btn" href="/trabajador/finalizados">Ver partes finalizados</a>
       </div>
     </div>
-    """
-    return page("Trabajador", body)
-    
-@app.get("/tecnico", response_class=HTMLResponse)
-def tecnico_menu(request: Request):
-    r = require_login(request)
-    if r:
-        return r
-    u = user_from_session(request)
-    if u["rol"] != "TECNICO":
-        return RedirectResponse(role_home_path(u["rol"]), status_code=303)
+    """,
+)
 
-    body = f"""
+
+@app.get("/trabajador", response_class=HTMLResponse)
+def worker_menu(u: Dict[str, Any] = Depends(require_worker)):
+    return named_page(_WORKER_MENU_BYTES, u["nombre"])
+
+
+_TECNICO_MENU_BYTES = page_bytes(
+    "Técnico",
+    f"""
     <div class="top">
       <div>
         <h2>PARTES DE MANTENIMIENTO DE WOM</h2>
-        <p>Hola <b>{h(u["nombre"])}</b>! (Técnico)</p>
+        <p>Hola <b>{NOMBRE_MARK}</b>! (Técnico)</p>
       </div>
       <div><a class="btn2" href="/logout">Salir</a></div>
     </div>
@@ -1350,24 +2057,28 @@ def tecnico_menu(request: Request):
         <a class="btn" href="/encargado/inventario">Inventario de Almacén</a>
       </div>
     </div>
-    """
-    return page("Técnico", body)
-
+    """,
+)
 
 
-@app.get("/trabajador/nuevo", response_class=HTMLResponse)
-def worker_new_form(request: Request):
+@app.get("/tecnico", response_class=HTMLResponse)
+def tecnico_menu(request: Request):
     r = require_login(request)
     if r:
         return r
     u = user_from_session(request)
-    if u["rol"] not in ("TRABAJADOR","TECNICO"):
+    if u["rol"] != "TECNICO":
         return RedirectResponse(role_home_path(u["rol"]), status_code=303)
 
+    return named_page(_TECNICO_MENU_BYTES, u["nombre"])
+
+
+
+@app.get("/trabajador/nuevo", response_class=HTMLResponse)
+def worker_new_form(u: Dict[str, Any] = Depends(require_worker)):
     ref = generar_referencia()
-    salas = get_salas()
-    salas_opts = "".join([f"<option value='{h(s)}'>{h(s)}</option>" for s in salas])
-    tipos_opts = "".join([f"<option value='{h(t)}'>{h(t)}</option>" for t in TIPOS])
+    salas_opts = salas_options_html()
+    tipos_opts = _tipos_options_html()
 
     body = f"""
     <div class="top">
@@ -1388,9 +2099,7 @@ def worker_new_form(request: Request):
         
         <label>Nivel de prioridad</label>
         <select name="priority" required>
-          <option value="URGENTE" style="color:#b00000;font-weight:800;">Urgente</option>
-          <option value="MEDIO" selected style="color:#d97706;font-weight:800;">Medio</option>
-          <option value="DEMORABLE" style="color:#15803d;font-weight:800;">Demorable</option>
+          {_PRIO_OPTIONS_HTML}
         </select>
 
 <label>Descripción</label>
@@ -1433,12 +2142,11 @@ def worker_new_form(request: Request):
       toggleReparacion();
     </script>
     """
-    return page("Nuevo parte", body)
+    return html_page("Nuevo parte", body)
 
 
 @app.post("/trabajador/nuevo")
-def worker_new_submit(
-    request: Request,
+async def worker_new_submit(
     referencia: str = Form(...),
     sala: str = Form(...),
     tipo: str = Form(...),
@@ -1447,15 +2155,9 @@ def worker_new_submit(
     solucionado: str = Form("NO"),
     reparacion_usuario: str = Form(""),
     imagenes: List[UploadFile] = File([]),
+    u: Dict[str, Any] = Depends(require_worker),
 ):
-    r = require_login(request)
-    if r:
-        return r
-    u = user_from_session(request)
-    if u["rol"] not in ("TRABAJADOR","TECNICO"):
-        return RedirectResponse(role_home_path(u["rol"]), status_code=303)
-
-    ref = (referencia or "").strip().upper()
+    ref = norm_ref(referencia)
     sala_name = (sala or "").strip()
     tipo_name = (tipo or "").strip()
     prio = (priority or "MEDIO").strip().upper()
@@ -1466,9 +2168,6 @@ def worker_new_submit(
     sol = (solucionado or "").strip().upper() == "SI"
     rep = (reparacion_usuario or "").strip() if sol else ""
 
-    image_url = None
-    image_path = None
-
     # --- Manejo de hasta 3 imágenes (se comprimen a ~100KB y se convierten a WEBP) ---
     files: List[UploadFile] = []
     if imagenes:
@@ -1477,130 +2176,130 @@ def worker_new_submit(
                 files.append(f)
 
     if len(files) > 3:
-        return HTMLResponse(
-            page("Error", "<div class='card'><h3>Máximo 3 imágenes por parte</h3><p><a class='btn2' href='/trabajador/nuevo'>Volver</a></p></div>"),
+        return html_page(
+            "Error",
+            "<div class='card'><h3>Máximo 3 imágenes por parte</h3><p><a class='btn2' href='/trabajador/nuevo'>Volver</a></p></div>",
             status_code=400,
         )
 
-    # Inserta primero el ticket para obtener ticket_id
-    room = db_one("select id, name from public.wom_rooms where name=%s;", (sala_name,))
+    # Valida las imágenes antes de crear el parte: (posición, fichero).
+    # Starlette ya deja cada subida en un SpooledTemporaryFile; medimos su tamaño con seek/tell
+    # y se lo pasamos a Pillow tal cual, sin volcarlo entero a un bytes intermedio.
+    raws: List[Tuple[int, BinaryIO]] = []
+    for pos, f in enumerate(files, start=1):
+        raw = f.file
+        raw.seek(0, os.SEEK_END)
+        size = raw.tell()
+        raw.seek(0)
+        if not size:
+            continue
+
+        # Límite de entrada (para no reventar memoria/tiempo)
+        if size > MAX_IMG_INPUT_BYTES:
+            return html_page(
+                "Error",
+                "<div class='card'><h3>Una de las imágenes supera 8MB</h3><p><a class='btn2' href='/trabajador/nuevo'>Volver</a></p></div>",
+                status_code=400,
+            )
+        raws.append((pos, raw))
+
+    # Pillow es CPU y libera el GIL al codificar: comprimimos las imágenes en paralelo
+    # en hilos para no bloquear el event loop.
+    compressed_list: List[bytes] = []
+    if raws:
+        try:
+            compressed_list = await asyncio.gather(
+                *[asyncio.to_thread(compress_image_to_target, raw, MAX_IMG_BYTES) for _pos, raw in raws]
+            )
+        except Exception as ex:
+            return html_page(
+                "Error",
+                f"<div class='card'><h3>Error procesando la imagen</h3><p class='muted'>{h(str(ex))}</p><p><a class='btn2' href='/trabajador/nuevo'>Volver</a></p></div>",
+                status_code=500,
+            )
+
+    # Inserta primero el ticket para obtener ticket_id.
+    # El "do update" no cambia nada pero hace que RETURNING devuelva el id también si la referencia ya existía.
+    room = await asyncio.to_thread(db_one, "select id, name from public.wom_rooms where name=%s;", (sala_name,))
     room_id = room["id"] if room else None
 
-    db_exec(
+    ticket_row = await asyncio.to_thread(
+        db_one,
         """
         insert into public.wom_tickets
         (referencia, created_by_code, created_by_name, room_id, room_name, tipo, priority, descripcion,
          solucionado_por_usuario, reparacion_usuario, image_url, image_path, visto_por_encargado, estado_encargado, observaciones_encargado)
         values
         (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, false, 'SIN ESTADO', '')
-        on conflict (referencia) do nothing;
+        on conflict (referencia) do update set referencia=public.wom_tickets.referencia
+        returning id;
         """,
         (ref, u["codigo"], u["nombre"], room_id, sala_name, tipo_name, prio, desc, sol, rep, None, None),
     )
-
-    ticket_row = db_one("select id from public.wom_tickets where referencia=%s;", (ref,))
     ticket_id = ticket_row["id"] if ticket_row else None
+    menu_counts_reset()
 
-    if files and not ticket_id:
-        return HTMLResponse(
-            page("Error", "<div class='card'><h3>No se pudo obtener el ID del parte para guardar imágenes</h3><p><a class='btn2' href='/trabajador/nuevo'>Volver</a></p></div>"),
+    if raws and not ticket_id:
+        return html_page(
+            "Error",
+            "<div class='card'><h3>No se pudo obtener el ID del parte para guardar imágenes</h3><p><a class='btn2' href='/trabajador/nuevo'>Volver</a></p></div>",
             status_code=500,
         )
 
-    if files:
+    if raws:
         bucket = os.getenv("SUPABASE_STORAGE_BUCKET", "partes")
         ts = now_madrid().strftime("%Y%m%d_%H%M%S")
-        for pos, f in enumerate(files, start=1):
-            raw = f.file.read()
-            if not raw:
-                continue
-
-            # Límite de entrada (para no reventar memoria/tiempo)
-            if len(raw) > 8 * 1024 * 1024:
-                return HTMLResponse(
-                    page("Error", "<div class='card'><h3>Una de las imágenes supera 8MB</h3><p><a class='btn2' href='/trabajador/nuevo'>Volver</a></p></div>"),
-                    status_code=400,
-                )
-
-            try:
-                compressed = compress_image_to_target(raw, MAX_IMG_BYTES)
-            except Exception as ex:
-                return HTMLResponse(
-                    page("Error", f"<div class='card'><h3>Error procesando la imagen</h3><p class='muted'>{h(str(ex))}</p><p><a class='btn2' href='/trabajador/nuevo'>Volver</a></p></div>"),
-                    status_code=500,
-                )
-
-            token = "".join(random.choice(string.ascii_lowercase + string.digits) for _ in range(6))
-            image_path_i = f"tickets/{ref}_{ts}_{token}_{pos}.webp"
-            try:
-                image_url_i = supabase_storage_upload(bucket, image_path_i, compressed, "image/webp")
-            except Exception as ex:
-                return HTMLResponse(
-                    page("Error", f"<div class='card'><h3>Error subiendo la imagen</h3><p class='muted'>{h(str(ex))}</p><p><a class='btn2' href='/trabajador/nuevo'>Volver</a></p></div>"),
-                    status_code=500,
-                )
-
-            # Inserta en tabla de imágenes
-            try:
-                db_exec(
-                    """
-                    insert into public.wom_ticket_images (ticket_id, position, image_url, image_path)
-                    values (%s, %s, %s, %s)
-                    on conflict (ticket_id, position) do update set image_url=excluded.image_url, image_path=excluded.image_path;
-                    """,
-                    (ticket_id, pos, image_url_i, image_path_i),
-                )
-            except Exception:
-                pass
+        paths: List[str] = []
+        for pos, _raw in raws:
+            token = secrets.token_urlsafe(_TOKEN_LEN)[:6].lower()
+            paths.append(f"tickets/{ref}_{ts}_{token}_{pos}.webp")
 
-            if pos == 1:
-                image_url = image_url_i
-                image_path = image_path_i
-
-        # Guarda la primera imagen también en wom_tickets (compatibilidad)
-        if image_url:
-            db_exec(
-                "update public.wom_tickets set image_url=%s, image_path=%s where id=%s;",
-                (image_url, image_path, ticket_id),
+        # Subidas concurrentes a Storage (una petición HTTPS por imagen)
+        try:
+            urls = await asyncio.gather(
+                *[
+                    asyncio.to_thread(supabase_storage_upload, bucket, path_i, data, "image/webp")
+                    for path_i, data in zip(paths, compressed_list)
+                ]
+            )
+        except Exception as ex:
+            return html_page(
+                "Error",
+                f"<div class='card'><h3>Error subiendo la imagen</h3><p class='muted'>{h(str(ex))}</p><p><a class='btn2' href='/trabajador/nuevo'>Volver</a></p></div>",
+                status_code=500,
             )
 
+        image_rows = [(pos, image_url_i, image_path_i) for (pos, _raw), image_url_i, image_path_i in zip(raws, urls, paths)]
+        try:
+            await asyncio.to_thread(save_ticket_images, ticket_id, image_rows)
+        except Exception as ex:
+            print(f"[worker_new_submit] error guardando imágenes ref={ref} err={ex}")
+
     return RedirectResponse(f"/parte/{ref}", status_code=303)
 
 
 @app.get("/trabajador/activos", response_class=HTMLResponse)
-def worker_activos(request: Request):
-    r = require_login(request)
-    if r:
-        return r
-    u = user_from_session(request)
-    if u["rol"] not in ("TRABAJADOR","TECNICO"):
-        return RedirectResponse(role_home_path(u["rol"]), status_code=303)
+def worker_activos(request: Request, u: Dict[str, Any] = Depends(require_worker)):
+    etag = etag_partes_en_proceso()
+    r304 = not_modified(request, etag)
+    if r304:
+        return r304
 
+    cursor = parse_cursor(request.query_params.get("cursor"))
     rows = db_all(
-        """
-        select referencia, created_at, created_by_name, room_name, tipo, priority, estado_encargado, visto_por_encargado
+        f"""
+        select id, referencia, created_at, {SQL_FECHA_HORA}, created_by_name, room_name, tipo, priority, estado_encargado, visto_por_encargado
         from public.wom_tickets
-        where (estado_encargado is null or estado_encargado not in ('TRABAJO TERMINADO/REPARADO','TRABAJO DESESTIMADO'))
-        order by created_at desc;
-    """
+        where {SQL_PARTE_ABIERTO}
+          and {SQL_KEYSET}
+        order by created_at desc, id desc
+        limit %s;
+    """,
+        (*keyset_params(cursor), PAGE_SIZE + 1),
     )
+    rows, next_cursor = split_page(rows)
 
-    trs = ""
-    for p in rows:
-        f, hh = formatear_fecha_hora(p.get("created_at"))
-        visto = "Sí" if p.get("visto_por_encargado") else "No"
-        ref = (p.get("referencia") or "").strip()
-        trs += f"""
-        <tr>
-          <td><a href="/parte/{h(ref)}">{h(ref)}</a></td>
-          <td>{h(f)} {h(hh)}</td>
-          <td>{h(p.get("created_by_name",""))}</td>
-          <td>{h(p.get("room_name",""))}</td>
-          <td>{h(p.get("tipo",""))}</td>
-          <td>{prio_span(p.get("priority"), p.get("estado_encargado","SIN ESTADO"))}</td>
-          <td>{h(visto)}</td>
-        </tr>
-        """
+    trs = "".join(map(_ticket_row, rows))
 
     body = f"""
     <div class="top">
@@ -1612,20 +2311,14 @@ def worker_activos(request: Request):
         <thead><tr><th>Ref</th><th>Fecha</th><th>Autor</th><th>Sala</th><th>Tipo</th><th>Estado</th><th>Visto</th></tr></thead>
         <tbody>{trs or "<tr><td colspan='7'>No hay partes.</td></tr>"}</tbody>
       </table>
+      {more_link("/trabajador/activos", {}, next_cursor)}
     </div>
     """
-    return page("En proceso", body)
+    return with_etag(html_page("En proceso", body), etag)
 
 
 @app.get("/trabajador/finalizados", response_class=HTMLResponse)
-def worker_finalizados(request: Request):
-    r = require_login(request)
-    if r:
-        return r
-    u = user_from_session(request)
-    if u["rol"] not in ("TRABAJADOR","TECNICO"):
-        return RedirectResponse(role_home_path(u["rol"]), status_code=303)
-
+def worker_finalizados(u: Dict[str, Any] = Depends(require_worker)):
     now = now_madrid()
     body = f'''
     <div class="top">
@@ -1638,7 +2331,7 @@ def worker_finalizados(request: Request):
       <form method="post" action="/trabajador/finalizados">
         <label>Mes</label>
         <select name="mes">
-          {''.join([f"<option value='{m}' {'selected' if m==now.month else ''}>{m:02d}</option>" for m in range(1,13)])}
+          {_MONTH_OPTIONS[now.month]}
         </select>
         <label>Año</label>
         <input name="anio" type="number" value="{now.year}" min="2020" max="2100" required/>
@@ -1648,18 +2341,14 @@ def worker_finalizados(request: Request):
       </form>
     </div>
     '''
-    return page("Finalizados", body)
+    return html_page("Finalizados", body)
 
 
 @app.post("/trabajador/finalizados", response_class=HTMLResponse)
-def worker_finalizados_post(request: Request, mes: int = Form(...), anio: int = Form(...)):
-    r = require_login(request)
-    if r:
-        return r
-    u = user_from_session(request)
-    if u["rol"] not in ("TRABAJADOR","TECNICO"):
-        return RedirectResponse(role_home_path(u["rol"]), status_code=303)
-
+def worker_finalizados_post(
+    mes: int = Form(...), anio: int = Form(...), cursor: str = Form(""),
+    u: Dict[str, Any] = Depends(require_worker),
+):
     mval = int(mes)
     yval = int(anio)
     if mval < 1 or mval > 12:
@@ -1668,37 +2357,34 @@ def worker_finalizados_post(request: Request, mes: int = Form(...), anio: int =
         yval = now_madrid().year
 
     start, end = month_bounds(yval, mval)
+    cur_key = parse_cursor(cursor)
 
     rows = db_all(
-        '''
-        select referencia, created_at, created_by_name, room_name, tipo, priority, estado_encargado, visto_por_encargado
+        f'''
+        select id, referencia, created_at, {SQL_FECHA_HORA}, created_by_name, room_name, tipo, priority, estado_encargado, visto_por_encargado
         from public.wom_tickets
-        where estado_encargado in ('TRABAJO TERMINADO/REPARADO','TRABAJO DESESTIMADO')
+        where {SQL_PARTE_FINALIZADO}
           and created_at >= %s and created_at < %s
-        order by created_at desc;
+          and {SQL_KEYSET}
+        order by created_at desc, id desc
+        limit %s;
     ''',
-        (start, end),
+        (start, end, *keyset_params(cur_key), PAGE_SIZE + 1),
     )
-
-    trs = ""
-    for p in rows:
-        f, hh = formatear_fecha_hora(p.get("created_at"))
-        visto = "Sí" if p.get("visto_por_encargado") else "No"
-        ref = (p.get("referencia") or "").strip()
-        estado = p.get("estado_encargado", "SIN ESTADO")
-        prio = p.get("priority", "MEDIO")
-        trs += f'''
-        <tr>
-          <td><a href="/parte/{h(ref)}">{h(ref)}</a></td>
-          <td>{h(f)} {h(hh)}</td>
-          <td>{h(p.get("created_by_name",""))}</td>
-          <td>{h(p.get("room_name",""))}</td>
-          <td>{h(p.get("tipo",""))}</td>
-          <td>{prio_span(prio, estado)}</td>
-          <td>{h(visto)}</td>
-        </tr>
+    rows, next_cursor = split_page(rows)
+    more_html = ""
+    if next_cursor:
+        more_html = f'''
+      <form method="post" action="/trabajador/finalizados" style="margin-top:10px">
+        <input type="hidden" name="mes" value="{mval}"/>
+        <input type="hidden" name="anio" value="{yval}"/>
+        <input type="hidden" name="cursor" value="{h(next_cursor)}"/>
+        <button class="btn2" type="submit">Más</button>
+      </form>
         '''
 
+    trs = "".join(map(_ticket_row, rows))
+
     body = f'''
     <div class="top">
       <div><h2>Partes finalizados</h2><p class="muted">Filtrado: {mval:02d}/{yval}</p></div>
@@ -1709,29 +2395,23 @@ def worker_finalizados_post(request: Request, mes: int = Form(...), anio: int =
         <thead><tr><th>Ref</th><th>Fecha</th><th>Autor</th><th>Sala</th><th>Tipo</th><th>Estado</th><th>Visto</th></tr></thead>
         <tbody>{trs or "<tr><td colspan='7'>No hay partes.</td></tr>"}</tbody>
       </table>
+      {more_html}
     </div>
     '''
-    return page("Finalizados", body)
+    return html_page("Finalizados", body)
 
 
 
 # =========================
 # JEFE
 # =========================
-@app.get("/jefe", response_class=HTMLResponse)
-def jefe_menu(request: Request):
-    r = require_login(request)
-    if r:
-        return r
-    u = user_from_session(request)
-    if u["rol"] != "JEFE":
-        return RedirectResponse(role_home_path(u["rol"]), status_code=303)
-
-    body = f"""
+_JEFE_MENU_BYTES = page_bytes(
+    "Jefe",
+    f"""
     <div class="top">
       <div>
         <h2>VISTA DE JEFATURA - PARTES WOM</h2>
-        <p>Bienvenido <b>{h(u["nombre"])}</b>.</p>
+        <p>Bienvenido <b>{NOMBRE_MARK}</b>.</p>
       </div>
       <div><a class="btn2" href="/logout">Salir</a></div>
     </div>
@@ -1744,8 +2424,20 @@ def jefe_menu(request: Request):
         <a class="btn" href="/jefe/inventario/consulta">Consultar Inventario</a>
       </div>
     </div>
-    """
-    return page("Jefe", body)
+    """,
+)
+
+
+@app.get("/jefe", response_class=HTMLResponse)
+def jefe_menu(request: Request):
+    r = require_login(request)
+    if r:
+        return r
+    u = user_from_session(request)
+    if u["rol"] != "JEFE":
+        return RedirectResponse(role_home_path(u["rol"]), status_code=303)
+
+    return named_page(_JEFE_MENU_BYTES, u["nombre"])
 
 
 @app.get("/jefe/en_proceso", response_class=HTMLResponse)
@@ -1757,31 +2449,26 @@ def jefe_en_proceso(request: Request):
     if u["rol"] != "JEFE":
         return RedirectResponse(role_home_path(u["rol"]), status_code=303)
 
+    etag = etag_partes_en_proceso()
+    r304 = not_modified(request, etag)
+    if r304:
+        return r304
+
+    cursor = parse_cursor(request.query_params.get("cursor"))
     rows = db_all(
-        """
-        select referencia, created_at, created_by_name, room_name, tipo, priority, estado_encargado, visto_por_encargado
+        f"""
+        select id, referencia, created_at, {SQL_FECHA_HORA}, created_by_name, room_name, tipo, priority, estado_encargado, visto_por_encargado
         from public.wom_tickets
-        where (estado_encargado is null or estado_encargado not in ('TRABAJO TERMINADO/REPARADO','TRABAJO DESESTIMADO'))
-        order by created_at desc;
-    """
+        where {SQL_PARTE_ABIERTO}
+          and {SQL_KEYSET}
+        order by created_at desc, id desc
+        limit %s;
+    """,
+        (*keyset_params(cursor), PAGE_SIZE + 1),
     )
+    rows, next_cursor = split_page(rows)
 
-    trs = ""
-    for p in rows:
-        f, hh = formatear_fecha_hora(p.get("created_at"))
-        visto = "Sí" if p.get("visto_por_encargado") else "No"
-        ref = (p.get("referencia") or "").strip()
-        trs += f"""
-        <tr>
-          <td><a href="/parte/{h(ref)}">{h(ref)}</a></td>
-          <td>{h(f)} {h(hh)}</td>
-          <td>{h(p.get("created_by_name",""))}</td>
-          <td>{h(p.get("room_name",""))}</td>
-          <td>{h(p.get("tipo",""))}</td>
-          <td>{prio_span(p.get("priority"), p.get("estado_encargado","SIN ESTADO"))}</td>
-          <td>{h(visto)}</td>
-        </tr>
-        """
+    trs = "".join(map(_ticket_row, rows))
 
     body = f"""
     <div class="top">
@@ -1793,9 +2480,10 @@ def jefe_en_proceso(request: Request):
         <thead><tr><th>Ref</th><th>Fecha</th><th>Autor</th><th>Sala</th><th>Tipo</th><th>Estado</th><th>Visto</th></tr></thead>
         <tbody>{trs or "<tr><td colspan='7'>No hay partes.</td></tr>"}</tbody>
       </table>
+      {more_link("/jefe/en_proceso", {}, next_cursor)}
     </div>
     """
-    return page("Jefe - En activo", body)
+    return with_etag(html_page("Jefe - En activo", body), etag)
 
 
 @app.get("/jefe/finalizados", response_class=HTMLResponse)
@@ -1811,38 +2499,30 @@ def jefe_finalizados(request: Request):
     mes = (request.query_params.get("mes") or str(now.month)).strip()
     anio = (request.query_params.get("anio") or str(now.year)).strip()
 
+    cursor = parse_cursor(request.query_params.get("cursor"))
+    next_cursor = None
     rows = []
     error = ""
     try:
         mes_i = int(mes); anio_i = int(anio)
         ts_start, ts_end = month_bounds(anio_i, mes_i)
         rows = db_all(
-            """
-            select referencia, created_at, created_by_name, room_name, tipo, priority, estado_encargado
+            f"""
+            select id, referencia, created_at, {SQL_FECHA_HORA}, created_by_name, room_name, tipo, priority, estado_encargado
             from public.wom_tickets
-            where estado_encargado in ('TRABAJO TERMINADO/REPARADO','TRABAJO DESESTIMADO')
+            where {SQL_PARTE_FINALIZADO}
               and created_at >= %s and created_at < %s
-            order by created_at desc;
+              and {SQL_KEYSET}
+            order by created_at desc, id desc
+            limit %s;
             """,
-            (ts_start, ts_end),
+            (ts_start, ts_end, *keyset_params(cursor), PAGE_SIZE + 1),
         )
+        rows, next_cursor = split_page(rows)
     except Exception as e:
         error = str(e)
 
-    trs = ""
-    for p in rows:
-        f, hh = formatear_fecha_hora(p.get("created_at"))
-        ref = (p.get("referencia") or "").strip()
-        trs += f"""
-        <tr>
-          <td><a href="/parte/{h(ref)}">{h(ref)}</a></td>
-          <td>{h(f)} {h(hh)}</td>
-          <td>{h(p.get("created_by_name",""))}</td>
-          <td>{h(p.get("room_name",""))}</td>
-          <td>{h(p.get("tipo",""))}</td>
-          <td>{prio_span(p.get("priority"), p.get("estado_encargado","SIN ESTADO"))}</td>
-        </tr>
-        """
+    trs = "".join([_ticket_row(p, con_visto=False) for p in rows])
 
     body = f"""
     <div class="top">
@@ -1872,9 +2552,10 @@ def jefe_finalizados(request: Request):
         <thead><tr><th>Ref</th><th>Fecha</th><th>Autor</th><th>Sala</th><th>Tipo</th><th>Estado</th></tr></thead>
         <tbody>{trs or "<tr><td colspan='6'>No hay partes.</td></tr>"}</tbody>
       </table>
+      {more_link("/jefe/finalizados", {"mes": mes, "anio": anio}, next_cursor)}
     </div>
     """
-    return page("Finalizados", body)
+    return html_page("Finalizados", body)
 
 
 @app.get("/jefe/consulta_en_proceso", response_class=HTMLResponse)
@@ -1904,7 +2585,7 @@ def jefe_consulta_en_proceso_form(request: Request):
       </form>
     </div>
     """
-    return page("Jefe - Consulta", body)
+    return html_page("Jefe - Consulta", body)
 
 
 @app.post("/jefe/consulta_en_proceso", response_class=HTMLResponse)
@@ -1927,7 +2608,7 @@ def jefe_consulta_en_proceso_result(request: Request, salas: List[str] = Form([]
         subtitle=f"Filtro de salas: {filtro_txt}",
         show_link=True,
     )
-    return page("Jefe - Resultados", body)
+    return html_page("Jefe - Resultados", body)
 
 
 # =========================
@@ -1942,21 +2623,18 @@ def parte_detalle(request: Request, ref: str):
 
     p = ticket_por_ref(ref)
     if not p:
-        return HTMLResponse(
-            page(
-                "No encontrado",
-                f"<div class='card'><h3>No existe el parte {h(ref)}</h3></div>",
-            ),
+        return html_page(
+            "No encontrado",
+            f"<div class='card'><h3>No existe el parte {h(ref)}</h3></div>",
             status_code=404,
         )
 
-    fecha, hora = formatear_fecha_hora(p.get("created_at"))
+    fecha, hora = fecha_hora_de(p)
     visto = "Sí" if p.get("visto_por_encargado") else "No"
     estado = p.get("estado_encargado") or "SIN ESTADO"
     prio_current = (p.get("priority") or "MEDIO").upper()
     prio = prio_current
-    prio_color = PRIORIDAD_COLOR.get(prio_current, "#f39c12")
-    prio_badge_html = f"<b style='color:{prio_color}'>{h(prio_label(prio_current))}</b>"
+    prio_badge_html = _PRIO_BADGE.get(prio_current, _PRIO_BADGE_DEFAULT)
     prio_options_html = "".join(
     [
     f"<option value='{h(k)}' {'selected' if k==prio_current else ''}>{h(v)}</option>"
@@ -1986,16 +2664,7 @@ def parte_detalle(request: Request, ref: str):
         """
 
     # --- Imágenes adjuntas (hasta 3) ---
-    imgs: List[str] = []
-    try:
-        if p.get("id"):
-            rows = db_all(
-                "select image_url from public.wom_ticket_images where ticket_id=%s order by position asc;",
-                (p["id"],),
-            )
-            imgs = [(r.get("image_url") or "").strip() for r in rows if (r.get("image_url") or "").strip()]
-    except Exception:
-        imgs = []
+    imgs: List[str] = [(url or "").strip() for url in (p.get("image_urls") or []) if (url or "").strip()]
 
     if not imgs:
         single = (p.get("image_url") or "").strip()
@@ -2040,12 +2709,7 @@ def parte_detalle(request: Request, ref: str):
     """
 
     if u["rol"] == "ENCARGADO":
-        estados_opts = "".join(
-            [
-                f"<option value='{h(e)}' {'selected' if e==estado else ''}>{h(e)}</option>"
-                for e in ESTADOS_ENCARGADO
-            ]
-        )
+        estados_opts = _estados_options_html(estado)
         body += f"""
         <div class="card">
           <h3>Acciones del encargado</h3>
@@ -2080,42 +2744,23 @@ def parte_detalle(request: Request, ref: str):
         </div>
         """
 
-    return page("Detalle", body)
+    return html_page("Detalle", body)
 
 
 # =========================
 # ENCARGADO
 # =========================
-@app.get("/encargado", response_class=HTMLResponse)
-def admin_menu(request: Request):
-    r = require_login(request)
-    if r:
-        return r
-    u = user_from_session(request)
-    if u["rol"] not in ("ENCARGADO",):
-        return RedirectResponse(role_home_path(u["rol"]), status_code=303)
+# Todas las rutas de este router exigen rol ENCARGADO (una sola dependencia por petición);
+# los handlers que necesitan el usuario lo piden con Depends(require_encargado), que FastAPI
+# resuelve una vez y reutiliza. El inventario queda fuera: también lo usa el TECNICO.
+encargado_router = APIRouter(prefix="/encargado", dependencies=[Depends(require_encargado)])
 
-    row = db_one(
-        '''
-        select count(*)::int as n
-        from public.wom_tickets
-        where coalesce(estado_encargado,'') not in ('TRABAJO TERMINADO/REPARADO','TRABAJO DESESTIMADO')
-          and visto_por_encargado = false;
-    '''
-    )
-    unseen = int((row or {}).get("n") or 0)
-    pend_class = "btn btn-attn" if unseen > 0 else "btn"
 
-    urg_row = db_one(
-        '''
-        select count(*)::int as n
-        from public.wom_tickets
-        where coalesce(estado_encargado,'') not in ('TRABAJO TERMINADO/REPARADO','TRABAJO DESESTIMADO')
-          and visto_por_encargado = false
-          and upper(coalesce(priority,'')) = 'URGENTE';
-        '''
-    )
-    urgentes_sin_ver = int((urg_row or {}).get('n') or 0)
+@encargado_router.get("", response_class=HTMLResponse)
+def admin_menu(u: Dict[str, Any] = Depends(require_encargado)):
+    # Contadores cacheados MENU_COUNTS_TTL s: otro worker puede tardar hasta eso en reflejar un parte nuevo.
+    unseen, urgentes_sin_ver = menu_counts()
+    pend_class = "btn btn-attn" if unseen > 0 else "btn"
 
     
     urgente_banner = ""
@@ -2142,215 +2787,220 @@ def admin_menu(request: Request):
     </div>
     {urgente_banner}
     '''
-    return page("Encargado", body)
-
-
-
-@app.get("/encargado/pendientes", response_class=HTMLResponse)
-def admin_pendientes(request: Request):
-    r = require_login(request)
-    if r:
-        return r
-    u = user_from_session(request)
-    if u["rol"] not in ("ENCARGADO",):
-        return RedirectResponse(role_home_path(u["rol"]), status_code=303)
+    return html_page("Encargado", body)
 
-    rows = db_all(
-        """
-        select referencia, created_at, created_by_name, room_name, tipo, priority, estado_encargado, visto_por_encargado
-        from public.wom_tickets
-        where (estado_encargado is null or estado_encargado not in ('TRABAJO TERMINADO/REPARADO','TRABAJO DESESTIMADO'))
-        order by created_at desc;
-    """
-    )
 
-    trs = ""
-    for p in rows:
-        f, hh = formatear_fecha_hora(p.get("created_at"))
-        visto = "Sí" if p.get("visto_por_encargado") else "No"
-        ref = (p.get("referencia") or "").strip()
-        trs += f"""
-        <tr>
-          <td><a href="/parte/{h(ref)}">{h(ref)}</a></td>
-          <td>{h(f)} {h(hh)}</td>
-          <td>{h(p.get("created_by_name",""))}</td>
-          <td>{h(p.get("room_name",""))}</td>
-          <td>{h(p.get("tipo",""))}</td>
-          <td>{prio_span(p.get("priority"), p.get("estado_encargado","SIN ESTADO"))}</td>
-          <td>{h(visto)}</td>
-        </tr>
-        """
 
-    body = f"""
-    <div class="top">
-      <div><h2>Pendientes / en curso</h2></div>
-      <div><a class="btn2" href="/encargado">Volver</a></div>
-    </div>
+# Plantillas de los listados del encargado: la parte fija se compone una vez al importar;
+# por petición solo se rellenan (con .format) las filas, el filtro y el enlace "Más".
+_SIN_PARTES_ROW = "<tr><td colspan='7'>No hay partes.</td></tr>"
+_TICKETS_TABLE_TPL = """
     <div class="card">
       <table>
         <thead><tr><th>Ref</th><th>Fecha</th><th>Autor</th><th>Sala</th><th>Tipo</th><th>Estado</th><th>Visto</th></tr></thead>
-        <tbody>{trs or "<tr><td colspan='7'>No hay partes.</td></tr>"}</tbody>
+        <tbody>{trs}</tbody>
       </table>
+      {more}
     </div>
     """
-    return page("Pendientes", body)
-
+_PENDIENTES_TPL = """
+    <div class="top">
+      <div><h2>Pendientes / en curso</h2></div>
+      <div><a class="btn2" href="/encargado">Volver</a></div>
+    </div>""" + _TICKETS_TABLE_TPL
+_FINALIZADOS_TPL = """
+    <div class="top">
+      <div><h2>Finalizados</h2></div>
+      <div><a class="btn2" href="/encargado">Volver</a></div>
+    </div>
+
+    <div class="card">
+      <form method="get" action="/encargado/finalizados">
+        <div class="grid2">
+          <div>
+            <label>Mes</label>
+            <input name="mes" type="number" min="1" max="12" value="{mes}" required>
+          </div>
+          <div>
+            <label>Año</label>
+            <input name="anio" type="number" min="2000" max="2100" value="{anio}" required>
+          </div>
+        </div>
+        <button class="btn" type="submit">Filtrar</button>
+      </form>
+      {error}
+    </div>
+""" + _TICKETS_TABLE_TPL
+
+
+@encargado_router.get("/pendientes", response_class=HTMLResponse)
+def admin_pendientes(request: Request):
+    cursor = parse_cursor(request.query_params.get("cursor"))
+    rows = db_all(
+        f"""
+        select {SQL_TICKET_FILA}
+        from public.wom_tickets
+        where {SQL_PARTE_ABIERTO}
+          and {SQL_KEYSET}
+        order by created_at desc, id desc
+        limit %s;
+    """,
+        (*keyset_params(cursor), PAGE_SIZE + 1),
+        cursor_factory=NamedTupleCursor,
+    )
+    rows, next_cursor = split_page(rows)
+
+    body = _PENDIENTES_TPL.format(
+        trs="".join(map(_ticket_row_nt, rows)) or _SIN_PARTES_ROW,
+        more=more_link("/encargado/pendientes", {}, next_cursor),
+    )
+    return html_page("Pendientes", body)
 
-@app.get("/encargado/finalizados", response_class=HTMLResponse)
-def admin_finalizados(request: Request):
-    r = require_login(request)
-    if r:
-        return r
-    u = user_from_session(request)
-    if u["rol"] not in ("ENCARGADO",):
-        return RedirectResponse(role_home_path(u["rol"]), status_code=303)
 
+@encargado_router.get("/finalizados", response_class=HTMLResponse)
+def admin_finalizados(request: Request):
     now = now_madrid()
     mes = (request.query_params.get("mes") or str(now.month)).strip()
     anio = (request.query_params.get("anio") or str(now.year)).strip()
 
+    cursor = parse_cursor(request.query_params.get("cursor"))
+    next_cursor = None
     rows = []
     error = ""
     try:
         mes_i = int(mes); anio_i = int(anio)
         ts_start, ts_end = month_bounds(anio_i, mes_i)
         rows = db_all(
-            """
-            select referencia, created_at, created_by_name, room_name, tipo, priority, estado_encargado, visto_por_encargado
+            f"""
+            select {SQL_TICKET_FILA}
             from public.wom_tickets
-            where estado_encargado in ('TRABAJO TERMINADO/REPARADO','TRABAJO DESESTIMADO')
+            where {SQL_PARTE_FINALIZADO}
               and created_at >= %s and created_at < %s
-            order by created_at desc;
+              and {SQL_KEYSET}
+            order by created_at desc, id desc
+            limit %s;
             """,
-            (ts_start, ts_end),
+            (ts_start, ts_end, *keyset_params(cursor), PAGE_SIZE + 1),
+            cursor_factory=NamedTupleCursor,
         )
+        rows, next_cursor = split_page(rows)
     except Exception as e:
         error = str(e)
 
-    trs = ""
-    for p in rows:
-        f, hh = formatear_fecha_hora(p.get("created_at"))
-        visto = "Sí" if p.get("visto_por_encargado") else "No"
-        ref = (p.get("referencia") or "").strip()
-        trs += f"""
-        <tr>
-          <td><a href="/parte/{h(ref)}">{h(ref)}</a></td>
-          <td>{h(f)} {h(hh)}</td>
-          <td>{h(p.get("created_by_name",""))}</td>
-          <td>{h(p.get("room_name",""))}</td>
-          <td>{h(p.get("tipo",""))}</td>
-          <td>{prio_span(p.get("priority"), p.get("estado_encargado","SIN ESTADO"))}</td>
-          <td>{h(visto)}</td>
-        </tr>
-        """
-
-    body = f"""
+    body = _FINALIZADOS_TPL.format(
+        mes=h(mes),
+        anio=h(anio),
+        error=f"<p class='warn'>Error en filtro: {h(error)}</p>" if error else "",
+        trs="".join(map(_ticket_row_nt, rows)) or _SIN_PARTES_ROW,
+        more=more_link("/encargado/finalizados", {"mes": mes, "anio": anio}, next_cursor)
+        + (_FINALIZADOS_TODO_LINK.format(qs=h(urllib.parse.urlencode({"mes": mes, "anio": anio}))) if next_cursor else ""),
+    )
+    return html_page("Finalizados", body)
+
+
+_FINALIZADOS_TODO_LINK = "<p style='margin-top:10px'><a class='btn2' href='/encargado/finalizados/todo?{qs}'>Ver el mes completo</a></p>"
+_SQL_FINALIZADOS_TODO = f"""
+    select {SQL_TICKET_FILA}
+    from public.wom_tickets
+    where {SQL_PARTE_FINALIZADO}
+      and created_at >= %s and created_at < %s
+    order by created_at desc, id desc;
+"""
+_FINALIZADOS_TODO_HEAD = """
     <div class="top">
-      <div><h2>Finalizados</h2></div>
-      <div><a class="btn2" href="/encargado">Volver</a></div>
-    </div>
-
-    <div class="card">
-      <form method="get" action="/encargado/finalizados">
-        <div class="grid2">
-          <div>
-            <label>Mes</label>
-            <input name="mes" type="number" min="1" max="12" value="{h(mes)}" required>
-          </div>
-          <div>
-            <label>Año</label>
-            <input name="anio" type="number" min="2000" max="2100" value="{h(anio)}" required>
-          </div>
-        </div>
-        <button class="btn" type="submit">Filtrar</button>
-      </form>
-      {f"<p class='warn'>Error en filtro: {h(error)}</p>" if error else ""}
+      <div><h2>Finalizados {mes}/{anio} (mes completo)</h2></div>
+      <div><a class="btn2" href="/encargado/finalizados?{qs}">Volver</a></div>
     </div>
-
     <div class="card">
       <table>
         <thead><tr><th>Ref</th><th>Fecha</th><th>Autor</th><th>Sala</th><th>Tipo</th><th>Estado</th><th>Visto</th></tr></thead>
-        <tbody>{trs or "<tr><td colspan='7'>No hay partes.</td></tr>"}</tbody>
+        <tbody>"""
+_FINALIZADOS_TODO_TAIL = """</tbody>
       </table>
     </div>
     """
-    return page("Finalizados", body)
 
 
-@app.post("/encargado/mark_visto/{ref}")
-def admin_mark_visto(request: Request, ref: str):
-    r = require_login(request)
-    if r:
-        return r
-    u = user_from_session(request)
-    if u["rol"] not in ("ENCARGADO",):
-        return RedirectResponse(role_home_path(u["rol"]), status_code=303)
-
+@encargado_router.get("/finalizados/todo")
+def admin_finalizados_todo(mes: str = "", anio: str = ""):
+    """Mes completo sin paginar: cursor de servidor y HTML por trozos (memoria acotada al lote)."""
+    try:
+        mes_i = int(mes); anio_i = int(anio)
+        ts_start, ts_end = month_bounds(anio_i, mes_i)
+    except Exception:
+        return RedirectResponse("/encargado/finalizados", status_code=303)
+
+    rows = db_iter(_SQL_FINALIZADOS_TODO, (ts_start, ts_end), cursor_factory=NamedTupleCursor)
+    qs = h(urllib.parse.urlencode({"mes": mes_i, "anio": anio_i}))
+
+    def chunks():
+        yield page_head_bytes("Finalizados")
+        yield _FINALIZADOS_TODO_HEAD.format(mes=mes_i, anio=anio_i, qs=qs).encode("utf-8")
+        trs: List[str] = []
+        n = 0
+        for n, t in enumerate(rows, 1):
+            trs.append(_ticket_row_nt(t))
+            if len(trs) >= 500:
+                yield "".join(trs).encode("utf-8")
+                trs.clear()
+        if not n:
+            trs.append(_SIN_PARTES_ROW)
+        yield "".join(trs).encode("utf-8")
+        yield _FINALIZADOS_TODO_TAIL.encode("utf-8") + _PAGE_POST_B
+
+    return StreamingResponse(chunks(), media_type=HTML_MEDIA_TYPE)
+
+
+@encargado_router.post("/mark_visto/{ref}")
+def admin_mark_visto(ref: str):
+    ref = norm_ref(ref)
     update_ticket(ref, "visto_por_encargado=true", ())
+    menu_counts_reset()
     return RedirectResponse(f"/parte/{ref}", status_code=303)
 
 
-@app.post("/encargado/set_estado/{ref}")
-def admin_set_estado(request: Request, ref: str, estado: str = Form(...)):
-    r = require_login(request)
-    if r:
-        return r
-    u = user_from_session(request)
-    if u["rol"] not in ("ENCARGADO",):
-        return RedirectResponse(role_home_path(u["rol"]), status_code=303)
-
+@encargado_router.post("/set_estado/{ref}")
+def admin_set_estado(ref: str, estado: str = Form(...)):
+    ref = norm_ref(ref)
     est = (estado or "").strip()
     if est in ESTADOS_ENCARGADO:
-        update_ticket(ref, "estado_encargado=%s, visto_por_encargado=true", (est,))
-        if est in ('TRABAJO TERMINADO/REPARADO','TRABAJO DESESTIMADO'):
-            t = ticket_por_ref(ref)
-            if t and t.get('id'):
-                cleanup_ticket_images(int(t['id']))
+        # RETURNING id: el mismo UPDATE da el id para limpiar imágenes, sin releer el parte
+        t = db_one(
+            "update public.wom_tickets set estado_encargado=%s, visto_por_encargado=true, updated_at=now() "
+            "where referencia=%s returning id;",
+            (est, ref),
+        )
+        menu_counts_reset()
+        if est in ESTADOS_FINALIZADOS and t and t.get("id"):
+            cleanup_ticket_images(int(t["id"]))
     return RedirectResponse(f"/parte/{ref}", status_code=303)
 
 
 
-@app.post("/encargado/set_priority/{ref}")
-def admin_set_priority(request: Request, ref: str, priority: str = Form("MEDIO")):
-    r = require_login(request)
-    if r:
-        return r
-    u = user_from_session(request)
-    if u["rol"] not in ("ENCARGADO",):
-        return RedirectResponse(role_home_path(u["rol"]), status_code=303)
-
+@encargado_router.post("/set_priority/{ref}")
+def admin_set_priority(ref: str, priority: str = Form("MEDIO")):
+    ref = norm_ref(ref)
     pr = (priority or "MEDIO").strip().upper()
     if pr not in PRIORIDADES_VALIDAS:
         pr = "MEDIO"
 
-    db_exec("update public.wom_tickets set priority=%s where referencia=%s;", (pr, ref))
+    db_exec("update public.wom_tickets set priority=%s, updated_at=now() where referencia=%s;", (pr, ref))
+    menu_counts_reset()
     return RedirectResponse(f"/parte/{ref}", status_code=303)
 
-@app.post("/encargado/set_obs/{ref}")
-def admin_set_obs(request: Request, ref: str, obs: str = Form("")):
-    r = require_login(request)
-    if r:
-        return r
-    u = user_from_session(request)
-    if u["rol"] not in ("ENCARGADO",):
-        return RedirectResponse(role_home_path(u["rol"]), status_code=303)
-
+@encargado_router.post("/set_obs/{ref}")
+def admin_set_obs(ref: str, obs: str = Form("")):
+    ref = norm_ref(ref)
     update_ticket(ref, "observaciones_encargado=%s, visto_por_encargado=true", ((obs or "").strip(),))
+    menu_counts_reset()
     return RedirectResponse(f"/parte/{ref}", status_code=303)
 
 
 # =========================
 # ENCARGADO - Gestión de Partes
 # =========================
-@app.get("/encargado/gestion_partes", response_class=HTMLResponse)
-def admin_gestion_partes(request: Request):
-    r = require_login(request)
-    if r:
-        return r
-    u = user_from_session(request)
-    if u["rol"] not in ("ENCARGADO",):
-        return RedirectResponse(role_home_path(u["rol"]), status_code=303)
-
+@encargado_router.get("/gestion_partes", response_class=HTMLResponse)
+def admin_gestion_partes():
     body = """
     <div class="top">
       <div><h2>Gestión de Partes</h2></div>
@@ -2366,18 +3016,11 @@ def admin_gestion_partes(request: Request):
       <p class="muted" style="margin-top:10px">Eliminar un parte lo borra para todos los roles.</p>
     </div>
     """
-    return page("Gestión de Partes", body)
+    return html_page("Gestión de Partes", body)
 
 
-@app.get("/encargado/visualizar_en_proceso", response_class=HTMLResponse)
-def admin_visualizar_en_proceso_form(request: Request):
-    r = require_login(request)
-    if r:
-        return r
-    u = user_from_session(request)
-    if u["rol"] not in ("ENCARGADO",):
-        return RedirectResponse(role_home_path(u["rol"]), status_code=303)
-
+@encargado_router.get("/visualizar_en_proceso", response_class=HTMLResponse)
+def admin_visualizar_en_proceso_form():
     salas = get_salas()
     selector = salas_multiselect_html(salas, None, "Selecciona sala(s) para filtrar (o TODAS)")
 
@@ -2396,18 +3039,11 @@ def admin_visualizar_en_proceso_form(request: Request):
       </form>
     </div>
     """
-    return page("Encargado - Visualizar", body)
-
+    return html_page("Encargado - Visualizar", body)
 
-@app.post("/encargado/visualizar_en_proceso", response_class=HTMLResponse)
-def admin_visualizar_en_proceso_result(request: Request, salas: List[str] = Form([])):
-    r = require_login(request)
-    if r:
-        return r
-    u = user_from_session(request)
-    if u["rol"] not in ("ENCARGADO",):
-        return RedirectResponse(role_home_path(u["rol"]), status_code=303)
 
+@encargado_router.post("/visualizar_en_proceso", response_class=HTMLResponse)
+def admin_visualizar_en_proceso_result(salas: List[str] = Form([])):
     salas_filtro = sanitize_salas_selection(salas)
     rows = _query_partes_en_proceso_filtrado(salas_filtro)
 
@@ -2419,18 +3055,11 @@ def admin_visualizar_en_proceso_result(request: Request, salas: List[str] = Form
         subtitle=f"Filtro de salas: {filtro_txt}",
         show_link=True,
     )
-    return page("Encargado - Visualizar", body)
+    return html_page("Encargado - Visualizar", body)
 
 
-@app.get("/encargado/pdf", response_class=HTMLResponse)
-def admin_pdf_form(request: Request):
-    r = require_login(request)
-    if r:
-        return r
-    u = user_from_session(request)
-    if u["rol"] not in ("ENCARGADO",):
-        return RedirectResponse(role_home_path(u["rol"]), status_code=303)
-
+@encargado_router.get("/pdf", response_class=HTMLResponse)
+def admin_pdf_form():
     salas = get_salas()
     selector = salas_multiselect_html(salas, None, "Selecciona sala(s) para generar el PDF (o TODAS)")
 
@@ -2449,35 +3078,21 @@ def admin_pdf_form(request: Request):
       </form>
     </div>
     """
-    return page("PDF - Filtro", body)
+    return html_page("PDF - Filtro", body)
 
 
-@app.post("/encargado/pdf")
-def admin_pdf_generate(request: Request, salas: List[str] = Form([])):
-    r = require_login(request)
-    if r:
-        return r
-    u = user_from_session(request)
-    if u["rol"] not in ("ENCARGADO",):
-        return RedirectResponse(role_home_path(u["rol"]), status_code=303)
-
+@encargado_router.post("/pdf")
+def admin_pdf_generate(salas: List[str] = Form([])):
     salas_filtro = sanitize_salas_selection(salas)
-    pdf_path = generar_pdf_partes_en_proceso(salas_filtro)
-    return FileResponse(str(pdf_path), media_type="application/pdf", filename=pdf_path.name)
+    filename, pdf = generar_pdf_partes_en_proceso(salas_filtro)
+    return pdf_response(pdf, filename)
 
 
 # =========================
 # ENCARGADO - Eliminar partes
 # =========================
-@app.get("/encargado/eliminar_partes", response_class=HTMLResponse)
-def admin_eliminar_partes_menu(request: Request):
-    r = require_login(request)
-    if r:
-        return r
-    u = user_from_session(request)
-    if u["rol"] not in ("ENCARGADO",):
-        return RedirectResponse(role_home_path(u["rol"]), status_code=303)
-
+@encargado_router.get("/eliminar_partes", response_class=HTMLResponse)
+def admin_eliminar_partes_menu():
     body = """
     <div class="top">
       <div><h2>Eliminar partes</h2></div>
@@ -2492,54 +3107,36 @@ def admin_eliminar_partes_menu(request: Request):
       </div>
     </div>
     """
-    return page("Eliminar partes", body)
+    return html_page("Eliminar partes", body)
 
 
-@app.get("/encargado/eliminar_partes/lista", response_class=HTMLResponse)
-def admin_eliminar_partes_lista(request: Request, tipo: str = "pendientes"):
-    r = require_login(request)
-    if r:
-        return r
-    u = user_from_session(request)
-    if u["rol"] not in ("ENCARGADO",):
-        return RedirectResponse(role_home_path(u["rol"]), status_code=303)
+# Las dos variantes (abiertos / finalizados) solo difieren en el predicado de estado:
+# se componen una vez al importar y cada una usa su índice parcial.
+_SQL_ELIMINAR_LISTA = {
+    fin: f"""
+        select id, referencia, created_at, {SQL_FECHA_HORA}, created_by_name, room_name, priority, estado_encargado
+        from public.wom_tickets
+        where {SQL_PARTE_FINALIZADO if fin else SQL_PARTE_ABIERTO}
+          and {SQL_KEYSET}
+        order by created_at desc, id desc
+        limit %s;
+    """
+    for fin in (False, True)
+}
+
 
+@encargado_router.get("/eliminar_partes/lista", response_class=HTMLResponse)
+def admin_eliminar_partes_lista(request: Request, tipo: str = "pendientes"):
     finalizados = (tipo or "").lower() == "finalizados"
-    if finalizados:
-        rows = db_all(
-            """
-            select referencia, created_at, created_by_name, room_name, estado_encargado
-            from public.wom_tickets
-            where estado_encargado in ('TRABAJO TERMINADO/REPARADO','TRABAJO DESESTIMADO')
-            order by created_at desc;
-        """
-        )
-        titulo = "Finalizados"
-    else:
-        rows = db_all(
-            """
-            select referencia, created_at, created_by_name, room_name, estado_encargado
-            from public.wom_tickets
-            where (estado_encargado is null or estado_encargado not in ('TRABAJO TERMINADO/REPARADO','TRABAJO DESESTIMADO'))
-            order by created_at desc;
-        """
-        )
-        titulo = "Pendientes / en curso"
+    titulo = "Finalizados" if finalizados else "Pendientes / en curso"
+    cursor = parse_cursor(request.query_params.get("cursor"))
+    rows = db_all(
+        _SQL_ELIMINAR_LISTA[finalizados],
+        (*keyset_params(cursor), PAGE_SIZE + 1),
+    )
+    rows, next_cursor = split_page(rows)
 
-    trs = ""
-    for p in rows:
-        f, hh = formatear_fecha_hora(p.get("created_at"))
-        ref = (p.get("referencia") or "").strip()
-        trs += f"""
-        <tr>
-          <td>{h(ref)}</td>
-          <td>{h(f)} {h(hh)}</td>
-          <td>{h(p.get("created_by_name",""))}</td>
-          <td>{h(p.get("room_name",""))}</td>
-          <td>{prio_span(p.get("priority"), p.get("estado_encargado","SIN ESTADO"))}</td>
-          <td><a class="btn danger" href="/encargado/eliminar_partes/confirmar/{h(ref)}">Eliminar</a></td>
-        </tr>
-        """
+    trs = "".join(map(_delete_row, rows))
 
     body = f"""
     <div class="top">
@@ -2551,20 +3148,14 @@ def admin_eliminar_partes_lista(request: Request, tipo: str = "pendientes"):
         <thead><tr><th>Ref</th><th>Fecha</th><th>Autor</th><th>Sala</th><th>Estado</th><th></th></tr></thead>
         <tbody>{trs or "<tr><td colspan='6'>No hay partes.</td></tr>"}</tbody>
       </table>
+      {more_link("/encargado/eliminar_partes/lista", {"tipo": "finalizados" if finalizados else "pendientes"}, next_cursor)}
     </div>
     """
-    return page("Eliminar partes", body)
+    return html_page("Eliminar partes", body)
 
 
-@app.get("/encargado/eliminar_partes/confirmar/{ref}", response_class=HTMLResponse)
-def admin_eliminar_partes_confirmar(request: Request, ref: str):
-    r = require_login(request)
-    if r:
-        return r
-    u = user_from_session(request)
-    if u["rol"] not in ("ENCARGADO",):
-        return RedirectResponse(role_home_path(u["rol"]), status_code=303)
-
+@encargado_router.get("/eliminar_partes/confirmar/{ref}", response_class=HTMLResponse)
+def admin_eliminar_partes_confirmar(ref: str):
     body = f"""
     <div class="card">
       <h2>Confirmación</h2>
@@ -2578,40 +3169,48 @@ def admin_eliminar_partes_confirmar(request: Request, ref: str):
       <p class="muted" style="margin-top:10px">Esta acción es irreversible.</p>
     </div>
     """
-    return page("Confirmar eliminación", body)
-
+    return html_page("Confirmar eliminación", body)
 
-@app.post("/encargado/eliminar_partes/confirmar/{ref}")
-def admin_eliminar_partes_do(request: Request, ref: str):
-    r = require_login(request)
-    if r:
-        return r
-    u = user_from_session(request)
-    if u["rol"] not in ("ENCARGADO",):
-        return RedirectResponse(role_home_path(u["rol"]), status_code=303)
 
-    rref = (ref or "").strip().upper()
-    t = ticket_por_ref(rref)
-    if t and t.get("id"):
-        # Borra imágenes asociadas (Storage + BD) antes de borrar el parte
-        cleanup_ticket_images(int(t["id"]))
-    db_exec("delete from public.wom_tickets where referencia=%s;", (rref,))
+@encargado_router.post("/eliminar_partes/confirmar/{ref}")
+def admin_eliminar_partes_do(ref: str):
+    rref = norm_ref(ref)
+    # Una sola sentencia/transacción: borra el parte (wom_ticket_images cae por ON DELETE CASCADE)
+    # y devuelve las rutas de sus imágenes, leídas con la foto previa al borrado.
+    row = db_one(
+        """
+        with t as (
+          delete from public.wom_tickets where referencia=%s
+          returning id, image_path, image_url
+        )
+        select t.image_path, t.image_url,
+               coalesce((select array_agg(i.image_path order by i.position)
+                         from public.wom_ticket_images i
+                         where i.ticket_id = t.id and coalesce(i.image_path,'') <> ''), '{}'::text[]) as paths
+        from t;
+        """,
+        (rref,),
+    )
+    menu_counts_reset()
+    if row:
+        # Storage va después del commit y nunca rompe el flujo (como cleanup_ticket_images)
+        bucket = (os.getenv("SUPABASE_STORAGE_BUCKET", "") or "").strip() or "partes"
+        paths = [p.strip() for p in (row.get("paths") or [])]
+        add_legacy_image_path(paths, row, bucket)
+        try:
+            supabase_storage_remove(bucket, paths)
+        except Exception as e:
+            print(f"[admin_eliminar_partes_do] error borrando storage ref={rref} err={e}")
     return RedirectResponse("/encargado/gestion_partes", status_code=303)
 
 
 # =========================
 # ENCARGADO - Gestión de Usuarios
 # =========================
-@app.get("/encargado/gestion_usuarios", response_class=HTMLResponse)
-def admin_gestion_usuarios(request: Request):
-    r = require_login(request)
-    if r:
-        return r
-    u = user_from_session(request)
-    if u["rol"] not in ("ENCARGADO",):
-        return RedirectResponse(role_home_path(u["rol"]), status_code=303)
-
-    body = """
+# Páginas fijas de esta sección: se renderizan una vez al importar y se sirven tal cual (con ETag).
+_GESTION_USUARIOS_PAGE = static_page(
+    "Gestión de Usuarios",
+    """
     <div class="top">
       <div><h2>Gestión de Usuarios</h2></div>
       <div><a class="btn2" href="/encargado">Volver</a></div>
@@ -2625,237 +3224,261 @@ def admin_gestion_usuarios(request: Request):
         <a class="btn" href="/encargado/salas">Gestionar las Salas de Escape</a>
       </div>
     </div>
+    """,
+)
+
+_CREAR_USUARIO_PAGE = static_page(
+    "Crear Usuario",
     """
-    return page("Gestión de Usuarios", body)
+    <div class="top">
+      <div><h2>Crear Usuario</h2></div>
+      <div><a class="btn2" href="/encargado/gestion_usuarios">Volver</a></div>
+    </div>
 
+    <div class="card">
+      <form method="post" action="/encargado/usuarios/crear">
+        <label>Código (ej: X123Y)</label>
+        <input name="codigo" autocomplete="off"/>
 
-@app.get("/encargado/usuarios/listar", response_class=HTMLResponse)
-def admin_listar_usuarios(request: Request):
-    r = require_login(request)
-    if r:
-        return r
-    u = user_from_session(request)
-    if u["rol"] not in ("ENCARGADO",):
-        return RedirectResponse(role_home_path(u["rol"]), status_code=303)
+        <label>Nombre</label>
+        <input name="nombre" autocomplete="off"/>
 
-    msg = request.query_params.get("msg", "")
+        <label>Rol</label>
+        <select name="rol">
+          <option value="TRABAJADOR">TRABAJADOR</option>
+          <option value="JEFE">JEFE</option>
+          <option value="ENCARGADO">ENCARGADO</option>
+        </select>
 
-    users = db_all("select code, name, role from public.wom_users order by role, name;")
-    counts = db_all("select created_by_code as code, count(*)::int as n from public.wom_tickets group by created_by_code;")
-    count_map = {(c.get("code") or "").upper(): int(c.get("n") or 0) for c in counts}
-
-    roles = ["TRABAJADOR", "ENCARGADO", "TECNICO", "JEFE"]
-
-    rows = ""
-    for us in users:
-        code = (us.get("code") or "").strip()
-        n = count_map.get(code.upper(), 0)
-        cur_role = (us.get("role") or "").upper()
-        opts = ""
-        for rname in roles:
-            sel = "selected" if rname == cur_role else ""
-            opts += f'<option value="{rname}" {sel}>{rname}</option>'
-        rows += f"""
-        <tr>
-          <td>{h(code)}</td>
-          <td>{h(us.get("name",""))}</td>
-          <td>
-            <form method="post" action="/encargado/usuarios/cambiar_rol" style="display:flex; gap:8px; align-items:center; margin:0;">
-              <input type="hidden" name="code" value="{h(code)}"/>
-              <select name="role">{opts}</select>
-              <button class="btn2" type="submit">Guardar</button>
-            </form>
-          </td>
-          <td style="text-align:right">{n}</td>
-        </tr>
-        """
+        <div style="margin-top:12px">
+          <button class="btn" type="submit">Crear</button>
+        </div>
+      </form>
+    </div>
+    """,
+)
 
-    body = f"""
+# Esqueletos de las páginas con datos: solo se rellenan con .format por petición.
+_LISTAR_USUARIOS_TPL = """
     <div class="top">
       <div><h2>Usuarios del sistema</h2></div>
       <div><a class="btn2" href="/encargado/gestion_usuarios">Volver</a></div>
     </div>
 
-    {f"<div class='msg ok'>{h(msg)}</div>" if msg else ""}
+    {msg}
 
     <div class="card">
       <table>
         <thead><tr><th>Código</th><th>Nombre</th><th>Rol (editable)</th><th>Partes emitidos</th></tr></thead>
-        <tbody>{rows or "<tr><td colspan='4'>No hay usuarios.</td></tr>"}</tbody>
+        <tbody>{rows}</tbody>
       </table>
       <p style="margin-top:10px; font-size:12px; opacity:0.9;">
         Nota: por seguridad, no se permite cambiar tu propio rol a uno distinto de ENCARGADO/TECNICO desde aquí.
       </p>
     </div>
     """
-    return page("Listar Usuarios", body)
 
+ROLES_USUARIO = ["TRABAJADOR", "ENCARGADO", "TECNICO", "JEFE"]
+# <option> del selector de rol, uno por rol actual (y "" para roles desconocidos)
+_ROLE_OPTS = {
+    cur: "".join(f'<option value="{r}" {"selected" if r == cur else ""}>{r}</option>' for r in ROLES_USUARIO)
+    for cur in ROLES_USUARIO + [""]
+}
 
-@app.post("/encargado/usuarios/cambiar_rol")
-def admin_cambiar_rol(request: Request, code: str = Form(...), role: str = Form(...)):
-    r = require_login(request)
-    if r:
-        return r
-    u = user_from_session(request)
-    if u["rol"] not in ("ENCARGADO",):
-        return RedirectResponse(role_home_path(u["rol"]), status_code=303)
-
-    code = (code or "").strip().upper()
-    role = (role or "").strip().upper()
-
-    allowed = {"TRABAJADOR", "ENCARGADO", "TECNICO", "JEFE"}
-    if role not in allowed:
-        return RedirectResponse('/encargado/usuarios/listar?msg=Rol%20no%20válido', status_code=303)
-
-    if code == (u.get("codigo") or "").strip().upper() and role not in {"ENCARGADO","TECNICO"}:
-        return RedirectResponse('/encargado/usuarios/listar?msg=No%20puedes%20cambiar%20tu%20propio%20rol%20a%20uno%20no%20administrador', status_code=303)
-
-    db_exec_safe("update public.wom_users set role=%s where code=%s;", (role, code), label="update_user_role")
-    return RedirectResponse('/encargado/usuarios/listar?msg=Rol%20actualizado', status_code=303)
-
+_USUARIO_ROL_ROW_TPL = """
+        <tr>
+          <td>{code}</td>
+          <td>{name}</td>
+          <td>
+            <form method="post" action="/encargado/usuarios/cambiar_rol" style="display:flex; gap:8px; align-items:center; margin:0;">
+              <input type="hidden" name="code" value="{code}"/>
+              <select name="role">{opts}</select>
+              <button class="btn2" type="submit">Guardar</button>
+            </form>
+          </td>
+          <td style="text-align:right">{n}</td>
+        </tr>
+        """
 
-@app.get("/encargado/usuarios/crear", response_class=HTMLResponse)
-def admin_crear_usuario_form(request: Request):
-    r = require_login(request)
-    if r:
-        return r
-    u = user_from_session(request)
-    if u["rol"] not in ("ENCARGADO",):
-        return RedirectResponse(role_home_path(u["rol"]), status_code=303)
+_USUARIO_ELIMINAR_ROW_TPL = """
+        <tr>
+          <td>{code}</td>
+          <td>{name}</td>
+          <td>{role}</td>
+          <td>{btn}</td>
+        </tr>
+        """
 
-    body = """
+_ELIMINAR_USUARIO_TPL = """
     <div class="top">
-      <div><h2>Crear Usuario</h2></div>
+      <div><h2>Eliminar Usuario</h2></div>
       <div><a class="btn2" href="/encargado/gestion_usuarios">Volver</a></div>
     </div>
 
     <div class="card">
-      <form method="post" action="/encargado/usuarios/crear">
-        <label>Código (ej: X123Y)</label>
-        <input name="codigo" autocomplete="off"/>
+      <table>
+        <thead><tr><th>Código</th><th>Nombre</th><th>Rol</th><th></th></tr></thead>
+        <tbody>{rows}</tbody>
+      </table>
+      <p class="muted" style="margin-top:10px">Eliminar un usuario NO borra los partes existentes.</p>
+    </div>
+    """
 
-        <label>Nombre</label>
-        <input name="nombre" autocomplete="off"/>
+_SALAS_TPL = """
+    <div class="top">
+      <div><h2>Gestionar Salas de Escape</h2></div>
+      <div><a class="btn2" href="/encargado/gestion_usuarios">Volver</a></div>
+    </div>
 
-        <label>Rol</label>
-        <select name="rol">
-          <option value="TRABAJADOR">TRABAJADOR</option>
-          <option value="JEFE">JEFE</option>
-          <option value="ENCARGADO">ENCARGADO</option>
-        </select>
+    <div class="card">
+      <h3>Salas actuales</h3>
+      <ul>{items}</ul>
+    </div>
 
+    <div class="card">
+      <h3>Añadir sala</h3>
+      <form method="post" action="/encargado/salas">
+        <label>Nombre de la sala</label>
+        <input name="sala" autocomplete="off" placeholder="Ej: NUEVA SALA"/>
         <div style="margin-top:12px">
-          <button class="btn" type="submit">Crear</button>
+          <button class="btn" type="submit">Añadir</button>
         </div>
       </form>
+      <p class="muted" style="margin-top:10px">Estas salas aparecerán en el desplegable de “Nuevo parte”.</p>
     </div>
     """
-    return page("Crear Usuario", body)
 
 
-@app.post("/encargado/usuarios/crear")
-def admin_crear_usuario_do(
+@encargado_router.get("/gestion_usuarios", response_class=HTMLResponse)
+def admin_gestion_usuarios(request: Request):
+    return page_response(request, _GESTION_USUARIOS_PAGE)
+
+
+@encargado_router.get("/usuarios/listar", response_class=HTMLResponse)
+def admin_listar_usuarios(request: Request):
+    msg = pop_flash(request)
+
+    # Usuarios y nº de partes emitidos en una sola consulta (agregado en el servidor).
+    users = db_all(
+        """
+        select u.code, u.name, u.role, coalesce(t.n, 0)::int as n
+        from public.wom_users u
+        left join (
+          select upper(created_by_code) as code, count(*) as n
+          from public.wom_tickets
+          group by 1
+        ) t on t.code = upper(u.code)
+        order by u.role, u.name;
+        """
+    )
+
+    def fila(us: Dict[str, Any]) -> str:
+        code = h((us.get("code") or "").strip())
+        opts = _ROLE_OPTS.get((us.get("role") or "").upper(), _ROLE_OPTS[""])
+        return _USUARIO_ROL_ROW_TPL.format(code=code, name=h(us.get("name", "")), opts=opts, n=us["n"])
+
+    rows = "".join(map(fila, users))
+
+    body = _LISTAR_USUARIOS_TPL.format(
+        msg=f"<div class='msg ok'>{h(msg)}</div>" if msg else "",
+        rows=rows or "<tr><td colspan='4'>No hay usuarios.</td></tr>",
+    )
+    return html_page("Listar Usuarios", body)
+
+
+@encargado_router.post("/usuarios/cambiar_rol")
+def admin_cambiar_rol(
     request: Request,
+    code: str = Form(...),
+    role: str = Form(...),
+    u: Dict[str, Any] = Depends(require_encargado),
+):
+    code = norm_code(code)
+    role = (role or "").strip().upper()
+
+    if role not in ROLES_USUARIO:
+        return flash_redirect(request, "/encargado/usuarios/listar", "Rol no válido")
+
+    if code == u["codigo"] and role not in {"ENCARGADO","TECNICO"}:
+        return flash_redirect(request, "/encargado/usuarios/listar", "No puedes cambiar tu propio rol a uno no administrador")
+
+    db_exec_safe("update public.wom_users set role=%s where code=%s;", (role, code), label="update_user_role")
+    workers_cache_reset()
+    return flash_redirect(request, "/encargado/usuarios/listar", "Rol actualizado")
+
+
+@encargado_router.get("/usuarios/crear", response_class=HTMLResponse)
+def admin_crear_usuario_form(request: Request):
+    return page_response(request, _CREAR_USUARIO_PAGE)
+
+
+@encargado_router.post("/usuarios/crear")
+def admin_crear_usuario_do(
     codigo: str = Form(...),
     nombre: str = Form(...),
     rol: str = Form(...),
 ):
-    r = require_login(request)
-    if r:
-        return r
-    u = user_from_session(request)
-    if u["rol"] not in ("ENCARGADO",):
-        return RedirectResponse(role_home_path(u["rol"]), status_code=303)
-
-    c = (codigo or "").strip().upper()
+    c = norm_code(codigo)
     n = (nombre or "").strip()
     rr = (rol or "").strip().upper()
 
     if not c or not n or rr not in {"TRABAJADOR", "JEFE", "ENCARGADO"}:
-        return HTMLResponse(
-            page(
-                "Error",
-                "<div class='card'><h3>Datos inválidos</h3><p><a class='btn2' href='/encargado/usuarios/crear'>Volver</a></p></div>",
-            ),
+        return html_page(
+            "Error",
+            "<div class='card'><h3>Datos inválidos</h3><p><a class='btn2' href='/encargado/usuarios/crear'>Volver</a></p></div>",
             status_code=400,
         )
 
-    exists = db_one("select 1 as x from public.wom_users where upper(code)=upper(%s);", (c,))
-    if exists:
-        return HTMLResponse(
-            page(
-                "Error",
-                f"<div class='card'><h3>Ya existe un usuario con código {h(c)}</h3><p><a class='btn2' href='/encargado/usuarios/crear'>Volver</a></p></div>",
-            ),
+    # Un solo INSERT atómico: si el código ya existe (PK o índice único en upper(code)) no inserta
+    # ni devuelve fila. Sin la ventana de carrera del "select y luego insert".
+    created = db_one(
+        "insert into public.wom_users (code, name, role) values (%s,%s,%s) on conflict do nothing returning code;",
+        (c, n, rr),
+    )
+    if not created:
+        return html_page(
+            "Error",
+            f"<div class='card'><h3>Ya existe un usuario con código {h(c)}</h3><p><a class='btn2' href='/encargado/usuarios/crear'>Volver</a></p></div>",
             status_code=400,
         )
 
-    db_exec("insert into public.wom_users (code, name, role) values (%s,%s,%s);", (c, n, rr))
+    workers_cache_reset()
     return RedirectResponse("/encargado/usuarios/listar", status_code=303)
 
 
-@app.get("/encargado/usuarios/eliminar", response_class=HTMLResponse)
-def admin_eliminar_usuario_lista(request: Request):
-    r = require_login(request)
-    if r:
-        return r
-    u = user_from_session(request)
-    if u["rol"] not in ("ENCARGADO",):
-        return RedirectResponse(role_home_path(u["rol"]), status_code=303)
-
+@encargado_router.get("/usuarios/eliminar", response_class=HTMLResponse)
+def admin_eliminar_usuario_lista(u: Dict[str, Any] = Depends(require_encargado)):
     users = db_all("select code, name, role from public.wom_users order by role, name;")
 
-    rows = ""
-    for us in users:
-        code = us["code"]
-        disabled = code.upper() == u["codigo"].upper()
-        btn = "(No puedes eliminarte)" if disabled else f"<a class='btn danger' href='/encargado/usuarios/eliminar/confirmar/{h(code)}'>Eliminar</a>"
-        rows += f"""
-        <tr>
-          <td>{h(code)}</td>
-          <td>{h(us["name"])}</td>
-          <td>{h(us["role"])}</td>
-          <td>{btn}</td>
-        </tr>
-        """
+    yo = u["codigo"]  # ya normalizado en sesión (get_user_by_code)
 
-    body = f"""
-    <div class="top">
-      <div><h2>Eliminar Usuario</h2></div>
-      <div><a class="btn2" href="/encargado/gestion_usuarios">Volver</a></div>
-    </div>
+    def fila(us: Dict[str, Any]) -> str:
+        code = h(us["code"])
+        btn = (
+            "(No puedes eliminarte)" if norm_code(us["code"]) == yo
+            else f"<a class='btn danger' href='/encargado/usuarios/eliminar/confirmar/{code}'>Eliminar</a>"
+        )
+        return _USUARIO_ELIMINAR_ROW_TPL.format(code=code, name=h(us["name"]), role=h(us["role"]), btn=btn)
 
-    <div class="card">
-      <table>
-        <thead><tr><th>Código</th><th>Nombre</th><th>Rol</th><th></th></tr></thead>
-        <tbody>{rows or "<tr><td colspan='4'>No hay usuarios.</td></tr>"}</tbody>
-      </table>
-      <p class="muted" style="margin-top:10px">Eliminar un usuario NO borra los partes existentes.</p>
-    </div>
-    """
-    return page("Eliminar Usuario", body)
+    rows = "".join(map(fila, users))
 
-@app.get("/encargado/usuarios/eliminar/confirmar/{code}", response_class=HTMLResponse)
-def admin_eliminar_usuario_confirmar(request: Request, code: str):
-    r = require_login(request)
-    if r:
-        return r
-    u = user_from_session(request)
-    if u["rol"] not in ("ENCARGADO",):
-        return RedirectResponse(role_home_path(u["rol"]), status_code=303)
+    body = _ELIMINAR_USUARIO_TPL.format(rows=rows or "<tr><td colspan='4'>No hay usuarios.</td></tr>")
+    return html_page("Eliminar Usuario", body)
 
-    code = (code or "").strip().upper()
+@encargado_router.get("/usuarios/eliminar/confirmar/{code}", response_class=HTMLResponse)
+def admin_eliminar_usuario_confirmar(code: str, u: Dict[str, Any] = Depends(require_encargado)):
+    code = norm_code(code)
     target = get_user_by_code(code)
     if not target:
         return RedirectResponse("/encargado/usuarios/eliminar", status_code=303)
 
-    if code == (u.get("codigo") or "").strip().upper():
+    if code == u["codigo"]:
         msg = "No puedes eliminar tu propio usuario."
         body = f'''
         <div class="top"><div><h2>Eliminar usuario</h2></div><div><a class="btn2" href="/encargado/usuarios/eliminar">Volver</a></div></div>
         <div class="card"><p style="font-weight:700; color:#b00000"><b>{h(msg)}</b></p></div>
         '''
-        return page("Eliminar usuario", body)
+        return html_page("Eliminar usuario", body)
 
     body = f'''
     <div class="top">
@@ -2872,20 +3495,13 @@ def admin_eliminar_usuario_confirmar(request: Request, code: str):
       </form>
     </div>
     '''
-    return page("Confirmar eliminación", body)
+    return html_page("Confirmar eliminación", body)
 
 
-@app.post("/encargado/usuarios/eliminar/confirmar/{code}")
-def admin_eliminar_usuario_confirmar_post(request: Request, code: str):
-    r = require_login(request)
-    if r:
-        return r
-    u = user_from_session(request)
-    if u["rol"] not in ("ENCARGADO",):
-        return RedirectResponse(role_home_path(u["rol"]), status_code=303)
-
-    code = (code or "").strip().upper()
-    if code == (u.get("codigo") or "").strip().upper():
+@encargado_router.post("/usuarios/eliminar/confirmar/{code}")
+def admin_eliminar_usuario_confirmar_post(code: str, u: Dict[str, Any] = Depends(require_encargado)):
+    code = norm_code(code)
+    if code == u["codigo"]:
         return RedirectResponse("/encargado/usuarios/eliminar", status_code=303)
 
     # no permitir eliminar el encargado principal
@@ -2893,83 +3509,108 @@ def admin_eliminar_usuario_confirmar_post(request: Request, code: str):
         return RedirectResponse("/encargado/usuarios/eliminar", status_code=303)
 
     db_exec("delete from public.wom_users where code=%s;", (code,))
+    workers_cache_reset()
     return RedirectResponse("/encargado/usuarios/eliminar", status_code=303)
 
 
 
-@app.get("/encargado/salas", response_class=HTMLResponse)
-def admin_salas(request: Request):
-    r = require_login(request)
-    if r:
-        return r
-    u = user_from_session(request)
-    if u["rol"] not in ("ENCARGADO",):
-        return RedirectResponse(role_home_path(u["rol"]), status_code=303)
-
+@encargado_router.get("/salas", response_class=HTMLResponse)
+def admin_salas():
     salas = get_salas()
     items = "".join([f"<li>{h(s)}</li>" for s in salas]) or "<li>No hay salas.</li>"
 
-    body = f"""
-    <div class="top">
-      <div><h2>Gestionar Salas de Escape</h2></div>
-      <div><a class="btn2" href="/encargado/gestion_usuarios">Volver</a></div>
-    </div>
-
-    <div class="card">
-      <h3>Salas actuales</h3>
-      <ul>{items}</ul>
-    </div>
-
-    <div class="card">
-      <h3>Añadir sala</h3>
-      <form method="post" action="/encargado/salas">
-        <label>Nombre de la sala</label>
-        <input name="sala" autocomplete="off" placeholder="Ej: NUEVA SALA"/>
-        <div style="margin-top:12px">
-          <button class="btn" type="submit">Añadir</button>
-        </div>
-      </form>
-      <p class="muted" style="margin-top:10px">Estas salas aparecerán en el desplegable de “Nuevo parte”.</p>
-    </div>
-    """
-    return page("Salas", body)
+    body = _SALAS_TPL.format(items=items)
+    return html_page("Salas", body)
 
 
-@app.post("/encargado/salas")
-def admin_salas_add(request: Request, sala: str = Form(...)):
-    r = require_login(request)
-    if r:
-        return r
-    u = user_from_session(request)
-    if u["rol"] not in ("ENCARGADO",):
-        return RedirectResponse(role_home_path(u["rol"]), status_code=303)
-
+@encargado_router.post("/salas")
+def admin_salas_add(sala: str = Form(...)):
     s = (sala or "").strip()
     if not s:
         return RedirectResponse("/encargado/salas", status_code=303)
 
-    db_exec("insert into public.wom_rooms (name) values (%s) on conflict (name) do nothing;", (s,))
+    # El NOTIFY se entrega al hacer commit: los workers que escuchan (DATABASE_DIRECT_URL) vacían su
+    # caché de salas; sin escucha, la ven al caducar el TTL.
+    db_exec(
+        f"insert into public.wom_rooms (name) values (%s) on conflict (name) do nothing; notify {SALAS_CHANNEL};",
+        (s,),
+    )
+    salas_cache_reset()
     return RedirectResponse("/encargado/salas", status_code=303)
 # =========================
 # ENCARGADO - Control de Horas
 # =========================
+# Plantilla de trabajadores para los formularios de horas, cacheada WORKERS_CACHE_TTL s.
+# Se vacía al crear/cambiar de rol/eliminar usuarios en este proceso; otros workers tardan como mucho el TTL.
+WORKERS_CACHE_TTL = 30  # segundos
+_workers_cache = None  # (caduca_en, trabajadores, html de <option>)
+
+
+def _workers_cached():
+    global _workers_cache
+    c = _workers_cache
+    now = time.monotonic()
+    if c is None or c[0] <= now:
+        rows = db_all(
+            "select code, name, role from public.wom_users where role in ('TRABAJADOR','TECNICO') order by name asc;"
+        )
+        workers = [{"code": r["code"], "name": r["name"], "role": r["role"]} for r in rows]
+        opts = "".join(f"<option value='{h(w['code'])}'>{h(w['name'])}</option>" for w in workers)
+        c = _workers_cache = (now + WORKERS_CACHE_TTL, workers, opts)
+    return c
+
+
 def _workers_for_hours() -> List[Dict[str, str]]:
-    rows = db_all(
-        "select code, name, role from public.wom_users where role in ('TRABAJADOR','TECNICO') order by name asc;"
-    )
-    return [{"code": r["code"], "name": r["name"], "role": r["role"]} for r in rows]
+    """Trabajadores y técnicos por nombre. La lista es compartida: no modificarla."""
+    return _workers_cached()[1]
+
+
+def workers_options_html(selected: str = "") -> str:
+    """<option> de _workers_for_hours(), cacheado con la lista; `selected` se marca sobre el HTML base."""
+    opts = _workers_cached()[2]
+    if selected:
+        v = f"value='{h(selected)}'"
+        opts = opts.replace(v, v + " selected", 1)
+    return opts
+
+
+def workers_cache_reset() -> None:
+    global _workers_cache
+    _workers_cache = None
 
 
-def _round_to_half_hours(hours: float) -> float:
-    if hours <= 0:
-        return 0.0
-    return math.floor(hours * 2 + 0.5) / 2.0
+# Horas de un registro cerrado, redondeadas a la media hora más cercana (la mitad sube), calculadas
+# en Postgres con aritmética entera sobre los segundos; NULL si falta la entrada o la salida.
+_SQL_HORAS_EXPR = (
+    "case when entry_at is not null and exit_at is not null then "
+    "(greatest((trunc(extract(epoch from exit_at - entry_at))::bigint + 900) / 1800, 0) / 2.0)::float8 "
+    "end"
+)
+SQL_HORAS_REDONDEADAS = f"{_SQL_HORAS_EXPR} as hrs"
+# Total del mes en la misma consulta (ventana sobre todas las filas), repetido en cada fila
+SQL_HORAS_TOTAL = f"coalesce(sum({_SQL_HORAS_EXPR}) over (), 0) as total"
+
+# Entrada/salida ya en hora de Madrid y formateadas por Postgres (sin astimezone por fila en Python).
+SQL_HORAS_FECHAS = (
+    "coalesce(to_char(entry_at at time zone 'Europe/Madrid', 'DD/MM/YYYY HH24:MI'), '??/??/???? ??:??') as entrada_txt, "
+    "coalesce(to_char(exit_at at time zone 'Europe/Madrid', 'DD/MM/YYYY HH24:MI'), '- -') as salida_txt"
+)
 
 
 def _parse_dt_local(dt_str: str) -> Optional[datetime]:
     s = (dt_str or "").strip()
     if not s:
         return None
+    # <input type="datetime-local"> envía siempre YYYY-MM-DDTHH:MM[:SS]: se lee por posiciones
+    n = len(s)
+    if (n == 16 or (n == 19 and s[16] == ":")) and s[4] == "-" and s[7] == "-" and s[10] == "T" and s[13] == ":":
+        dig = s[0:4] + s[5:7] + s[8:10] + s[11:13] + s[14:16] + (s[17:19] if n == 19 else "00")
+        if dig.isdigit() and dig.isascii():
+            try:
+                return datetime(int(s[0:4]), int(s[5:7]), int(s[8:10]), int(s[11:13]), int(s[14:16]),
+                                int(s[17:19]) if n == 19 else 0, tzinfo=TZ)
+            except ValueError:
+                return None
     try:
         dt = datetime.fromisoformat(s)
     except Exception:
@@ -2981,15 +3622,14 @@ def _parse_dt_local(dt_str: str) -> Optional[datetime]:
     return dt
 
 
-@app.get("/encargado/horas", response_class=HTMLResponse)
-def horas_menu(request: Request):
-    r = require_login(request)
-    if r:
-        return r
-    u = user_from_session(request)
-    if u.get("rol") != "ENCARGADO":
-        return RedirectResponse(role_home_path(u.get("rol", "")), status_code=303)
+@lru_cache(maxsize=64)
+def _horas_add_url(msg: str) -> str:
+    """URL de vuelta al formulario de horas con el aviso ya codificado (los avisos son literales fijos)."""
+    return "/encargado/horas/add?msg=" + urllib.parse.quote(msg)
 
+
+@encargado_router.get("/horas", response_class=HTMLResponse)
+def horas_menu():
     body = """
     <div class="top">
       <div><h2>Control de Horas</h2></div>
@@ -3004,22 +3644,13 @@ def horas_menu(request: Request):
       </div>
     </div>
     """
-    return page("Control de Horas", body)
+    return html_page("Control de Horas", body)
 
 
-@app.get("/encargado/horas/add", response_class=HTMLResponse)
+@encargado_router.get("/horas/add", response_class=HTMLResponse)
 def horas_add_form(request: Request):
-    r = require_login(request)
-    if r:
-        return r
-    u = user_from_session(request)
-    if u.get("rol") != "ENCARGADO":
-        return RedirectResponse(role_home_path(u.get("rol", "")), status_code=303)
-
-    workers = _workers_for_hours()
-    salas = get_salas()
-    w_opts = "".join([f"<option value='{h(w['code'])}'>{h(w['name'])}</option>" for w in workers])
-    s_opts = "".join([f"<option value='{h(s)}'>{h(s)}</option>" for s in salas])
+    w_opts = workers_options_html()
+    s_opts = salas_options_html()
 
     msg = (request.query_params.get("msg") or "").strip()
     msg_html = f"<div class='card' style='border-color:#ddd;background:#fafafa'><b>{h(msg)}</b></div>" if msg else ""
@@ -3062,66 +3693,68 @@ def horas_add_form(request: Request):
       </form>
     </div>
     """
-    return page("Añadir Entrada/Salida", body)
+    return html_page("Añadir Entrada/Salida", body)
 
 
-@app.post("/encargado/horas/add")
+@encargado_router.post("/horas/add")
 def horas_add_submit(
-    request: Request,
     worker_code: str = Form(...),
     room_name: str = Form(...),
     action: str = Form(...),
     entry_manual: str = Form(""),
     exit_manual: str = Form(""),
+    u: Dict[str, Any] = Depends(require_encargado),
 ):
-    r = require_login(request)
-    if r:
-        return r
-
-    u = user_from_session(request)
-    if (u or {}).get("rol") != "ENCARGADO":
-        return RedirectResponse(role_home_path((u or {}).get("rol", "")), status_code=303)
-
-    ucode = ((u or {}).get("codigo") or (u or {}).get("code") or (u or {}).get("user_code") or "").strip().upper()
-    uname = ((u or {}).get("nombre") or (u or {}).get("name") or (u or {}).get("user_name") or "").strip()
-    if not uname:
-        uname = ucode
+    # La sesión siempre se crea con get_user_by_code: "codigo" ya viene normalizado y "nombre" es el de wom_users
+    ucode = u["codigo"]
+    uname = (u["nombre"] or "").strip() or ucode
 
     # Validación: el encargado que registra debe existir en wom_users (FK)
     if not ucode:
         return RedirectResponse(
-            "/encargado/horas/add?msg=" + urllib.parse.quote("No se pudo identificar el código del encargado."),
+            _horas_add_url("No se pudo identificar el código del encargado."),
             status_code=303,
         )
-    chk = db_one("select 1 as x from public.wom_users where upper(code)=upper(%s) limit 1;", (ucode,))
-    if not chk:
+    wcode = norm_code(worker_code)
+    sala = (room_name or "").strip()
+
+    # Un solo round-trip: existe el encargado, nombre del trabajador y su registro abierto en la sala.
+    chk = db_one(
+        """
+        select exists(select 1 from public.wom_users where upper(code)=%s) as enc_ok,
+               w.name as wname, o.id as open_id, o.entry_at as open_entry
+        from (select 1) x
+        left join lateral (
+          select name from public.wom_users where upper(code)=%s limit 1
+        ) w on true
+        left join lateral (
+          select id, entry_at from public.wom_hours
+          where worker_code=%s and room_name=%s and exit_at is null
+          order by entry_at desc nulls last limit 1
+        ) o on true;
+        """,
+        (ucode, wcode, wcode, sala),
+    ) or {}
+    if not chk.get("enc_ok"):
         return RedirectResponse(
-            "/encargado/horas/add?msg=" + urllib.parse.quote("Tu usuario no existe en wom_users. Revisa el código del encargado."),
+            _horas_add_url("Tu usuario no existe en wom_users. Revisa el código del encargado."),
             status_code=303,
         )
-
-    wcode = (worker_code or "").strip().upper()
-    sala = (room_name or "").strip()
-
-    w = db_one("select code, name from public.wom_users where upper(code)=upper(%s) limit 1;", (wcode,))
-    if not w:
-        return RedirectResponse("/encargado/horas/add?msg=" + urllib.parse.quote("Trabajador no válido"), status_code=303)
+    if chk.get("wname") is None:
+        return RedirectResponse(_horas_add_url("Trabajador no válido"), status_code=303)
+    wname = chk["wname"]
+    open_row = {"id": chk["open_id"], "entry_at": chk["open_entry"]} if chk.get("open_id") is not None else None
 
     now = now_madrid()
 
-    open_row = db_one(
-        "select id, entry_at from public.wom_hours where worker_code=%s and room_name=%s and exit_at is null order by entry_at desc nulls last limit 1;",
-        (wcode, sala),
-    )
-
     def go(msg: str):
-        return RedirectResponse("/encargado/horas/add?msg=" + urllib.parse.quote(msg), status_code=303)
+        return RedirectResponse(_horas_add_url(msg), status_code=303)
 
     try:
         if action == "entrada_now":
             if open_row:
                 return go("Debe registrar la salida del trabajador primero.")
-            wom_hours_insert(wcode, w["name"], sala, now, None, ucode, uname)
+            wom_hours_insert(wcode, wname, sala, now, None, ucode, uname)
             return go("Entrada registrada correctamente.")
 
         if action == "salida_now":
@@ -3138,13 +3771,13 @@ def horas_add_submit(
                 return go("La salida no puede ser anterior a la entrada.")
 
             if en and ex:
-                wom_hours_insert(wcode, w["name"], sala, en, ex, ucode, uname)
+                wom_hours_insert(wcode, wname, sala, en, ex, ucode, uname)
                 return go("Registro manual (entrada y salida) guardado.")
 
             if en and not ex:
                 if open_row:
                     return go("Debe registrar la salida del trabajador primero.")
-                wom_hours_insert(wcode, w["name"], sala, en, None, ucode, uname)
+                wom_hours_insert(wcode, wname, sala, en, None, ucode, uname)
                 return go("Entrada manual registrada correctamente.")
 
             if ex and not en:
@@ -3152,7 +3785,9 @@ def horas_add_submit(
                     return go("Debe registrar la entrada del trabajador primero.")
                 entry_at = open_row.get("entry_at")
                 if entry_at:
-                    entry_at = entry_at.astimezone(TZ) if entry_at.tzinfo else entry_at.replace(tzinfo=TZ)
+                    # timestamptz llega ya con zona; comparar datetimes aware no necesita astimezone
+                    if entry_at.tzinfo is None:
+                        entry_at = entry_at.replace(tzinfo=TZ)
                     if ex < entry_at:
                         return go("La salida manual no puede ser anterior a la entrada registrada.")
                 wom_hours_set_exit(int(open_row["id"]), ex, ucode, uname)
@@ -3167,37 +3802,43 @@ def horas_add_submit(
         return go("Error al registrar: revisa logs o reintenta.")
 
 
+_HORAS_FILA_TPL = """
+        <tr>
+          <td>{sala}</td>
+          <td>{entrada}</td>
+          <td>{salida}</td>
+          <td>{hrs}</td>
+          <td>
+            <form method="post" action="/encargado/horas/delete/{id}{qs}" onsubmit="return confirm('¿Eliminar este registro?');">
+              <button class="btn2 danger" type="submit">Eliminar</button>
+            </form>
+          </td>
+        </tr>
+        """
+
 
-@app.get("/encargado/horas/consultar", response_class=HTMLResponse)
+@encargado_router.get("/horas/consultar", response_class=HTMLResponse)
 def horas_consultar_form(request: Request):
-    r = require_login(request)
-    if r:
-        return r
-    u = user_from_session(request)
-    if u.get("rol") != "ENCARGADO":
-        return RedirectResponse(role_home_path(u.get("rol", "")), status_code=303)
-
     workers = _workers_for_hours()
     now = now_madrid()
     mes = (request.query_params.get("mes") or str(now.month)).strip()
     anio = (request.query_params.get("anio") or str(now.year)).strip()
     worker_code = (request.query_params.get("worker_code") or (workers[0]["code"] if workers else "")).strip().upper()
 
-    w_opts = "".join([f"<option value='{h(w['code'])}' {'selected' if w['code']==worker_code else ''}>{h(w['name'])}</option>" for w in workers])
-    months_opts = "".join([f"<option value='{i}' {'selected' if str(i)==mes else ''}>{i:02d}</option>" for i in range(1, 13)])
+    w_opts = workers_options_html(worker_code)
+    months_opts = month_options_html(mes)
     years = [now.year - 1, now.year, now.year + 1]
-    years_opts = "".join([f"<option value='{y}' {'selected' if str(y)==anio else ''}>{y}</option>" for y in years])
+    years_opts = "".join(f"<option value='{y}' {'selected' if str(y)==anio else ''}>{y}</option>" for y in years)
 
     rows = []
-    total = 0.0
     error = ""
 
     try:
         mes_i = int(mes); anio_i = int(anio)
         ts_start, ts_end = month_bounds(anio_i, mes_i)
         rows = db_all(
-            """
-            select id, room_name, entry_at, exit_at
+            f"""
+            select id, room_name, {SQL_HORAS_FECHAS}, {SQL_HORAS_REDONDEADAS}, {SQL_HORAS_TOTAL}
             from public.wom_hours
             where worker_code=%s and entry_at >= %s and entry_at < %s
             order by entry_at asc nulls last;
@@ -3208,33 +3849,21 @@ def horas_consultar_form(request: Request):
         error = str(ex)
         rows = []
 
-    trs = ""
-    for rr in rows:
-        en_f, en_h = formatear_fecha_hora(rr.get("entry_at"))
-        ex_f, ex_h = (("-", "-") if not rr.get("exit_at") else formatear_fecha_hora(rr.get("exit_at")))
-        hrs_txt = "-"
-        if rr.get("entry_at") and rr.get("exit_at"):
-            dt_en = rr["entry_at"]; dt_ex = rr["exit_at"]
-            dt_en = dt_en.astimezone(TZ) if dt_en.tzinfo else dt_en.replace(tzinfo=TZ)
-            dt_ex = dt_ex.astimezone(TZ) if dt_ex.tzinfo else dt_ex.replace(tzinfo=TZ)
-            hours = (dt_ex - dt_en).total_seconds() / 3600.0
-            hrs = _round_to_half_hours(hours)
-            total += hrs
-            hrs_txt = f"{hrs:.1f}"
-        del_url = f"/encargado/horas/delete/{rr['id']}?worker_code={urllib.parse.quote(worker_code)}&mes={urllib.parse.quote(str(mes))}&anio={urllib.parse.quote(str(anio))}"
-        trs += f"""
-        <tr>
-          <td>{h(rr.get('room_name',''))}</td>
-          <td>{h(en_f)} {h(en_h)}</td>
-          <td>{h(ex_f)} {h(ex_h)}</td>
-          <td>{h(hrs_txt)}</td>
-          <td>
-            <form method="post" action="{del_url}" onsubmit="return confirm('¿Eliminar este registro?');">
-              <button class="btn2 danger" type="submit">Eliminar</button>
-            </form>
-          </td>
-        </tr>
-        """
+    del_qs = f"?worker_code={urllib.parse.quote(worker_code)}&mes={urllib.parse.quote(str(mes))}&anio={urllib.parse.quote(str(anio))}"
+    total = rows[0]["total"] if rows else 0.0
+
+    def fila(rr: Dict[str, Any]) -> str:
+        hrs = rr["hrs"]
+        return _HORAS_FILA_TPL.format(
+            sala=h(rr.get("room_name", "")),
+            entrada=rr["entrada_txt"],
+            salida=rr["salida_txt"],
+            hrs="-" if hrs is None else f"{hrs:.1f}",
+            id=rr["id"],
+            qs=del_qs,
+        )
+
+    trs = "".join(map(fila, rows))
 
     body = f"""
     <div class="top">
@@ -3277,18 +3906,11 @@ def horas_consultar_form(request: Request):
       <p><b>TOTAL:</b> {h(f"{total:.1f}")} horas</p>
     </div>
     """
-    return page("Consultar Horas", body)
+    return html_page("Consultar Horas", body)
 
 
-@app.post("/encargado/horas/delete/{hid}")
+@encargado_router.post("/horas/delete/{hid}")
 def horas_delete(request: Request, hid: int):
-    r = require_login(request)
-    if r:
-        return r
-    u = user_from_session(request)
-    if u.get("rol") != "ENCARGADO":
-        return RedirectResponse(role_home_path(u.get("rol", "")), status_code=303)
-
     db_exec("delete from public.wom_hours where id=%s;", (hid,))
     qs = str(request.url.query or "")
     back = "/encargado/horas/consultar"
@@ -3297,21 +3919,13 @@ def horas_delete(request: Request, hid: int):
     return RedirectResponse(back, status_code=303)
 
 
-@app.get("/encargado/horas/pdf", response_class=HTMLResponse)
-def horas_pdf_form(request: Request):
-    r = require_login(request)
-    if r:
-        return r
-    u = user_from_session(request)
-    if u.get("rol") != "ENCARGADO":
-        return RedirectResponse(role_home_path(u.get("rol", "")), status_code=303)
-
-    workers = _workers_for_hours()
+@encargado_router.get("/horas/pdf", response_class=HTMLResponse)
+def horas_pdf_form():
     now = now_madrid()
-    w_opts = "".join([f"<option value='{h(w['code'])}'>{h(w['name'])}</option>" for w in workers])
-    months_opts = "".join([f"<option value='{i}' {'selected' if i==now.month else ''}>{i:02d}</option>" for i in range(1, 13)])
+    w_opts = workers_options_html()
+    months_opts = _MONTH_OPTIONS[now.month]
     years = [now.year - 1, now.year, now.year + 1]
-    years_opts = "".join([f"<option value='{y}' {'selected' if y==now.year else ''}>{y}</option>" for y in years])
+    years_opts = "".join(f"<option value='{y}' {'selected' if y==now.year else ''}>{y}</option>" for y in years)
 
     body = f"""
     <div class="top">
@@ -3341,60 +3955,54 @@ def horas_pdf_form(request: Request):
       </form>
     </div>
     """
-    return page("PDF Horas", body)
+    return html_page("PDF Horas", body)
 
 
-def _query_horas(worker_code: str, year: int, month: int) -> List[Dict[str, Any]]:
+def _query_horas(worker_code: str, year: int, month: int) -> Tuple[Optional[str], List[Dict[str, Any]]]:
+    """(nombre del trabajador o None si no existe, registros del mes) en una sola consulta."""
     ts_start, ts_end = month_bounds(year, month)
-    return db_all(
-        """
-        select id, room_name, entry_at, exit_at
-        from public.wom_hours
-        where worker_code=%s and entry_at >= %s and entry_at < %s
-        order by entry_at asc nulls last;
+    rows = db_all(
+        f"""
+        select u.name as wname, h.id, h.room_name, {SQL_HORAS_FECHAS}, {SQL_HORAS_REDONDEADAS}, {SQL_HORAS_TOTAL}
+        from public.wom_users u
+        left join public.wom_hours h
+          on h.worker_code=%s and h.entry_at >= %s and h.entry_at < %s
+        where upper(u.code)=%s
+        order by h.entry_at asc nulls last;
         """,
-        (worker_code, ts_start, ts_end),
+        (worker_code, ts_start, ts_end, worker_code),
     )
+    if not rows:
+        return None, []
+    return rows[0]["wname"], [r for r in rows if r["id"] is not None]
 
 
-@app.post("/encargado/horas/pdf")
+@encargado_router.post("/horas/pdf")
 def horas_pdf_generate(
-    request: Request,
     worker_code: str = Form(...),
     mes: str = Form(...),
     anio: str = Form(...),
 ):
-    r = require_login(request)
-    if r:
-        return r
-    u = user_from_session(request)
-    if u.get("rol") != "ENCARGADO":
-        return RedirectResponse(role_home_path(u.get("rol", "")), status_code=303)
-
     try:
         m_i = int(mes); y_i = int(anio)
+        # Rango antes de _query_horas: month_bounds lanzaría ValueError (500) con mes 0/13 o año fuera de datetime
+        if not (1 <= m_i <= 12 and 1 <= y_i < 9999):
+            raise ValueError("Mes/Año fuera de rango")
     except Exception:
-        return HTMLResponse(page("Error", "<div class='card'><h3>Mes/Año inválido</h3></div>"), status_code=400)
-
-    wcode = (worker_code or "").strip().upper()
-    w = db_one("select code, name from public.wom_users where upper(code)=upper(%s) limit 1;", (wcode,))
-    if not w:
-        return HTMLResponse(page("Error", "<div class='card'><h3>Trabajador no válido</h3></div>"), status_code=400)
+        return html_page("Error", "<div class='card'><h3>Mes/Año inválido</h3></div>", status_code=400)
 
-    rows = _query_horas(wcode, y_i, m_i)
+    wcode = norm_code(worker_code)
+    wname, rows = _query_horas(wcode, y_i, m_i)
+    if wname is None:
+        return html_page("Error", "<div class='card'><h3>Trabajador no válido</h3></div>", status_code=400)
 
-    from reportlab.lib.pagesizes import A4
-    from reportlab.lib.units import mm
-    from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle
-    from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-    from reportlab.lib import colors
 
-    out_dir = Path.cwd()
     ts = now_madrid().strftime("%Y%m%d_%H%M%S")
-    out_path = out_dir / f"horas_{wcode}_{y_i}_{m_i:02d}_{ts}.pdf"
+    filename = f"horas_{wcode}_{y_i}_{m_i:02d}_{ts}.pdf"
 
+    buf = BytesIO()
     doc = SimpleDocTemplate(
-        str(out_path),
+        buf,
         pagesize=A4,
         leftMargin=12 * mm,
         rightMargin=12 * mm,
@@ -3403,55 +4011,41 @@ def horas_pdf_generate(
         title="Horas de trabajo de mantenimiento",
     )
 
-    styles = getSampleStyleSheet()
-    st_title = ParagraphStyle("t", parent=styles["Normal"], fontName="Helvetica-Bold", fontSize=16, leading=18)
-    st_mid = ParagraphStyle("m", parent=styles["Normal"], fontName="Helvetica", fontSize=11, leading=13)
+    st_title, st_mid = _ST_HORAS_TITLE, _ST_HORAS_MID
 
     story = []
     story.append(Paragraph("HORAS DE TRABAJO DE MANTENIMIENTO", st_title))
     story.append(Spacer(1, 10))
-    story.append(Paragraph(f"Trabajador: <b>{_xml_escape(w['name'])}</b>", st_mid))
+    story.append(Paragraph(f"Trabajador: <b>{_xml_escape(wname)}</b>", st_mid))
     story.append(Paragraph(f"Mes y año: <b>{m_i:02d}/{y_i}</b>", st_mid))
     story.append(Spacer(1, 6))
     story.append(Paragraph("<para><font color='#000000'>______________________________________________</font></para>", st_mid))
     story.append(Spacer(1, 10))
 
+    if not rows:
+        # Mes sin registros: no hay tabla que componer
+        story.append(Paragraph("Sin registros en este mes.", st_mid))
+        doc.build(story)
+        return pdf_response(buf.getvalue(), filename)
+
     data = [["Sala", "Entrada", "Salida", "NºHoras"]]
-    total = 0.0
     for rr in rows:
-        en_f, en_h = formatear_fecha_hora(rr.get("entry_at"))
-        ex_f, ex_h = (("-", "-") if not rr.get("exit_at") else formatear_fecha_hora(rr.get("exit_at")))
-        hrs_txt = "-"
-        if rr.get("entry_at") and rr.get("exit_at"):
-            dt_en = rr["entry_at"]; dt_ex = rr["exit_at"]
-            dt_en = dt_en.astimezone(TZ) if dt_en.tzinfo else dt_en.replace(tzinfo=TZ)
-            dt_ex = dt_ex.astimezone(TZ) if dt_ex.tzinfo else dt_ex.replace(tzinfo=TZ)
-            hours = (dt_ex - dt_en).total_seconds() / 3600.0
-            hrs = _round_to_half_hours(hours)
-            total += hrs
-            hrs_txt = f"{hrs:.1f}"
-        data.append([rr.get("room_name", ""), f"{en_f} {en_h}", f"{ex_f} {ex_h}", hrs_txt])
-
-    data.append(["", "", "TOTAL", f"{total:.1f}"])
+        hrs = rr["hrs"]
+        data.append([rr.get("room_name", ""), rr["entrada_txt"], rr["salida_txt"], "-" if hrs is None else f"{hrs:.1f}"])
+
+    data.append(["", "", "TOTAL", f"{rows[0]['total']:.1f}"])
 
     table = Table(data, colWidths=[55 * mm, 45 * mm, 45 * mm, 20 * mm])
-    table.setStyle(
-        TableStyle(
-            [
-                ("FONTNAME", (0, 0), (-1, -1), "Courier"),
-                ("FONTSIZE", (0, 0), (-1, -1), 8),
-                ("LINEBELOW", (0, 0), (-1, 0), 1, colors.black),
-                ("GRID", (0, 0), (-1, -1), 0.25, colors.grey),
-                ("BACKGROUND", (0, 0), (-1, 0), colors.whitesmoke),
-                ("FONTNAME", (0, 0), (-1, 0), "Courier-Bold"),
-                ("FONTNAME", (2, -1), (-1, -1), "Courier-Bold"),
-            ]
-        )
-    )
+    table.setStyle(_HORAS_TABLE_STYLE)
     story.append(table)
 
     doc.build(story)
-    return FileResponse(str(out_path), media_type="application/pdf", filename=out_path.name)
+    return pdf_response(buf.getvalue(), filename)
+
+
+app.include_router(encargado_router)
+
+
 # =========================
 # INVENTARIO DE ALMACÉN
 # =========================
@@ -3464,11 +4058,13 @@ INV_CATEGORIES = [
     ("Varios", "V"),
 ]
 
+INV_CAT_PREFIX = dict(INV_CATEGORIES)
+# <option> de categorías: fijo, se construye una vez; la seleccionada se marca al pedirlo
+INV_CATEGORY_OPTIONS_HTML = "".join(f'<option value="{h(name)}">{h(name)}</option>' for name, _ in INV_CATEGORIES)
+
+
 def inv_category_prefix(cat: str) -> str:
-    for name, pref in INV_CATEGORIES:
-        if name == cat:
-            return pref
-    return "V"
+    return INV_CAT_PREFIX.get(cat, "V")
 
 def ensure_inventory_schema() -> None:
     # Ubicaciones
@@ -3501,6 +4097,24 @@ def ensure_inventory_schema() -> None:
     )
     db_exec_safe("create index if not exists wom_inv_items_desc_idx on public.wom_inv_items (description);", label="inv_items_desc_idx")
     db_exec_safe("create index if not exists wom_inv_items_loc_idx on public.wom_inv_items (location_id);", label="inv_items_loc_idx")
+    # Consulta por ubicación (activos de una ubicación ordenados por descripción) y listado de todas:
+    # índice parcial que ya sale ordenado y cubre las columnas mostradas (index-only scan, sin sort)
+    db_exec_safe(
+        """
+        create index if not exists wom_inv_items_loc_active_desc_idx
+          on public.wom_inv_items (location_id, description)
+          include (id, code, stock, category)
+          where active = true;
+        """,
+        label="inv_items_loc_active_desc_idx",
+    )
+    # Búsqueda por trozos de descripción (inv_search_items): índice de trigramas sobre la descripción normalizada
+    db_exec_safe("create extension if not exists pg_trgm;", label="pg_trgm")
+    db_exec_safe(
+        "create index if not exists wom_inv_items_desc_trgm on public.wom_inv_items "
+        f"using gin ({_INV_DESC_NORM_SQL.format(col='description')} gin_trgm_ops);",
+        label="inv_items_desc_trgm",
+    )
 
     # Movimientos
     db_exec(
@@ -3516,26 +4130,53 @@ def ensure_inventory_schema() -> None:
         );
         '''
     )
-    db_exec_safe("create index if not exists wom_inv_moves_created_idx on public.wom_inv_moves (created_at);", label="inv_moves_created_idx")
+    # Listado y PDF de movimientos de un mes (más recientes primero): índice por (fecha, id) descendente,
+    # el mismo orden que la paginación keyset del listado, que cubre las columnas del movimiento.
+    # Sustituye a los antiguos índices sobre created_at solo.
+    db_exec_safe(
+        "create index if not exists wom_inv_moves_recent_id_idx on public.wom_inv_moves (created_at desc, id desc) "
+        "include (item_id, move_type, qty, user_name);",
+        label="inv_moves_recent_id_idx",
+    )
+    db_exec_safe("drop index if exists public.wom_inv_moves_recent_idx;", label="drop_inv_moves_recent_idx")
+    db_exec_safe("drop index if exists public.wom_inv_moves_created_idx;", label="drop_inv_moves_created_idx")
     db_exec_safe("create index if not exists wom_inv_moves_item_idx on public.wom_inv_moves (item_id);", label="inv_moves_item_idx")
 
-    # Seed ubicaciones Caja 1..20 si no hay ninguna
-    row = db_one("select count(*)::int as n from public.wom_inv_locations;")
-    n = int((row or {}).get("n") or 0)
-    if n == 0:
-        for i in range(1, 21):
-            db_exec_safe("insert into public.wom_inv_locations(name, active) values (%s, true);", (f"Caja {i}",), label=f"seed_loc_{i}")
+    # Secuencias de códigos por categoría. Se ponen al día con el mayor código existente, sin
+    # retroceder nunca (otro proceso puede estar ya usándolas).
+    for pref in sorted({p for _, p in INV_CATEGORIES} | {"V"}):
+        seq = _inv_code_seq(pref)
+        db_exec_safe(f"create sequence if not exists {seq};", label=f"inv_seq_{pref}")
+        db_exec_safe(
+            f"""
+            select setval('{seq}', m, true)
+            from (
+              select greatest(
+                coalesce(max(substring(code from '^{pref}-([0-9]+)$')::bigint), 0),
+                (select case when is_called then last_value else 0 end from {seq})
+              ) as m
+              from public.wom_inv_items
+            ) x
+            where m > 0;
+            """,
+            label=f"inv_seq_sync_{pref}",
+        )
 
+    # Seed ubicaciones Caja 1..20 si no hay ninguna (una sola sentencia: comprobación e inserción juntas)
+    db_exec_safe(
+        """
+        insert into public.wom_inv_locations(name, active)
+        select 'Caja ' || g, true
+        from generate_series(1, 20) as g
+        where not exists (select 1 from public.wom_inv_locations)
+        on conflict (name) do nothing;
+        """,
+        label="seed_locs",
+    )
 
-@app.get("/encargado/inventario", response_class=HTMLResponse)
-def inv_menu(request: Request):
-    r = require_login(request)
-    if r:
-        return r
-    u = user_from_session(request)
-    if u["rol"] not in ("ENCARGADO","TECNICO"):
-        return RedirectResponse(role_home_path(u["rol"]), status_code=303)
 
+@app.get("/encargado/inventario", response_class=HTMLResponse, dependencies=[Depends(require_inv_user)])
+def inv_menu():
     body = f"""
     <div class="top">
       <div><h2>Inventario de Almacén</h2></div>
@@ -3551,37 +4192,51 @@ def inv_menu(request: Request):
       </div>
     </div>
     """
-    return page("Inventario", body)
+    return html_page("Inventario", body)
+
+
+# <option> de las ubicaciones activas para los desplegables del inventario, ya renderizados y
+# cacheados INV_LOCS_CACHE_TTL s (la selección se marca después con un replace).
+# Se vacía al añadir/eliminar ubicaciones en este proceso; otros workers tardan como mucho el TTL.
+INV_LOCS_CACHE_TTL = 30  # segundos
+_inv_locs_cache = None  # (caduca_en, html de las opciones)
+
+
+def _inv_locs_options_html() -> str:
+    global _inv_locs_cache
+    c = _inv_locs_cache
+    now = time.monotonic()
+    if c is None or c[0] <= now:
+        locs = db_all("select id, name from public.wom_inv_locations where active=true order by name;")
+        opts = "".join(f'<option value="{int(l["id"])}">{h(l.get("name",""))}</option>' for l in locs)
+        c = _inv_locs_cache = (now + INV_LOCS_CACHE_TTL, opts)
+    return c[1]
+
+
+def inv_locs_cache_reset() -> None:
+    global _inv_locs_cache
+    _inv_locs_cache = None
 
 
 def inv_locations_options(selected_id: Optional[int] = None, include_all: bool = False) -> str:
-    locs = db_all("select id, name from public.wom_inv_locations where active=true order by name;")
-    opts = ""
+    opts = _inv_locs_options_html()
+    if selected_id is not None:
+        v = f'value="{int(selected_id)}"'
+        opts = opts.replace(v, v + " selected", 1)
     if include_all:
-        opts += f'<option value="ALL" {"selected" if selected_id is None else ""}>TODAS</option>'
-    for l in locs:
-        lid = int(l.get("id"))
-        sel = "selected" if selected_id == lid else ""
-        opts += f'<option value="{lid}" {sel}>{h(l.get("name",""))}</option>'
+        opts = f'<option value="ALL"{" selected" if selected_id is None else ""}>TODAS</option>' + opts
     return opts
 
 def inv_category_options(selected: Optional[str] = None) -> str:
-    opts = ""
-    for name, _ in INV_CATEGORIES:
-        sel = "selected" if selected == name else ""
-        opts += f'<option value="{h(name)}" {sel}>{h(name)}</option>'
+    opts = INV_CATEGORY_OPTIONS_HTML
+    if selected:
+        v = f'value="{h(selected)}"'
+        opts = opts.replace(v, v + " selected", 1)
     return opts
 
 
-@app.get("/encargado/inventario/add_item", response_class=HTMLResponse)
+@app.get("/encargado/inventario/add_item", response_class=HTMLResponse, dependencies=[Depends(require_inv_user)])
 def inv_add_item_form(request: Request):
-    r = require_login(request)
-    if r:
-        return r
-    u = user_from_session(request)
-    if u["rol"] not in ("ENCARGADO","TECNICO"):
-        return RedirectResponse(role_home_path(u["rol"]), status_code=303)
-
     msg = request.query_params.get("msg","")
 
     # URL de retorno para que el ajuste de stock vuelva a esta misma consulta
@@ -3626,55 +4281,76 @@ def inv_add_item_form(request: Request):
       </form>
     </div>
     """
-    return page("Añadir Artículo", body)
+    return html_page("Añadir Artículo", body)
 
 
-def inv_generate_next_code(category: str) -> str:
+def _inv_code_seq(pref: str) -> str:
+    """Secuencia de Postgres que numera los códigos de una categoría (E-0001, E-0002...)."""
+    return f"public.wom_inv_seq_{pref.lower()}"
+
+
+def inv_create_item(category: str, description: str, location_id: int, qty: int) -> str:
+    """Inserta el artículo numerándolo con nextval de la secuencia de su categoría y devuelve el código.
+    Una sola sentencia atómica: dos altas a la vez nunca reciben el mismo número."""
     pref = inv_category_prefix(category)
-    row = db_one("select code from public.wom_inv_items where code like %s order by code desc limit 1;", (f"{pref}-%",))
-    last = (row or {}).get("code") if row else None
-    n = 0
-    if last and isinstance(last, str) and "-" in last:
-        try:
-            n = int(last.split("-")[1])
-        except Exception:
-            n = 0
-    return f"{pref}-{n+1:04d}"
+    row = db_one(
+        """
+        insert into public.wom_inv_items(code, category, description, location_id, stock, active)
+        select %s || '-' || lpad(s.n::text, greatest(4, length(s.n::text)), '0'), %s, %s, %s, %s, true
+        from (select nextval(%s::regclass) as n) s
+        returning code;
+        """,
+        (pref, category, description, int(location_id), qty, _inv_code_seq(pref)),
+    )
+    return row["code"]
 
 
-@app.post("/encargado/inventario/add_item")
+def inv_bulk_insert_items(items: List[Tuple[str, str, int, int]], page_size: int = 1000) -> List[str]:
+    """Alta masiva de artículos (importaciones/migraciones) con execute_values: un INSERT por cada
+    page_size filas en vez de uno por artículo, todo en una transacción.
+    items: [(categoría, descripción, location_id, stock), ...]. Devuelve los códigos asignados;
+    se numeran con las mismas secuencias por categoría que inv_create_item."""
+    if not items:
+        return []
+    rows = [
+        (inv_category_prefix(cat), _inv_code_seq(inv_category_prefix(cat)), cat, desc, int(loc), max(int(st or 0), 0))
+        for cat, desc, loc, st in items
+    ]
+    with db_conn() as conn:
+        with conn.cursor() as cur:
+            out = execute_values(
+                cur,
+                """
+                insert into public.wom_inv_items(code, category, description, location_id, stock, active)
+                select v.pref || '-' || lpad(v.n::text, greatest(4, length(v.n::text)), '0'), v.cat, v.descr, v.loc, v.stock, true
+                from (
+                  select x.*, nextval(x.seq::regclass) as n
+                  from (values %s) as x(pref, seq, cat, descr, loc, stock)
+                ) v
+                returning code;
+                """,
+                rows,
+                template="(%s, %s, %s, %s, %s::bigint, %s::integer)",
+                page_size=page_size,
+                fetch=True,
+            )
+    return [r["code"] for r in out]
+
+
+@app.post("/encargado/inventario/add_item", dependencies=[Depends(require_inv_user)])
 def inv_add_item_submit(
-    request: Request,
     category: str = Form(...),
     location_id: int = Form(...),
     description: str = Form(...),
     qty: int = Form(...),
 ):
-    r = require_login(request)
-    if r:
-        return r
-    u = user_from_session(request)
-    if u["rol"] not in ("ENCARGADO","TECNICO"):
-        return RedirectResponse(role_home_path(u["rol"]), status_code=303)
-
     category = (category or "").strip()
     description = (description or "").strip()
     qty = int(qty or 0)
     if qty < 0:
         qty = 0
 
-    code = inv_generate_next_code(category)
-    try:
-        db_exec(
-            "insert into public.wom_inv_items(code, category, description, location_id, stock, active) values (%s,%s,%s,%s,%s,true);",
-            (code, category, description, int(location_id), qty),
-        )
-    except Exception:
-        code = inv_generate_next_code(category)
-        db_exec(
-            "insert into public.wom_inv_items(code, category, description, location_id, stock, active) values (%s,%s,%s,%s,%s,true);",
-            (code, category, description, int(location_id), qty),
-        )
+    code = inv_create_item(category, description, location_id, qty)
 
     return RedirectResponse(f"/encargado/inventario/add_item?msg=Articulo%20creado%20correctamente%20con%20código%20{code}", status_code=303)
 
@@ -3694,23 +4370,34 @@ def _inv_tokens(q: str) -> list[str]:
         return []
     return [t for t in re.split(r"\s+", qn) if t]
 
-def _inv_match(description: str, q: str) -> bool:
-    tokens = _inv_tokens(q)
-    if not tokens:
-        return True
-    dn = _inv_norm_text(description)
-    return all(t in dn for t in tokens)
+# Descripción en minúsculas y sin tildes, calculada en Postgres igual que _inv_norm_text para el español.
+# La misma expresión respalda el índice GIN de trigramas (wom_inv_items_desc_trgm), así que los
+# "like '%trozo%'" de la búsqueda no recorren la tabla entera.
+_INV_DESC_NORM_SQL = (
+    "translate(lower({col}), 'áàâäãéèêëíìîïóòôöõúùûüñç', 'aaaaaeeeeiiiiooooouuuunc')"
+)
+
+
+def _like_escape(s: str) -> str:
+    return s.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
 
 def inv_search_items(q: str, include_inactive: bool = False, limit: int = 500) -> List[Dict[str, Any]]:
     """Búsqueda por descripción:
     - Insensible a mayúsculas/minúsculas.
     - Insensible a acentos (Botón == Boton).
     - Permite buscar por partes y en cualquier orden (ej: "bot azu").
+    El filtrado se hace en Postgres (un like por trozo sobre la descripción normalizada).
     """
-    q = (q or "").strip()
-
-    where = "" if include_inactive else "WHERE i.active = true"
-    rows = db_all(
+    conds = [] if include_inactive else ["i.active = true"]
+    params: List[Any] = []
+    desc_norm = _INV_DESC_NORM_SQL.format(col="i.description")
+    for t in _inv_tokens(q):
+        conds.append(f"{desc_norm} like %s")
+        params.append(f"%{_like_escape(t)}%")
+    where = ("where " + " and ".join(conds)) if conds else ""
+    params.append(int(limit))
+    return db_all(
         f"""
         select
             i.id,i.code,i.description,i.category,i.stock,i.active,
@@ -3719,30 +4406,23 @@ def inv_search_items(q: str, include_inactive: bool = False, limit: int = 500) -
         left join public.wom_inv_locations l on l.id=i.location_id
         {where}
         order by i.description asc, i.code asc
-        limit 2000;
-        """
+        limit %s;
+        """,
+        tuple(params),
     )
 
-    if not q:
-        return rows[:int(limit)]
+_INV_RESULTADO_LI_TPL = "<li><a href='{href}{iid}'>{desc}</a> ({code})</li>"
 
-    out: List[Dict[str, Any]] = []
-    for r in rows:
-        if _inv_match(r.get("description",""), q):
-            out.append(r)
-            if len(out) >= int(limit):
-                break
-    return out
 
-@app.get("/encargado/inventario/mov", response_class=HTMLResponse)
-def inv_mov_form(request: Request):
-    r = require_login(request)
-    if r:
-        return r
-    u = user_from_session(request)
-    if u["rol"] not in ("ENCARGADO","TECNICO"):
-        return RedirectResponse(role_home_path(u["rol"]), status_code=303)
+def _inv_resultados_html(results: List[Dict[str, Any]], href: str, _h=h) -> str:
+    """Tarjeta de resultados de inv_search_items; cada uno enlaza a href + id."""
+    return "<div class='card'><b>Resultados:</b><ul>" + "".join(
+        _INV_RESULTADO_LI_TPL.format(href=href, iid=int(it["id"]), desc=_h(it.get("description")), code=_h(it.get("code")))
+        for it in results
+    ) + "</ul></div>"
 
+@app.get("/encargado/inventario/mov", response_class=HTMLResponse, dependencies=[Depends(require_inv_user)])
+def inv_mov_form(request: Request):
     q = request.query_params.get("q","")
     item_id = request.query_params.get("item_id","")
     msg = request.query_params.get("msg","")
@@ -3757,10 +4437,7 @@ def inv_mov_form(request: Request):
 
     res_html = ""
     if results:
-        res_html += "<div class='card'><b>Resultados:</b><ul>"
-        for it in results:
-            res_html += f"<li><a href='/encargado/inventario/mov?item_id={int(it['id'])}'>{h(it.get('description',''))}</a> ({h(it.get('code',''))})</li>"
-        res_html += "</ul></div>"
+        res_html = _inv_resultados_html(results, "/encargado/inventario/mov?item_id=")
 
     item_block = ""
     if item:
@@ -3813,88 +4490,147 @@ def inv_mov_form(request: Request):
     {res_html}
     {item_block}
     """
-    return page("Movimientos", body)
+    return html_page("Movimientos", body)
+
+
+INV_MSG_NO_ENCONTRADO = "Artículo no encontrado"
+INV_MSG_SIN_STOCK = "No hay stock suficiente"
+
+# Movimiento de stock en una sola sentencia: el UPDATE bloquea la fila y vuelve a comprobar la condición
+# de stock; el INSERT del movimiento solo ocurre si el UPDATE tocó la fila.
+_SQL_INV_MOVE = {
+    solo_activos: f"""
+    with upd as (
+      update public.wom_inv_items
+         set stock = stock + %s, updated_at = now()
+       where id = %s{" and active = true" if solo_activos else ""} and (%s > 0 or stock + %s >= 0)
+       returning id
+    )
+    insert into public.wom_inv_moves(item_id, move_type, qty, user_code, user_name)
+    select id, %s, %s, %s, %s from upd
+    returning item_id;
+    """
+    for solo_activos in (False, True)
+}
+
+
+def inv_apply_move(item_id: int, move_type: str, qty: int, user_code: Optional[str], user_name: Optional[str],
+                   solo_activos: bool = False) -> Optional[str]:
+    """Aplica una ENTRADA/SALIDA de qty unidades y registra el movimiento.
+    Devuelve None si se aplicó, o INV_MSG_NO_ENCONTRADO / INV_MSG_SIN_STOCK si no."""
+    delta = qty if move_type == "ENTRADA" else -qty
+    row = db_one(_SQL_INV_MOVE[solo_activos], (delta, item_id, delta, delta, move_type, qty, user_code, user_name))
+    if row:
+        return None
+    # Solo en el caso de error: distinguir artículo inexistente de stock insuficiente
+    existe = db_one(
+        "select 1 as ok from public.wom_inv_items where id=%s" + (" and active=true;" if solo_activos else ";"),
+        (item_id,),
+    )
+    return INV_MSG_SIN_STOCK if existe else INV_MSG_NO_ENCONTRADO
 
 
 @app.post("/encargado/inventario/mov")
 def inv_mov_submit(
-    request: Request,
     item_id: int = Form(...),
     move_type: str = Form(...),
     qty: int = Form(...),
+    u: Dict[str, Any] = Depends(require_inv_user),
 ):
-    r = require_login(request)
-    if r:
-        return r
-    u = user_from_session(request)
-    if u["rol"] not in ("ENCARGADO","TECNICO"):
-        return RedirectResponse(role_home_path(u["rol"]), status_code=303)
-
     move_type = (move_type or "").strip().upper()
     qty = int(qty or 0)
     if move_type not in ("ENTRADA","SALIDA") or qty <= 0:
         return RedirectResponse("/encargado/inventario/mov?msg=Datos%20no%20válidos", status_code=303)
 
-    conn = db_conn()
     try:
-        with conn:
-            with conn.cursor(cursor_factory=RealDictCursor) as cur:
-                cur.execute("select id, stock from public.wom_inv_items where id=%s for update;", (int(item_id),))
-                row = cur.fetchone()
-                if not row:
-                    raise Exception("Artículo no encontrado")
-                stock = int(row.get("stock") or 0)
-                if move_type == "SALIDA" and stock - qty < 0:
-                    raise Exception("No hay stock suficiente")
-
-                new_stock = stock + qty if move_type == "ENTRADA" else stock - qty
-                cur.execute("update public.wom_inv_items set stock=%s, updated_at=now() where id=%s;", (new_stock, int(item_id)))
-                ucode = (u.get("codigo") or "").strip().upper()
-                uname = (u.get("nombre") or "").strip()
-                cur.execute(
-                    "insert into public.wom_inv_moves(item_id, move_type, qty, user_code, user_name) values (%s,%s,%s,%s,%s);",
-                    (int(item_id), move_type, qty, ucode, uname),
-                )
+        err = inv_apply_move(int(item_id), move_type, qty, u["codigo"], (u.get("nombre") or "").strip())
+        if err:
+            raise Exception(err)
         return RedirectResponse(f"/encargado/inventario/mov?item_id={int(item_id)}&msg=Movimiento%20registrado", status_code=303)
     except Exception as e:
-        return RedirectResponse(f"/encargado/inventario/mov?item_id={int(item_id)}&msg={quote(str(e))}", status_code=303)
-    finally:
-        try:
-            conn.close()
-        except Exception:
-            pass
+        return RedirectResponse(f"/encargado/inventario/mov?item_id={int(item_id)}&msg={urllib.parse.quote(str(e))}", status_code=303)
 
 
 
 
-def _inv_adjust_form(item_id: int, next_url: str) -> str:
-    nu = (next_url or "/encargado/inventario/consulta").strip()
-    if not nu.startswith("/"):
-        nu = "/encargado/inventario/consulta"
-    return f"""
+_INV_ADJUST_FORM_TPL = """
     <form method='post' action='/inventario/adjust' style='display:inline-flex;gap:6px;align-items:center;margin-left:8px'>
-      <input type='hidden' name='item_id' value='{int(item_id)}' />
-      <input type='hidden' name='next_url' value='{h(nu)}' />
+      <input type='hidden' name='item_id' value='{iid}' />
+      <input type='hidden' name='next_url' value='{nu}' />
       <input name='delta' type='number' step='1' style='width:80px' placeholder='+/-' />
       <button class='btn2' type='submit'>Ajustar</button>
     </form>
     """
 
 
+def _inv_adjust_nu(next_url: str) -> str:
+    """next_url validado y ya escapado para el formulario de ajuste (una vez por página, no por fila)."""
+    nu = (next_url or "/encargado/inventario/consulta").strip()
+    if not nu.startswith("/"):
+        nu = "/encargado/inventario/consulta"
+    return h(nu)
+
+
+# Filas de la consulta de inventario; en rojo los artículos sin stock
+_INV_STOCK0 = " style='color:#c00'"
+_INV_CONSULTA_LI_TPL = "<li{style0}><b>{desc}</b> ({code}) — Stock: <b>{st}</b>{form} — {loc}</li>"
+_INV_CONSULTA_TR_TPL = "<tr{style0}><td>{code}</td><td>{desc}</td><td style='text-align:right'>{st}{form}</td></tr>"
+_INV_CONSULTA_TR_LOC_TPL = "<tr{style0}><td>{loc}</td><td>{code}</td><td>{desc}</td><td style='text-align:right'>{st}</td></tr>"
+
+
+def _inv_consulta_li(it: Dict[str, Any], nu: str, _h=h) -> str:
+    st = int(it.get('stock') or 0)
+    return _INV_CONSULTA_LI_TPL.format(
+        style0=_INV_STOCK0 if st == 0 else "",
+        desc=_h(it.get('description')),
+        code=_h(it.get('code')),
+        st=st,
+        form=_INV_ADJUST_FORM_TPL.format(iid=int(it.get('id') or 0), nu=nu),
+        loc=_h(it.get('location')),
+    )
+
+
+# Consultas por ubicación: filas como tuplas (NamedTupleCursor) que se desempaquetan por posición.
+# La de una ubicación sale entera del índice wom_inv_items_loc_active_desc_idx (index-only scan).
+_SQL_INV_CONSULTA_UBICACION = (
+    "select i.id, i.code, i.description, i.stock from public.wom_inv_items i "
+    "where i.active=true and i.location_id=%s order by i.description;"
+)
+# La de TODAS se corta en INV_CONSULTA_TODAS_MAX filas y trae en cada fila el total sin cortar
+# (count(*) over (), en la misma pasada): el listado completo está en el PDF.
+INV_CONSULTA_TODAS_MAX = 500
+_SQL_INV_CONSULTA_TODAS = (
+    "select l.name, i.code, i.description, i.stock, count(*) over () as total from public.wom_inv_items i "
+    "join public.wom_inv_locations l on l.id=i.location_id where i.active=true order by l.name, i.description "
+    "limit %s;"
+)
+
+
+def _inv_consulta_tr(it: Tuple[Any, ...], nu: str, _h=h) -> str:
+    iid, code, desc, st = it
+    st = st or 0
+    return _INV_CONSULTA_TR_TPL.format(
+        style0=_INV_STOCK0 if st == 0 else "",
+        code=_h(code),
+        desc=_h(desc),
+        st=st,
+        form=_INV_ADJUST_FORM_TPL.format(iid=iid, nu=nu),
+    )
+
+
+def _inv_consulta_tr_loc(it: Tuple[Any, ...], _h=h, _hr=h_repetido) -> str:
+    lname, code, desc, st, _total = it
+    st = st or 0
+    return _INV_CONSULTA_TR_LOC_TPL.format(style0=_INV_STOCK0 if st == 0 else "", loc=_hr(lname), code=_h(code), desc=_h(desc), st=st)
+
+
 @app.post("/inventario/adjust")
 def inv_adjust_submit(
-    request: Request,
     item_id: int = Form(...),
     delta: int = Form(...),
     next_url: str = Form("/encargado/inventario/consulta"),
+    u: Dict[str, Any] = Depends(require_inv_ajuste),
 ):
-    r = require_login(request)
-    if r:
-        return r
-    u = user_from_session(request)
-    if u.get("rol") not in ("ENCARGADO","TECNICO","JEFE"):
-        return RedirectResponse(role_home_path(u.get("rol","")), status_code=303)
-
     try:
         delta_i = int(delta)
     except Exception:
@@ -3909,86 +4645,20 @@ def inv_adjust_submit(
     move_type = "ENTRADA" if delta_i > 0 else "SALIDA"
     qty = abs(delta_i)
 
-    with db_conn() as conn:
-        with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute(
-                "select id, stock from public.wom_inv_items where id=%s and active=true for update;",
-                (int(item_id),),
-            )
-            row = cur.fetchone()
-            if not row:
-                nu = (next_url or "/encargado/inventario/consulta").strip()
-                if not nu.startswith("/"):
-                    nu = "/encargado/inventario/consulta"
-                sep = "&" if "?" in nu else "?"
-                return RedirectResponse(f"{nu}{sep}msg=Artículo%20no%20encontrado", status_code=303)
-
-            stock = int(row.get("stock") or 0)
-            new_stock = stock + qty if move_type == "ENTRADA" else stock - qty
-            if new_stock < 0:
-                nu = (next_url or "/encargado/inventario/consulta").strip()
-                if not nu.startswith("/"):
-                    nu = "/encargado/inventario/consulta"
-                sep = "&" if "?" in nu else "?"
-                return RedirectResponse(f"{nu}{sep}msg=Stock%20insuficiente", status_code=303)
-
-            cur.execute("update public.wom_inv_items set stock=%s, updated_at=now() where id=%s;", (new_stock, int(item_id)))
-            cur.execute(
-                "insert into public.wom_inv_moves (item_id, move_type, qty, user_code, user_name) values (%s,%s,%s,%s,%s);",
-                (int(item_id), move_type, int(qty), u.get("codigo"), u.get("nombre")),
-            )
+    err = inv_apply_move(int(item_id), move_type, qty, u.get("codigo"), u.get("nombre"), solo_activos=True)
 
     nu = (next_url or "/encargado/inventario/consulta").strip()
     if not nu.startswith("/"):
         nu = "/encargado/inventario/consulta"
     sep = "&" if "?" in nu else "?"
+    if err == INV_MSG_NO_ENCONTRADO:
+        return RedirectResponse(f"{nu}{sep}msg=Artículo%20no%20encontrado", status_code=303)
+    if err:
+        return RedirectResponse(f"{nu}{sep}msg=Stock%20insuficiente", status_code=303)
     return RedirectResponse(f"{nu}{sep}msg=Stock%20actualizado", status_code=303)
 
-@app.get("/encargado/inventario/consulta", response_class=HTMLResponse)
-def inv_consulta(request: Request):
-    r = require_login(request)
-    if r:
-        return r
-    u = user_from_session(request)
-    if u["rol"] not in ("ENCARGADO","TECNICO"):
-        return RedirectResponse(role_home_path(u["rol"]), status_code=303)
-
-    mode = request.query_params.get("mode","articulo")
-    q = request.query_params.get("q","")
-    loc = request.query_params.get("loc","")
-    msg = request.query_params.get("msg","")
-
-    # URL de retorno para que el ajuste de stock vuelva a esta misma consulta
-    next_url = request.url.path
-    if request.url.query:
-        next_url = f"{next_url}?{request.url.query}"
-
-    content = ""
-    if mode == "articulo" and q:
-        res = inv_search_items(q)
-        if not res:
-            content = "<div class='card'>No se encontraron artículos.</div>"
-        else:
-            lis = ""
-            for it in res:
-                st = int(it.get('stock') or 0)
-                style0 = " style='color:#c00'" if st == 0 else ""
-                lis += f"<li{style0}><b>{h(it.get('description',''))}</b> ({h(it.get('code',''))}) — Stock: <b>{st}</b>{_inv_adjust_form(int(it.get('id') or 0), next_url)} — {h(it.get('location',''))}</li>"
-            content = f"<div class='card'><ul>{lis}</ul></div>"
-    elif mode == "ubicacion" and loc and loc != "ALL":
-        rows = db_all(
-            "select i.id,i.code,i.description,i.category,i.stock,l.name as location from public.wom_inv_items i join public.wom_inv_locations l on l.id=i.location_id where i.active=true and l.id=%s order by i.description;",
-            (int(loc),),
-        )
-        if not rows:
-            content = "<div class='card'>No hay artículos en esa ubicación.</div>"
-        else:
-            trs = ""
-            for it in rows:
-                st = int(it.get('stock') or 0)
-                tr_style0 = " style='color:#c00'" if st == 0 else ""
-                trs += f"<tr{tr_style0}><td>{h(it.get('code',''))}</td><td>{h(it.get('description',''))}</td><td style='text-align:right'>{st}{_inv_adjust_form(int(it.get('id') or 0), next_url)}</td></tr>"
-            content = f"""
+# Plantillas de la consulta de inventario (str.format; los valores llegan ya escapados con h())
+_INV_TABLA_UBICACION_TPL = """
             <div class="card">
               <table>
                 <thead><tr><th>Código</th><th>Artículo</th><th style='text-align:right'>Stock</th></tr></thead>
@@ -3996,19 +4666,8 @@ def inv_consulta(request: Request):
               </table>
             </div>
             """
-    elif mode == "ubicacion" and loc == "ALL":
-        rows = db_all(
-            "select l.name as location, i.code,i.description,i.stock from public.wom_inv_items i join public.wom_inv_locations l on l.id=i.location_id where i.active=true order by l.name, i.description;",
-        )
-        if not rows:
-            content = "<div class='card'>No hay artículos.</div>"
-        else:
-            trs = ""
-            for it in rows:
-                st = int(it.get('stock') or 0)
-                tr_style0 = " style='color:#c00'" if st == 0 else ""
-                trs += f"<tr{tr_style0}><td>{h(it.get('location',''))}</td><td>{h(it.get('code',''))}</td><td>{h(it.get('description',''))}</td><td style='text-align:right'>{st}</td></tr>"
-            content = f"""
+
+_INV_TABLA_TODAS_TPL = """
             <div class="card">
               <table>
                 <thead><tr><th>Ubicación</th><th>Código</th><th>Artículo</th><th style='text-align:right'>Stock</th></tr></thead>
@@ -4017,16 +4676,17 @@ def inv_consulta(request: Request):
             </div>
             """
 
-    pdf_btn = ""
-    if mode == "ubicacion" and loc:
-        pdf_btn = f"<a class='btn2' style='margin-left:8px' href='/encargado/inventario/consulta_pdf?loc={h(loc)}'>Generar PDF por ubicación</a>"
+_INV_AVISO_TODAS = (
+    f"<div class='card'><p class='warn'>Mostrando los primeros {INV_CONSULTA_TODAS_MAX} de {{total}} artículos: "
+    "elige una ubicación o descarga el PDF para verlos todos.</p></div>"
+)
 
-    body = f"""
+_INV_CONSULTA_TPL = """
     <div class="top">
       <div><h2>Consulta de Inventario</h2></div>
       <div><a class="btn2" href="/encargado/inventario">Volver</a></div>
     </div>
-    {f"<div class='msg ok'>{h(msg)}</div>" if msg else ""}
+    {msg}
 
     <div class="card">
       <div class="row" style="gap:10px; flex-wrap:wrap;">
@@ -4035,9 +4695,9 @@ def inv_consulta(request: Request):
       </div>
       <hr/>
       <form method="get" action="/encargado/inventario/consulta">
-        <input type="hidden" name="mode" value="{h(mode)}"/>
-        {"<label>Buscar por descripción</label><input name='q' value='"+h(q)+"'/>" if mode=="articulo" else ""}
-        {"<label>Ubicación</label><select name='loc'>"+inv_locations_options(int(loc) if loc and loc.isdigit() else None, include_all=True)+"</select>" if mode=="ubicacion" else ""}
+        <input type="hidden" name="mode" value="{mode}"/>
+        {q_field}
+        {loc_field}
         <div style="margin-top:10px;">
           <button class="btn" type="submit">Consultar</button>
           {pdf_btn}
@@ -4045,36 +4705,90 @@ def inv_consulta(request: Request):
       </form>
     </div>
 
-    {content}
-    """
-    return page("Consulta Inventario", body)
+    {content}
+    """
+
+
+@app.get("/encargado/inventario/consulta", response_class=HTMLResponse, dependencies=[Depends(require_inv_user)])
+def inv_consulta(request: Request):
+    mode = request.query_params.get("mode","articulo")
+    q = request.query_params.get("q","")
+    loc = request.query_params.get("loc","")
+    msg = request.query_params.get("msg","")
+
+    # URL de retorno para que el ajuste de stock vuelva a esta misma consulta
+    next_url = request.url.path
+    if request.url.query:
+        next_url = f"{next_url}?{request.url.query}"
+
+    content = ""
+    if mode == "articulo" and q:
+        res = inv_search_items(q)
+        if not res:
+            content = "<div class='card'>No se encontraron artículos.</div>"
+        else:
+            nu = _inv_adjust_nu(next_url)
+            lis = "".join(_inv_consulta_li(it, nu) for it in res)
+            content = f"<div class='card'><ul>{lis}</ul></div>"
+    elif mode == "ubicacion" and loc and loc != "ALL":
+        rows = db_all(_SQL_INV_CONSULTA_UBICACION, (int(loc),), cursor_factory=NamedTupleCursor)
+        if not rows:
+            content = "<div class='card'>No hay artículos en esa ubicación.</div>"
+        else:
+            nu = _inv_adjust_nu(next_url)
+            trs = "".join(_inv_consulta_tr(it, nu) for it in rows)
+            content = _INV_TABLA_UBICACION_TPL.format(trs=trs)
+    elif mode == "ubicacion" and loc == "ALL":
+        rows = db_all(_SQL_INV_CONSULTA_TODAS, (INV_CONSULTA_TODAS_MAX,), cursor_factory=NamedTupleCursor)
+        if not rows:
+            content = "<div class='card'>No hay artículos.</div>"
+        else:
+            total = rows[0].total
+            aviso = _INV_AVISO_TODAS.format(total=total) if total > len(rows) else ""
+            trs = "".join(map(_inv_consulta_tr_loc, rows))
+            content = aviso + _INV_TABLA_TODAS_TPL.format(trs=trs)
+
+    pdf_btn = ""
+    if mode == "ubicacion" and loc:
+        pdf_btn = f"<a class='btn2' style='margin-left:8px' href='/encargado/inventario/consulta_pdf?loc={h(loc)}'>Generar PDF por ubicación</a>"
 
+    body = _INV_CONSULTA_TPL.format(
+        msg=f"<div class='msg ok'>{h(msg)}</div>" if msg else "",
+        mode=h(mode),
+        q_field=f"<label>Buscar por descripción</label><input name='q' value='{h(q)}'/>" if mode == "articulo" else "",
+        loc_field=(
+            "<label>Ubicación</label><select name='loc'>"
+            + inv_locations_options(int(loc) if loc and loc.isdigit() else None, include_all=True)
+            + "</select>"
+        ) if mode == "ubicacion" else "",
+        pdf_btn=pdf_btn,
+        content=content,
+    )
+    return html_page("Consulta Inventario", body)
 
-@app.get("/encargado/inventario/consulta_pdf")
-def inv_consulta_pdf(request: Request, loc: str = "ALL"):
-    r = require_login(request)
-    if r:
-        return r
-    u = user_from_session(request)
-    if u["rol"] not in ("ENCARGADO","TECNICO"):
-        return RedirectResponse(role_home_path(u["rol"]), status_code=303)
 
+@app.get("/encargado/inventario/consulta_pdf", dependencies=[Depends(require_inv_user)])
+def inv_consulta_pdf(loc: str = "ALL"):
+    loc_id = int(loc) if loc and loc != "ALL" else None
+    # Exportación completa sin paginar: una sola consulta (el nombre de la ubicación viene en cada fila)
+    # leída por lotes con cursor de servidor. Las ubicaciones sin artículos dan una fila con code NULL.
+    rows = db_iter(
+        """
+        select l.name, i.code, i.description, i.stock
+        from public.wom_inv_locations l
+        left join public.wom_inv_items i on i.location_id = l.id and i.active = true
+        where %s::bigint is null or l.id = %s
+        order by l.name, i.description;
+        """,
+        (loc_id, loc_id),
+        cursor_factory=NamedTupleCursor,
+        itersize=1000,
+    )
     loc_name = "TODAS"
-    if loc and loc != "ALL":
-        loc_row = db_one("select name from public.wom_inv_locations where id=%s;", (int(loc),))
-        loc_name = (loc_row or {}).get("name") or "Ubicación"
-        rows = db_all(
-            "select code, description, stock from public.wom_inv_items where active=true and location_id=%s order by description;",
-            (int(loc),),
-        )
-    else:
-        rows = db_all(
-            "select l.name as location, i.code,i.description,i.stock from public.wom_inv_items i join public.wom_inv_locations l on l.id=i.location_id where i.active=true order by l.name, i.description;",
-        )
-
-    from reportlab.lib.pagesizes import A4
-    from reportlab.pdfgen import canvas
-    from reportlab.lib.units import mm
+    if loc_id is not None:
+        first = next(rows, None)
+        loc_name = (first.name if first else None) or "Ubicación"
+        rows = chain((first,) if first else (), rows)
 
     buf = BytesIO()
     c = canvas.Canvas(buf, pagesize=A4)
@@ -4092,38 +4806,40 @@ def inv_consulta_pdf(request: Request, loc: str = "ALL"):
 
     c.setFont("Courier", 8)
 
-    if loc and loc != "ALL":
-        c.drawString(20*mm, y, "CÓDIGO     STOCK   ARTÍCULO")
-        y -= 5*mm
-        c.line(20*mm, y, w-20*mm, y)
-        y -= 5*mm
-        for it in rows:
-            st = int(it.get('stock') or 0)
-            if st == 0: c.setFillColorRGB(0.8, 0.0, 0.0)
-            else: c.setFillColorRGB(0.0, 0.0, 0.0)
-            line = f"{(it.get('code') or ''):10} {(st):5}  {(it.get('description') or '')}"
-            c.drawString(20*mm, y, line[:110])
-            y -= 4*mm
-            if y < 20*mm:
-                c.showPage()
-                y = hhh - 20*mm
-                c.setFont("Courier", 8)
-    else:
-        c.drawString(20*mm, y, "UBICACIÓN           CÓDIGO     STOCK   ARTÍCULO")
-        y -= 5*mm
-        c.line(20*mm, y, w-20*mm, y)
-        y -= 5*mm
-        for it in rows:
-            st = int(it.get('stock') or 0)
-            if st == 0: c.setFillColorRGB(0.8, 0.0, 0.0)
-            else: c.setFillColorRGB(0.0, 0.0, 0.0)
-            line = f"{(it.get('location') or ''):18} {(it.get('code') or ''):10} {(st):5}  {(it.get('description') or '')}"
-            c.drawString(20*mm, y, line[:110])
-            y -= 4*mm
-            if y < 20*mm:
-                c.showPage()
-                y = hhh - 20*mm
-                c.setFont("Courier", 8)
+    por_ubicacion = loc_id is not None
+    c.drawString(20*mm, y, "CÓDIGO     STOCK   ARTÍCULO" if por_ubicacion else "UBICACIÓN           CÓDIGO     STOCK   ARTÍCULO")
+    y -= 5*mm
+    c.line(20*mm, y, w-20*mm, y)
+    y -= 5*mm
+
+    # Un objeto de texto por página en vez de un drawString por fila; el color solo se emite al cambiar
+    def nuevo_texto(y0):
+        t = c.beginText(20*mm, y0)
+        t.setFont("Courier", 8)
+        t.setLeading(4*mm)
+        return t
+
+    t = nuevo_texto(y)
+    rojo = False
+    for lname, code, desc, st in rows:
+        if code is None:
+            continue
+        st = st or 0
+        if (st == 0) != rojo:
+            rojo = st == 0
+            if rojo: t.setFillColorRGB(0.8, 0.0, 0.0)
+            else: t.setFillColorRGB(0.0, 0.0, 0.0)
+        if por_ubicacion:
+            line = f"{code:10} {(st):5}  {(desc or '')}"
+        else:
+            line = f"{(lname or ''):18} {code:10} {(st):5}  {(desc or '')}"
+        t.textLine(line[:110])
+        if t.getY() < 20*mm:
+            c.drawText(t)
+            c.showPage()
+            t = nuevo_texto(hhh - 20*mm)
+            rojo = False
+    c.drawText(t)
 
     c.save()
     pdf = buf.getvalue()
@@ -4132,10 +4848,7 @@ def inv_consulta_pdf(request: Request, loc: str = "ALL"):
 
 
 @app.get("/encargado/inventario/gestion", response_class=HTMLResponse)
-def inv_gestion_menu(request: Request):
-    u = require_roles(request, {"ENCARGADO", "TECNICO"})
-    if isinstance(u, Response):
-        return u
+def inv_gestion_menu(u: Dict[str, Any] = Depends(require_inv_user)):
     links = []
     if u["rol"] == "ENCARGADO":
         links.append('<a class="btn danger" href="/encargado/inventario/gestion/eliminar">Eliminar un artículo</a>')
@@ -4157,13 +4870,10 @@ def inv_gestion_menu(request: Request):
       </div>
     </div>
     """
-    return page("Gestión Inventario", body)
+    return html_page("Gestión Inventario", body)
 
-@app.get("/encargado/inventario/gestion/editar", response_class=HTMLResponse)
+@app.get("/encargado/inventario/gestion/editar", response_class=HTMLResponse, dependencies=[Depends(require_encargado)])
 def inv_edit_item_form(request: Request):
-    u = require_roles(request, {"ENCARGADO"})
-    if isinstance(u, Response):
-        return u
     q = request.query_params.get("q","")
     item_id = request.query_params.get("item_id","")
     msg = request.query_params.get("msg","")
@@ -4181,10 +4891,7 @@ def inv_edit_item_form(request: Request):
 
     res_html = ""
     if results:
-        res_html += "<div class='card'><b>Resultados:</b><ul>"
-        for it in results:
-            res_html += f"<li><a href='/encargado/inventario/gestion/editar?item_id={int(it['id'])}'>{h(it.get('description',''))}</a> ({h(it.get('code',''))})</li>"
-        res_html += "</ul></div>"
+        res_html = _inv_resultados_html(results, "/encargado/inventario/gestion/editar?item_id=")
 
     edit_block = ""
     if item:
@@ -4224,18 +4931,14 @@ def inv_edit_item_form(request: Request):
     {res_html}
     {edit_block}
     """
-    return page("Editar artículo", body)
+    return html_page("Editar artículo", body)
 
 
-@app.post("/encargado/inventario/gestion/editar")
+@app.post("/encargado/inventario/gestion/editar", dependencies=[Depends(require_encargado)])
 def inv_edit_item_submit(
-    request: Request,
     item_id: int = Form(...),
     description: str = Form(...),
 ):
-    u = require_roles(request, {"ENCARGADO"})
-    if isinstance(u, Response):
-        return u
     description = (description or "").strip()
     if not description:
         return RedirectResponse(f"/encargado/inventario/gestion/editar?item_id={int(item_id)}&msg=Descripción%20no%20válida", status_code=303)
@@ -4247,26 +4950,18 @@ def inv_edit_item_submit(
     return RedirectResponse(f"/encargado/inventario/gestion/editar?item_id={int(item_id)}&msg=Artículo%20actualizado", status_code=303)
 
 @app.get("/encargado/inventario/gestion/eliminar", response_class=HTMLResponse)
-def inv_eliminar_form(request: Request):
-    r = require_login(request)
-    if r:
-        return r
-    u = user_from_session(request)
-    if u["rol"] not in ("ENCARGADO","TECNICO"):
-        return RedirectResponse(role_home_path(u["rol"]), status_code=303)
-
+def inv_eliminar_form(request: Request, u: Dict[str, Any] = Depends(require_inv_user)):
     if u["rol"] != "ENCARGADO":
         return RedirectResponse("/encargado/inventario/gestion?msg=Solo%20Encargado%20puede%20eliminar%20artículos", status_code=303)
 
     q = request.query_params.get("q","")
     msg = request.query_params.get("msg","")
     res = inv_search_items(q, include_inactive=True) if q else []
-    items = ""
-    if res:
-        for it in res:
-            if not it.get("active"):
-                continue
-            items += f"<li>{h(it.get('description',''))} ({h(it.get('code',''))}) <a class='btn2 danger' href='/encargado/inventario/gestion/eliminar_confirm?id={int(it['id'])}'>Eliminar</a></li>"
+    items = "".join(
+        f"<li>{h(it.get('description',''))} ({h(it.get('code',''))}) <a class='btn2 danger' href='/encargado/inventario/gestion/eliminar_confirm?id={int(it['id'])}'>Eliminar</a></li>"
+        for it in res
+        if it.get("active")
+    )
     body = f"""
     <div class="top">
       <div><h2>Eliminar artículo</h2></div>
@@ -4284,18 +4979,11 @@ def inv_eliminar_form(request: Request):
     </div>
     <div class="card"><ul>{items or "<li>No hay resultados.</li>"}</ul></div>
     """
-    return page("Eliminar artículo", body)
-
+    return html_page("Eliminar artículo", body)
 
-@app.get("/encargado/inventario/gestion/eliminar_confirm", response_class=HTMLResponse)
-def inv_eliminar_confirm(request: Request, id: int):
-    r = require_login(request)
-    if r:
-        return r
-    u = user_from_session(request)
-    if u["rol"] != "ENCARGADO":
-        return RedirectResponse(role_home_path(u["rol"]), status_code=303)
 
+@app.get("/encargado/inventario/gestion/eliminar_confirm", response_class=HTMLResponse, dependencies=[Depends(require_encargado)])
+def inv_eliminar_confirm(id: int):
     it = db_one("select id, code, description from public.wom_inv_items where id=%s;", (int(id),))
     if not it:
         return RedirectResponse("/encargado/inventario/gestion/eliminar?msg=No%20encontrado", status_code=303)
@@ -4314,40 +5002,55 @@ def inv_eliminar_confirm(request: Request, id: int):
       </form>
     </div>
     """
-    return page("Eliminar artículo", body)
+    return html_page("Eliminar artículo", body)
 
 
-@app.post("/encargado/inventario/gestion/eliminar_confirm")
-def inv_eliminar_do(request: Request, id: int = Form(...)):
-    r = require_login(request)
-    if r:
-        return r
-    u = user_from_session(request)
-    if u["rol"] != "ENCARGADO":
-        return RedirectResponse(role_home_path(u["rol"]), status_code=303)
-
+@app.post("/encargado/inventario/gestion/eliminar_confirm", dependencies=[Depends(require_encargado)])
+def inv_eliminar_do(id: int = Form(...)):
     db_exec_safe("update public.wom_inv_items set active=false, updated_at=now() where id=%s;", (int(id),), label="inv_soft_delete")
     return RedirectResponse("/encargado/inventario/gestion/eliminar?msg=Artículo%20eliminado", status_code=303)
 
 
-@app.get("/encargado/inventario/gestion/ubicaciones", response_class=HTMLResponse)
-def inv_locations_manage(request: Request):
-    r = require_login(request)
-    if r:
-        return r
-    u = user_from_session(request)
-    if u["rol"] not in ("ENCARGADO","TECNICO"):
-        return RedirectResponse(role_home_path(u["rol"]), status_code=303)
+# Keyset del listado de movimientos: como SQL_KEYSET, pero calificado (la consulta une con artículos)
+_SQL_INV_MOVES_KEYSET = "(%s::timestamptz is null or (m.created_at, m.id) < (%s, %s))"
+
+
+def _inv_loc_li(l: Dict[str, Any]) -> str:
+    btn = ""
+    if l.get("active"):
+        btn = f"<a class='btn2 danger' href='/encargado/inventario/gestion/ubicaciones/delete?id={int(l['id'])}'>Eliminar</a>"
+    return f"<li>{'✅' if l.get('active') else '⛔'} {h(l.get('name',''))} ({l['n']} artículos) {btn}</li>"
+
 
+_INV_MOVE_TR_TPL = (
+    "<tr><td>{dts}</td><td>{mv}</td><td style='text-align:right'>{qty}</td><td>{code}</td>"
+    "<td>{desc}</td><td>{loc}</td><td>{user}</td></tr>"
+)
+
+
+def _inv_move_tr(r: Any, _h=h, _hr=h_repetido) -> str:
+    """Fila del listado de movimientos; r es la tupla de la consulta de inv_moves_list."""
+    _id, dt, mv, qty, user, code, desc, loc = r
+    dts = dt.strftime("%d/%m/%Y %H:%M") if isinstance(dt, datetime) else str(dt)
+    return _INV_MOVE_TR_TPL.format(
+        dts=_h(dts), mv=_hr(mv), qty=int(qty or 0), code=_h(code), desc=_h(desc), loc=_hr(loc), user=_hr(user),
+    )
+
+
+@app.get("/encargado/inventario/gestion/ubicaciones", response_class=HTMLResponse, dependencies=[Depends(require_inv_user)])
+def inv_locations_manage(request: Request):
     msg = request.query_params.get("msg","")
-    locs = db_all("select id,name,active from public.wom_inv_locations order by id;")
-    lis = ""
-    for l in locs:
-        status = "✅" if l.get("active") else "⛔"
-        btn = ""
-        if l.get("active"):
-            btn = f"<a class='btn2 danger' href='/encargado/inventario/gestion/ubicaciones/delete?id={int(l['id'])}'>Eliminar</a>"
-        lis += f"<li>{status} {h(l.get('name',''))} {btn}</li>"
+    # Ubicaciones con su nº de artículos activos en una sola consulta agregada
+    locs = db_all(
+        """
+        select l.id, l.name, l.active, count(i.id)::int as n
+        from public.wom_inv_locations l
+        left join public.wom_inv_items i on i.location_id = l.id and i.active = true
+        group by l.id
+        order by l.id;
+        """
+    )
+    lis = "".join(map(_inv_loc_li, locs))
 
     body = f"""
     <div class="top">
@@ -4366,74 +5069,64 @@ def inv_locations_manage(request: Request):
     </div>
     <div class="card"><ul>{lis}</ul></div>
     """
-    return page("Ubicaciones", body)
+    return html_page("Ubicaciones", body)
 
 
-@app.post("/encargado/inventario/gestion/ubicaciones/add")
-def inv_locations_add(request: Request, name: str = Form(...)):
-    r = require_login(request)
-    if r:
-        return r
-    u = user_from_session(request)
-    if u["rol"] not in ("ENCARGADO","TECNICO"):
-        return RedirectResponse(role_home_path(u["rol"]), status_code=303)
-
+@app.post("/encargado/inventario/gestion/ubicaciones/add", dependencies=[Depends(require_inv_user)])
+def inv_locations_add(name: str = Form(...)):
     name = (name or "").strip()
     if not name:
         return RedirectResponse("/encargado/inventario/gestion/ubicaciones?msg=Nombre%20vacío", status_code=303)
     db_exec_safe("insert into public.wom_inv_locations(name, active) values (%s, true) on conflict (name) do update set active=true;", (name,), label="inv_add_loc")
+    inv_locs_cache_reset()
     return RedirectResponse("/encargado/inventario/gestion/ubicaciones?msg=Ubicación%20añadida", status_code=303)
 
 
-@app.get("/encargado/inventario/gestion/ubicaciones/delete")
-def inv_locations_delete(request: Request, id: int):
-    r = require_login(request)
-    if r:
-        return r
-    u = user_from_session(request)
-    if u["rol"] not in ("ENCARGADO","TECNICO"):
-        return RedirectResponse(role_home_path(u["rol"]), status_code=303)
+_SQL_INV_LOC_DELETE = (
+    "update public.wom_inv_locations set active=false where id=%s "
+    "and not exists (select 1 from public.wom_inv_items where active=true and location_id=%s) returning id;"
+)
 
-    row = db_one("select count(*)::int as n from public.wom_inv_items where active=true and location_id=%s;", (int(id),))
-    n = int((row or {}).get("n") or 0)
-    if n > 0:
+
+@app.get("/encargado/inventario/gestion/ubicaciones/delete", dependencies=[Depends(require_inv_user)])
+def inv_locations_delete(id: int):
+    # Comprobación y baja en una sola sentencia: si la ubicación tiene artículos activos no se toca
+    row = db_one(_SQL_INV_LOC_DELETE, (int(id), int(id)))
+    if not row:
         return RedirectResponse("/encargado/inventario/gestion/ubicaciones?msg=No%20se%20puede%20eliminar:%20hay%20artículos%20en%20esa%20ubicación", status_code=303)
-    db_exec_safe("update public.wom_inv_locations set active=false where id=%s;", (int(id),), label="inv_del_loc")
+    inv_locs_cache_reset()
     return RedirectResponse("/encargado/inventario/gestion/ubicaciones?msg=Ubicación%20eliminada", status_code=303)
 
 
-@app.get("/encargado/inventario/gestion/moves", response_class=HTMLResponse)
-def inv_moves_list(request: Request):
-    r = require_login(request)
-    if r:
-        return r
-    u = user_from_session(request)
-    if u["rol"] not in ("ENCARGADO","TECNICO"):
-        return RedirectResponse(role_home_path(u["rol"]), status_code=303)
-
-    mes = int(request.query_params.get("mes") or datetime.now().month)
-    anio = int(request.query_params.get("anio") or datetime.now().year)
+@app.get("/encargado/inventario/gestion/moves", response_class=HTMLResponse, dependencies=[Depends(require_inv_user)])
+def inv_moves_list(
+    request: Request,
+    mes: Optional[int] = Query(None, ge=1, le=12),
+    anio: Optional[int] = Query(None, ge=2020, le=2100),
+):
+    now = request_now(request)
+    mes = mes or now.month
+    anio = anio or now.year
+    ts_start, ts_end = month_bounds(anio, mes)
 
+    cursor = parse_cursor(request.query_params.get("cursor"))
     rows = db_all(
-        '''
-        select m.created_at, m.move_type, m.qty, m.user_name, i.code, i.description, l.name as location
+        f'''
+        select m.id, m.created_at, m.move_type, m.qty, m.user_name, i.code, i.description, l.name as location
         from public.wom_inv_moves m
         join public.wom_inv_items i on i.id=m.item_id
         left join public.wom_inv_locations l on l.id=i.location_id
-        where extract(month from m.created_at)= %s and extract(year from m.created_at)= %s
-        order by m.created_at desc;
+        where m.created_at >= %s and m.created_at < %s
+          and {_SQL_INV_MOVES_KEYSET}
+        order by m.created_at desc, m.id desc
+        limit %s;
         ''',
-        (mes, anio),
+        (ts_start, ts_end, *keyset_params(cursor), PAGE_SIZE + 1),
+        cursor_factory=NamedTupleCursor,
     )
+    rows, next_cursor = split_page(rows)
 
-    trs = ""
-    for rrr in rows:
-        dt = rrr.get("created_at")
-        if isinstance(dt, datetime):
-            dts = dt.strftime("%d/%m/%Y %H:%M")
-        else:
-            dts = str(dt)
-        trs += f"<tr><td>{h(dts)}</td><td>{h(rrr.get('move_type',''))}</td><td style='text-align:right'>{int(rrr.get('qty') or 0)}</td><td>{h(rrr.get('code',''))}</td><td>{h(rrr.get('description',''))}</td><td>{h(rrr.get('location',''))}</td><td>{h(rrr.get('user_name',''))}</td></tr>"
+    trs = "".join(map(_inv_move_tr, rows))
 
     body = f"""
     <div class="top">
@@ -4454,22 +5147,21 @@ def inv_moves_list(request: Request):
         <thead><tr><th>Fecha</th><th>Tipo</th><th>Cant.</th><th>Código</th><th>Artículo</th><th>Ubicación</th><th>Usuario</th></tr></thead>
         <tbody>{trs or "<tr><td colspan='7'>No hay movimientos.</td></tr>"}</tbody>
       </table>
+      {more_link("/encargado/inventario/gestion/moves", {"mes": mes, "anio": anio}, next_cursor)}
     </div>
     """
-    return page("Movimientos inventario", body)
-
+    return html_page("Movimientos inventario", body)
 
-@app.get("/encargado/inventario/gestion/moves_pdf", response_class=HTMLResponse)
-def inv_moves_pdf_form(request: Request):
-    r = require_login(request)
-    if r:
-        return r
-    u = user_from_session(request)
-    if u["rol"] not in ("ENCARGADO","TECNICO"):
-        return RedirectResponse(role_home_path(u["rol"]), status_code=303)
 
-    mes = int(request.query_params.get("mes") or datetime.now().month)
-    anio = int(request.query_params.get("anio") or datetime.now().year)
+@app.get("/encargado/inventario/gestion/moves_pdf", response_class=HTMLResponse, dependencies=[Depends(require_inv_user)])
+def inv_moves_pdf_form(
+    request: Request,
+    mes: Optional[int] = Query(None, ge=1, le=12),
+    anio: Optional[int] = Query(None, ge=2020, le=2100),
+):
+    now = request_now(request)
+    mes = mes or now.month
+    anio = anio or now.year
 
     body = f"""
     <div class="top">
@@ -4486,81 +5178,86 @@ def inv_moves_pdf_form(request: Request):
       </form>
     </div>
     """
-    return page("PDF Movimientos", body)
+    return html_page("PDF Movimientos", body)
 
 
-@app.get("/encargado/inventario/gestion/moves_pdf_download")
-def inv_moves_pdf_download(request: Request, mes: int, anio: int):
-    r = require_login(request)
-    if r:
-        return r
-    u = user_from_session(request)
-    if u["rol"] not in ("ENCARGADO","TECNICO"):
-        return RedirectResponse(role_home_path(u["rol"]), status_code=303)
+# Márgenes de los PDF de inventario (A4, 20 mm) y línea del PDF de movimientos:
+# FECHA TIPO CANT CÓDIGO UBICACIÓN ARTÍCULO
+_INV_PDF_MARGEN = 20*mm
+_INV_PDF_ARRIBA = A4[1] - 20*mm
+_INV_PDF_DERECHA = A4[0] - 20*mm
+_INV_MOVES_PDF_INTERLINEA = 3.8*mm
+_INV_MOVES_PDF_LINEA = "{:16} {:6} {:4} {:10} {:16} {}".format
 
-    rows = db_all(
+
+@app.get("/encargado/inventario/gestion/moves_pdf_download", dependencies=[Depends(require_inv_user)])
+def inv_moves_pdf_download(
+    request: Request,
+    mes: int = Query(..., ge=1, le=12),
+    anio: int = Query(..., ge=2020, le=2100),
+):
+    ts_start, ts_end = month_bounds(anio, mes)
+
+    rows = db_iter(
         '''
-        select m.created_at, m.move_type, m.qty, m.user_name, i.code, i.description, l.name as location
+        select m.created_at, m.move_type, m.qty, i.code, l.name as location, i.description
         from public.wom_inv_moves m
         join public.wom_inv_items i on i.id=m.item_id
         left join public.wom_inv_locations l on l.id=i.location_id
-        where extract(month from m.created_at)= %s and extract(year from m.created_at)= %s
+        where m.created_at >= %s and m.created_at < %s
         order by m.created_at desc;
         ''',
-        (int(mes), int(anio)),
+        (ts_start, ts_end),
+        itersize=1000,
     )
 
-    from reportlab.lib.pagesizes import A4
-    from reportlab.pdfgen import canvas
-    from reportlab.lib.units import mm
 
     buf = BytesIO()
     c = canvas.Canvas(buf, pagesize=A4)
-    W, H = A4
+    x0 = _INV_PDF_MARGEN
 
-    y = H - 20*mm
+    y = _INV_PDF_ARRIBA
     c.setFont("Helvetica-Bold", 16)
-    c.drawString(20*mm, y, "ENTRADAS Y SALIDAS - INVENTARIO")
+    c.drawString(x0, y, "ENTRADAS Y SALIDAS - INVENTARIO")
     y -= 10*mm
     c.setFont("Helvetica", 11)
-    c.drawString(20*mm, y, f"Mes/Año: {int(mes):02d}/{int(anio)}")
+    c.drawString(x0, y, f"Mes/Año: {int(mes):02d}/{int(anio)}")
     y -= 6*mm
-    c.drawString(20*mm, y, f"Generado: {datetime.now().strftime('%d/%m/%Y %H:%M')}")
+    c.drawString(x0, y, f"Generado: {request_now(request).strftime('%d/%m/%Y %H:%M')}")
     y -= 10*mm
 
     c.setFont("Courier", 7)
-    c.drawString(20*mm, y, "FECHA            TIPO   CANT  CÓDIGO     UBICACIÓN          ARTÍCULO")
+    c.drawString(x0, y, "FECHA            TIPO   CANT  CÓDIGO     UBICACIÓN          ARTÍCULO")
     y -= 4*mm
-    c.line(20*mm, y, W-20*mm, y)
+    c.line(x0, y, _INV_PDF_DERECHA, y)
     y -= 5*mm
 
-    for rrr in rows:
-        dt = rrr.get("created_at")
-        if isinstance(dt, datetime):
-            dts = dt.strftime("%d/%m/%Y %H:%M")
-        else:
-            dts = str(dt)[:16]
-        line = f"{dts:16} {rrr.get('move_type','')[:6]:6} {int(rrr.get('qty') or 0):4} {(rrr.get('code') or ''):10} {(rrr.get('location') or ''):16} {(rrr.get('description') or '')}"
-        c.drawString(20*mm, y, line[:120])
-        y -= 3.8*mm
-        if y < 20*mm:
+    # Un objeto de texto por página en vez de un drawString por fila
+    def nuevo_texto(y0):
+        t = c.beginText(x0, y0)
+        t.setFont("Courier", 7)
+        t.setLeading(_INV_MOVES_PDF_INTERLINEA)
+        return t
+
+    linea = _INV_MOVES_PDF_LINEA
+    y_min, y_top = _INV_PDF_MARGEN, _INV_PDF_ARRIBA
+    t = nuevo_texto(y)
+    for dt, mv, qty, code, loc, desc in rows:
+        dts = dt.strftime("%d/%m/%Y %H:%M") if isinstance(dt, datetime) else str(dt)[:16]
+        t.textLine(linea(dts, (mv or "")[:6], int(qty or 0), code or "", loc or "", desc or "")[:120])
+        if t.getY() < y_min:
+            c.drawText(t)
             c.showPage()
-            y = H - 20*mm
-            c.setFont("Courier", 7)
+            t = nuevo_texto(y_top)
+    c.drawText(t)
 
     c.save()
-    pdf = buf.getvalue()
-    headers = {"Content-Disposition": f'attachment; filename="movimientos_inventario_{int(mes):02d}_{int(anio)}.pdf"'}
-    return Response(content=pdf, media_type="application/pdf", headers=headers)
+    return pdf_buffer_response(buf, f"movimientos_inventario_{int(mes):02d}_{int(anio)}.pdf")
 
 
 
-@app.get("/encargado/inventario/gestion/repo_pdf")
-def inv_repo_pdf(request: Request):
-    u = require_roles(request, {"ENCARGADO", "TECNICO"})
-    if not isinstance(u, dict):
-        return u
-
+@app.get("/encargado/inventario/gestion/repo_pdf", dependencies=[Depends(require_inv_user)])
+def inv_repo_pdf():
     # db_all() ya gestiona su propia conexión (no se le pasa conn)
     rows = db_all(
         """
@@ -4579,8 +5276,6 @@ def inv_repo_pdf(request: Request):
     )
 
     from io import BytesIO
-    from reportlab.lib.pagesizes import A4
-    from reportlab.pdfgen import canvas
 
     buf = BytesIO()
     c = canvas.Canvas(buf, pagesize=A4)
@@ -4619,15 +5314,8 @@ def inv_repo_pdf(request: Request):
     return Response(content=pdf, media_type="application/pdf", headers=headers)
 
 
-@app.get("/encargado/inventario/gestion/cambiar_ubicacion", response_class=HTMLResponse)
+@app.get("/encargado/inventario/gestion/cambiar_ubicacion", response_class=HTMLResponse, dependencies=[Depends(require_inv_user)])
 def inv_change_loc_form(request: Request):
-    r = require_login(request)
-    if r:
-        return r
-    u = user_from_session(request)
-    if u["rol"] not in ("ENCARGADO","TECNICO"):
-        return RedirectResponse(role_home_path(u["rol"]), status_code=303)
-
     q = request.query_params.get("q","")
     item_id = request.query_params.get("item_id","")
     msg = request.query_params.get("msg","")
@@ -4638,10 +5326,7 @@ def inv_change_loc_form(request: Request):
 
     res_html = ""
     if results:
-        res_html += "<div class='card'><b>Resultados:</b><ul>"
-        for it in results:
-            res_html += f"<li><a href='/encargado/inventario/gestion/cambiar_ubicacion?item_id={int(it['id'])}'>{h(it.get('description',''))}</a> ({h(it.get('code',''))})</li>"
-        res_html += "</ul></div>"
+        res_html = _inv_resultados_html(results, "/encargado/inventario/gestion/cambiar_ubicacion?item_id=")
 
     item_block = ""
     if item:
@@ -4680,33 +5365,19 @@ def inv_change_loc_form(request: Request):
     {res_html}
     {item_block}
     """
-    return page("Cambio ubicación", body)
+    return html_page("Cambio ubicación", body)
 
 
-@app.post("/encargado/inventario/gestion/cambiar_ubicacion")
-def inv_change_loc_submit(request: Request, item_id: int = Form(...), location_id: int = Form(...)):
-    r = require_login(request)
-    if r:
-        return r
-    u = user_from_session(request)
-    if u["rol"] not in ("ENCARGADO","TECNICO"):
-        return RedirectResponse(role_home_path(u["rol"]), status_code=303)
-
+@app.post("/encargado/inventario/gestion/cambiar_ubicacion", dependencies=[Depends(require_inv_user)])
+def inv_change_loc_submit(item_id: int = Form(...), location_id: int = Form(...)):
     db_exec_safe("update public.wom_inv_items set location_id=%s, updated_at=now() where id=%s;", (int(location_id), int(item_id)), label="inv_change_loc")
     return RedirectResponse(f"/encargado/inventario/gestion/cambiar_ubicacion?item_id={int(item_id)}&msg=Ubicación%20actualizada", status_code=303)
 
 
 # ---- JEFES: solo consulta ----
 
-@app.get("/jefe/inventario/consulta", response_class=HTMLResponse)
+@app.get("/jefe/inventario/consulta", response_class=HTMLResponse, dependencies=[Depends(require_jefe)])
 def jefe_inv_consulta(request: Request):
-    r = require_login(request)
-    if r:
-        return r
-    u = user_from_session(request)
-    if u["rol"] != "JEFE":
-        return RedirectResponse(role_home_path(u["rol"]), status_code=303)
-
     mode = request.query_params.get("mode","articulo")
     next_url = str(request.url)
     q = request.query_params.get("q","")
@@ -4719,53 +5390,26 @@ def jefe_inv_consulta(request: Request):
         if not res:
             content = "<div class='card'>No se encontraron artículos.</div>"
         else:
-            lis = ""
-            for it in res:
-                st = int(it.get('stock') or 0)
-                style0 = " style='color:#c00'" if st == 0 else ""
-                lis += f"<li{style0}><b>{h(it.get('description',''))}</b> ({h(it.get('code',''))}) — Stock: <b>{st}</b>{_inv_adjust_form(int(it.get('id') or 0), next_url)} — {h(it.get('location',''))}</li>"
+            nu = _inv_adjust_nu(next_url)
+            lis = "".join(_inv_consulta_li(it, nu) for it in res)
             content = f"<div class='card'><ul>{lis}</ul></div>"
     elif mode == "ubicacion" and loc and loc != "ALL":
-        rows = db_all(
-            "select i.code,i.description,i.stock,l.name as location from public.wom_inv_items i join public.wom_inv_locations l on l.id=i.location_id where i.active=true and l.id=%s order by i.description;",
-            (int(loc),),
-        )
+        rows = db_all(_SQL_INV_CONSULTA_UBICACION, (int(loc),), cursor_factory=NamedTupleCursor)
         if not rows:
             content = "<div class='card'>No hay artículos en esa ubicación.</div>"
         else:
-            trs = ""
-            for it in rows:
-                st = int(it.get('stock') or 0)
-                tr_style0 = " style='color:#c00'" if st == 0 else ""
-                trs += f"<tr{tr_style0}><td>{h(it.get('code',''))}</td><td>{h(it.get('description',''))}</td><td style='text-align:right'>{st}{_inv_adjust_form(int(it.get('id') or 0), next_url)}</td></tr>"
-            content = f"""
-            <div class="card">
-              <table>
-                <thead><tr><th>Código</th><th>Artículo</th><th style='text-align:right'>Stock</th></tr></thead>
-                <tbody>{trs}</tbody>
-              </table>
-            </div>
-            """
+            nu = _inv_adjust_nu(next_url)
+            trs = "".join(_inv_consulta_tr(it, nu) for it in rows)
+            content = _INV_TABLA_UBICACION_TPL.format(trs=trs)
     elif mode == "ubicacion" and loc == "ALL":
-        rows = db_all(
-            "select l.name as location, i.code,i.description,i.stock from public.wom_inv_items i join public.wom_inv_locations l on l.id=i.location_id where i.active=true order by l.name, i.description;",
-        )
+        rows = db_all(_SQL_INV_CONSULTA_TODAS, (INV_CONSULTA_TODAS_MAX,), cursor_factory=NamedTupleCursor)
         if not rows:
             content = "<div class='card'>No hay artículos.</div>"
         else:
-            trs = ""
-            for it in rows:
-                st = int(it.get('stock') or 0)
-                tr_style0 = " style='color:#c00'" if st == 0 else ""
-                trs += f"<tr{tr_style0}><td>{h(it.get('location',''))}</td><td>{h(it.get('code',''))}</td><td>{h(it.get('description',''))}</td><td style='text-align:right'>{st}</td></tr>"
-            content = f"""
-            <div class="card">
-              <table>
-                <thead><tr><th>Ubicación</th><th>Código</th><th>Artículo</th><th style='text-align:right'>Stock</th></tr></thead>
-                <tbody>{trs}</tbody>
-              </table>
-            </div>
-            """
+            total = rows[0].total
+            aviso = _INV_AVISO_TODAS.format(total=total) if total > len(rows) else ""
+            trs = "".join(map(_inv_consulta_tr_loc, rows))
+            content = aviso + _INV_TABLA_TODAS_TPL.format(trs=trs)
 
     body = f"""
     <div class="top">
@@ -4792,25 +5436,21 @@ def jefe_inv_consulta(request: Request):
 
     {content}
     """
-    return page("Consulta Inventario", body)
-@app.get("/encargado/inventario/gestion/ubicaciones", response_class=HTMLResponse)
+    return html_page("Consulta Inventario", body)
+@app.get("/encargado/inventario/gestion/ubicaciones", response_class=HTMLResponse, dependencies=[Depends(require_inv_user)])
 def inv_locations_manage(request: Request):
-    r = require_login(request)
-    if r:
-        return r
-    u = user_from_session(request)
-    if u["rol"] not in ("ENCARGADO","TECNICO"):
-        return RedirectResponse(role_home_path(u["rol"]), status_code=303)
-
     msg = request.query_params.get("msg","")
-    locs = db_all("select id,name,active from public.wom_inv_locations order by id;")
-    lis = ""
-    for l in locs:
-        status = "✅" if l.get("active") else "⛔"
-        btn = ""
-        if l.get("active"):
-            btn = f"<a class='btn2 danger' href='/encargado/inventario/gestion/ubicaciones/delete?id={int(l['id'])}'>Eliminar</a>"
-        lis += f"<li>{status} {h(l.get('name',''))} {btn}</li>"
+    # Ubicaciones con su nº de artículos activos en una sola consulta agregada
+    locs = db_all(
+        """
+        select l.id, l.name, l.active, count(i.id)::int as n
+        from public.wom_inv_locations l
+        left join public.wom_inv_items i on i.location_id = l.id and i.active = true
+        group by l.id
+        order by l.id;
+        """
+    )
+    lis = "".join(map(_inv_loc_li, locs))
 
     body = f"""
     <div class="top">
@@ -4829,74 +5469,58 @@ def inv_locations_manage(request: Request):
     </div>
     <div class="card"><ul>{lis}</ul></div>
     """
-    return page("Ubicaciones", body)
+    return html_page("Ubicaciones", body)
 
 
-@app.post("/encargado/inventario/gestion/ubicaciones/add")
-def inv_locations_add(request: Request, name: str = Form(...)):
-    r = require_login(request)
-    if r:
-        return r
-    u = user_from_session(request)
-    if u["rol"] not in ("ENCARGADO","TECNICO"):
-        return RedirectResponse(role_home_path(u["rol"]), status_code=303)
-
+@app.post("/encargado/inventario/gestion/ubicaciones/add", dependencies=[Depends(require_inv_user)])
+def inv_locations_add(name: str = Form(...)):
     name = (name or "").strip()
     if not name:
         return RedirectResponse("/encargado/inventario/gestion/ubicaciones?msg=Nombre%20vacío", status_code=303)
     db_exec_safe("insert into public.wom_inv_locations(name, active) values (%s, true) on conflict (name) do update set active=true;", (name,), label="inv_add_loc")
+    inv_locs_cache_reset()
     return RedirectResponse("/encargado/inventario/gestion/ubicaciones?msg=Ubicación%20añadida", status_code=303)
 
 
-@app.get("/encargado/inventario/gestion/ubicaciones/delete")
-def inv_locations_delete(request: Request, id: int):
-    r = require_login(request)
-    if r:
-        return r
-    u = user_from_session(request)
-    if u["rol"] not in ("ENCARGADO","TECNICO"):
-        return RedirectResponse(role_home_path(u["rol"]), status_code=303)
-
-    row = db_one("select count(*)::int as n from public.wom_inv_items where active=true and location_id=%s;", (int(id),))
-    n = int((row or {}).get("n") or 0)
-    if n > 0:
+@app.get("/encargado/inventario/gestion/ubicaciones/delete", dependencies=[Depends(require_inv_user)])
+def inv_locations_delete(id: int):
+    # Comprobación y baja en una sola sentencia: si la ubicación tiene artículos activos no se toca
+    row = db_one(_SQL_INV_LOC_DELETE, (int(id), int(id)))
+    if not row:
         return RedirectResponse("/encargado/inventario/gestion/ubicaciones?msg=No%20se%20puede%20eliminar:%20hay%20artículos%20en%20esa%20ubicación", status_code=303)
-    db_exec_safe("update public.wom_inv_locations set active=false where id=%s;", (int(id),), label="inv_del_loc")
+    inv_locs_cache_reset()
     return RedirectResponse("/encargado/inventario/gestion/ubicaciones?msg=Ubicación%20eliminada", status_code=303)
 
 
-@app.get("/encargado/inventario/gestion/moves", response_class=HTMLResponse)
-def inv_moves_list(request: Request):
-    r = require_login(request)
-    if r:
-        return r
-    u = user_from_session(request)
-    if u["rol"] not in ("ENCARGADO","TECNICO"):
-        return RedirectResponse(role_home_path(u["rol"]), status_code=303)
-
-    mes = int(request.query_params.get("mes") or datetime.now().month)
-    anio = int(request.query_params.get("anio") or datetime.now().year)
+@app.get("/encargado/inventario/gestion/moves", response_class=HTMLResponse, dependencies=[Depends(require_inv_user)])
+def inv_moves_list(
+    request: Request,
+    mes: Optional[int] = Query(None, ge=1, le=12),
+    anio: Optional[int] = Query(None, ge=2020, le=2100),
+):
+    now = request_now(request)
+    mes = mes or now.month
+    anio = anio or now.year
+    ts_start, ts_end = month_bounds(anio, mes)
 
+    cursor = parse_cursor(request.query_params.get("cursor"))
     rows = db_all(
-        '''
-        select m.created_at, m.move_type, m.qty, m.user_name, i.code, i.description, l.name as location
+        f'''
+        select m.id, m.created_at, m.move_type, m.qty, m.user_name, i.code, i.description, l.name as location
         from public.wom_inv_moves m
         join public.wom_inv_items i on i.id=m.item_id
         left join public.wom_inv_locations l on l.id=i.location_id
-        where extract(month from m.created_at)= %s and extract(year from m.created_at)= %s
-        order by m.created_at desc;
+        where m.created_at >= %s and m.created_at < %s
+          and {_SQL_INV_MOVES_KEYSET}
+        order by m.created_at desc, m.id desc
+        limit %s;
         ''',
-        (mes, anio),
+        (ts_start, ts_end, *keyset_params(cursor), PAGE_SIZE + 1),
+        cursor_factory=NamedTupleCursor,
     )
+    rows, next_cursor = split_page(rows)
 
-    trs = ""
-    for rrr in rows:
-        dt = rrr.get("created_at")
-        if isinstance(dt, datetime):
-            dts = dt.strftime("%d/%m/%Y %H:%M")
-        else:
-            dts = str(dt)
-        trs += f"<tr><td>{h(dts)}</td><td>{h(rrr.get('move_type',''))}</td><td style='text-align:right'>{int(rrr.get('qty') or 0)}</td><td>{h(rrr.get('code',''))}</td><td>{h(rrr.get('description',''))}</td><td>{h(rrr.get('location',''))}</td><td>{h(rrr.get('user_name',''))}</td></tr>"
+    trs = "".join(map(_inv_move_tr, rows))
 
     body = f"""
     <div class="top">
@@ -4917,22 +5541,21 @@ def inv_moves_list(request: Request):
         <thead><tr><th>Fecha</th><th>Tipo</th><th>Cant.</th><th>Código</th><th>Artículo</th><th>Ubicación</th><th>Usuario</th></tr></thead>
         <tbody>{trs or "<tr><td colspan='7'>No hay movimientos.</td></tr>"}</tbody>
       </table>
+      {more_link("/encargado/inventario/gestion/moves", {"mes": mes, "anio": anio}, next_cursor)}
     </div>
     """
-    return page("Movimientos inventario", body)
+    return html_page("Movimientos inventario", body)
 
 
-@app.get("/encargado/inventario/gestion/moves_pdf", response_class=HTMLResponse)
-def inv_moves_pdf_form(request: Request):
-    r = require_login(request)
-    if r:
-        return r
-    u = user_from_session(request)
-    if u["rol"] not in ("ENCARGADO","TECNICO"):
-        return RedirectResponse(role_home_path(u["rol"]), status_code=303)
-
-    mes = int(request.query_params.get("mes") or datetime.now().month)
-    anio = int(request.query_params.get("anio") or datetime.now().year)
+@app.get("/encargado/inventario/gestion/moves_pdf", response_class=HTMLResponse, dependencies=[Depends(require_inv_user)])
+def inv_moves_pdf_form(
+    request: Request,
+    mes: Optional[int] = Query(None, ge=1, le=12),
+    anio: Optional[int] = Query(None, ge=2020, le=2100),
+):
+    now = request_now(request)
+    mes = mes or now.month
+    anio = anio or now.year
 
     body = f"""
     <div class="top">
@@ -4949,83 +5572,76 @@ def inv_moves_pdf_form(request: Request):
       </form>
     </div>
     """
-    return page("PDF Movimientos", body)
+    return html_page("PDF Movimientos", body)
 
 
-@app.get("/encargado/inventario/gestion/moves_pdf_download")
-def inv_moves_pdf_download(request: Request, mes: int, anio: int):
-    r = require_login(request)
-    if r:
-        return r
-    u = user_from_session(request)
-    if u["rol"] not in ("ENCARGADO","TECNICO"):
-        return RedirectResponse(role_home_path(u["rol"]), status_code=303)
+@app.get("/encargado/inventario/gestion/moves_pdf_download", dependencies=[Depends(require_inv_user)])
+def inv_moves_pdf_download(
+    request: Request,
+    mes: int = Query(..., ge=1, le=12),
+    anio: int = Query(..., ge=2020, le=2100),
+):
+    ts_start, ts_end = month_bounds(anio, mes)
 
-    rows = db_all(
+    rows = db_iter(
         '''
-        select m.created_at, m.move_type, m.qty, m.user_name, i.code, i.description, l.name as location
+        select m.created_at, m.move_type, m.qty, i.code, l.name as location, i.description
         from public.wom_inv_moves m
         join public.wom_inv_items i on i.id=m.item_id
         left join public.wom_inv_locations l on l.id=i.location_id
-        where extract(month from m.created_at)= %s and extract(year from m.created_at)= %s
+        where m.created_at >= %s and m.created_at < %s
         order by m.created_at desc;
         ''',
-        (int(mes), int(anio)),
+        (ts_start, ts_end),
+        itersize=1000,
     )
 
-    from reportlab.lib.pagesizes import A4
-    from reportlab.pdfgen import canvas
-    from reportlab.lib.units import mm
 
     buf = BytesIO()
     c = canvas.Canvas(buf, pagesize=A4)
-    W, H = A4
+    x0 = _INV_PDF_MARGEN
 
-    y = H - 20*mm
+    y = _INV_PDF_ARRIBA
     c.setFont("Helvetica-Bold", 16)
-    c.drawString(20*mm, y, "ENTRADAS Y SALIDAS - INVENTARIO")
+    c.drawString(x0, y, "ENTRADAS Y SALIDAS - INVENTARIO")
     y -= 10*mm
     c.setFont("Helvetica", 11)
-    c.drawString(20*mm, y, f"Mes/Año: {int(mes):02d}/{int(anio)}")
+    c.drawString(x0, y, f"Mes/Año: {int(mes):02d}/{int(anio)}")
     y -= 6*mm
-    c.drawString(20*mm, y, f"Generado: {datetime.now().strftime('%d/%m/%Y %H:%M')}")
+    c.drawString(x0, y, f"Generado: {request_now(request).strftime('%d/%m/%Y %H:%M')}")
     y -= 10*mm
 
     c.setFont("Courier", 7)
-    c.drawString(20*mm, y, "FECHA            TIPO   CANT  CÓDIGO     UBICACIÓN          ARTÍCULO")
+    c.drawString(x0, y, "FECHA            TIPO   CANT  CÓDIGO     UBICACIÓN          ARTÍCULO")
     y -= 4*mm
-    c.line(20*mm, y, W-20*mm, y)
+    c.line(x0, y, _INV_PDF_DERECHA, y)
     y -= 5*mm
 
-    for rrr in rows:
-        dt = rrr.get("created_at")
-        if isinstance(dt, datetime):
-            dts = dt.strftime("%d/%m/%Y %H:%M")
-        else:
-            dts = str(dt)[:16]
-        line = f"{dts:16} {rrr.get('move_type','')[:6]:6} {int(rrr.get('qty') or 0):4} {(rrr.get('code') or ''):10} {(rrr.get('location') or ''):16} {(rrr.get('description') or '')}"
-        c.drawString(20*mm, y, line[:120])
-        y -= 3.8*mm
-        if y < 20*mm:
+    # Un objeto de texto por página en vez de un drawString por fila
+    def nuevo_texto(y0):
+        t = c.beginText(x0, y0)
+        t.setFont("Courier", 7)
+        t.setLeading(_INV_MOVES_PDF_INTERLINEA)
+        return t
+
+    linea = _INV_MOVES_PDF_LINEA
+    y_min, y_top = _INV_PDF_MARGEN, _INV_PDF_ARRIBA
+    t = nuevo_texto(y)
+    for dt, mv, qty, code, loc, desc in rows:
+        dts = dt.strftime("%d/%m/%Y %H:%M") if isinstance(dt, datetime) else str(dt)[:16]
+        t.textLine(linea(dts, (mv or "")[:6], int(qty or 0), code or "", loc or "", desc or "")[:120])
+        if t.getY() < y_min:
+            c.drawText(t)
             c.showPage()
-            y = H - 20*mm
-            c.setFont("Courier", 7)
+            t = nuevo_texto(y_top)
+    c.drawText(t)
 
     c.save()
-    pdf = buf.getvalue()
-    headers = {"Content-Disposition": f'attachment; filename="movimientos_inventario_{int(mes):02d}_{int(anio)}.pdf"'}
-    return Response(content=pdf, media_type="application/pdf", headers=headers)
+    return pdf_buffer_response(buf, f"movimientos_inventario_{int(mes):02d}_{int(anio)}.pdf")
 
 
-@app.get("/encargado/inventario/gestion/cambiar_ubicacion", response_class=HTMLResponse)
+@app.get("/encargado/inventario/gestion/cambiar_ubicacion", response_class=HTMLResponse, dependencies=[Depends(require_inv_user)])
 def inv_change_loc_form(request: Request):
-    r = require_login(request)
-    if r:
-        return r
-    u = user_from_session(request)
-    if u["rol"] not in ("ENCARGADO","TECNICO"):
-        return RedirectResponse(role_home_path(u["rol"]), status_code=303)
-
     q = request.query_params.get("q","")
     item_id = request.query_params.get("item_id","")
     msg = request.query_params.get("msg","")
@@ -5036,10 +5652,7 @@ def inv_change_loc_form(request: Request):
 
     res_html = ""
     if results:
-        res_html += "<div class='card'><b>Resultados:</b><ul>"
-        for it in results:
-            res_html += f"<li><a href='/encargado/inventario/gestion/cambiar_ubicacion?item_id={int(it['id'])}'>{h(it.get('description',''))}</a> ({h(it.get('code',''))})</li>"
-        res_html += "</ul></div>"
+        res_html = _inv_resultados_html(results, "/encargado/inventario/gestion/cambiar_ubicacion?item_id=")
 
     item_block = ""
     if item:
@@ -5078,33 +5691,19 @@ def inv_change_loc_form(request: Request):
     {res_html}
     {item_block}
     """
-    return page("Cambio ubicación", body)
-
+    return html_page("Cambio ubicación", body)
 
-@app.post("/encargado/inventario/gestion/cambiar_ubicacion")
-def inv_change_loc_submit(request: Request, item_id: int = Form(...), location_id: int = Form(...)):
-    r = require_login(request)
-    if r:
-        return r
-    u = user_from_session(request)
-    if u["rol"] not in ("ENCARGADO","TECNICO"):
-        return RedirectResponse(role_home_path(u["rol"]), status_code=303)
 
+@app.post("/encargado/inventario/gestion/cambiar_ubicacion", dependencies=[Depends(require_inv_user)])
+def inv_change_loc_submit(item_id: int = Form(...), location_id: int = Form(...)):
     db_exec_safe("update public.wom_inv_items set location_id=%s, updated_at=now() where id=%s;", (int(location_id), int(item_id)), label="inv_change_loc")
     return RedirectResponse(f"/encargado/inventario/gestion/cambiar_ubicacion?item_id={int(item_id)}&msg=Ubicación%20actualizada", status_code=303)
 
 
 # ---- JEFES: solo consulta ----
 
-@app.get("/jefe/inventario/consulta", response_class=HTMLResponse)
+@app.get("/jefe/inventario/consulta", response_class=HTMLResponse, dependencies=[Depends(require_jefe)])
 def jefe_inv_consulta(request: Request):
-    r = require_login(request)
-    if r:
-        return r
-    u = user_from_session(request)
-    if u["rol"] != "JEFE":
-        return RedirectResponse(role_home_path(u["rol"]), status_code=303)
-
     mode = request.query_params.get("mode","articulo")
     next_url = str(request.url)
     q = request.query_params.get("q","")
@@ -5117,53 +5716,26 @@ def jefe_inv_consulta(request: Request):
         if not res:
             content = "<div class='card'>No se encontraron artículos.</div>"
         else:
-            lis = ""
-            for it in res:
-                st = int(it.get('stock') or 0)
-                style0 = " style='color:#c00'" if st == 0 else ""
-                lis += f"<li{style0}><b>{h(it.get('description',''))}</b> ({h(it.get('code',''))}) — Stock: <b>{st}</b>{_inv_adjust_form(int(it.get('id') or 0), next_url)} — {h(it.get('location',''))}</li>"
+            nu = _inv_adjust_nu(next_url)
+            lis = "".join(_inv_consulta_li(it, nu) for it in res)
             content = f"<div class='card'><ul>{lis}</ul></div>"
     elif mode == "ubicacion" and loc and loc != "ALL":
-        rows = db_all(
-            "select i.code,i.description,i.stock,l.name as location from public.wom_inv_items i join public.wom_inv_locations l on l.id=i.location_id where i.active=true and l.id=%s order by i.description;",
-            (int(loc),),
-        )
+        rows = db_all(_SQL_INV_CONSULTA_UBICACION, (int(loc),), cursor_factory=NamedTupleCursor)
         if not rows:
             content = "<div class='card'>No hay artículos en esa ubicación.</div>"
         else:
-            trs = ""
-            for it in rows:
-                st = int(it.get('stock') or 0)
-                tr_style0 = " style='color:#c00'" if st == 0 else ""
-                trs += f"<tr{tr_style0}><td>{h(it.get('code',''))}</td><td>{h(it.get('description',''))}</td><td style='text-align:right'>{st}{_inv_adjust_form(int(it.get('id') or 0), next_url)}</td></tr>"
-            content = f"""
-            <div class="card">
-              <table>
-                <thead><tr><th>Código</th><th>Artículo</th><th style='text-align:right'>Stock</th></tr></thead>
-                <tbody>{trs}</tbody>
-              </table>
-            </div>
-            """
+            nu = _inv_adjust_nu(next_url)
+            trs = "".join(_inv_consulta_tr(it, nu) for it in rows)
+            content = _INV_TABLA_UBICACION_TPL.format(trs=trs)
     elif mode == "ubicacion" and loc == "ALL":
-        rows = db_all(
-            "select l.name as location, i.code,i.description,i.stock from public.wom_inv_items i join public.wom_inv_locations l on l.id=i.location_id where i.active=true order by l.name, i.description;",
-        )
+        rows = db_all(_SQL_INV_CONSULTA_TODAS, (INV_CONSULTA_TODAS_MAX,), cursor_factory=NamedTupleCursor)
         if not rows:
             content = "<div class='card'>No hay artículos.</div>"
         else:
-            trs = ""
-            for it in rows:
-                st = int(it.get('stock') or 0)
-                tr_style0 = " style='color:#c00'" if st == 0 else ""
-                trs += f"<tr{tr_style0}><td>{h(it.get('location',''))}</td><td>{h(it.get('code',''))}</td><td>{h(it.get('description',''))}</td><td style='text-align:right'>{st}</td></tr>"
-            content = f"""
-            <div class="card">
-              <table>
-                <thead><tr><th>Ubicación</th><th>Código</th><th>Artículo</th><th style='text-align:right'>Stock</th></tr></thead>
-                <tbody>{trs}</tbody>
-              </table>
-            </div>
-            """
+            total = rows[0].total
+            aviso = _INV_AVISO_TODAS.format(total=total) if total > len(rows) else ""
+            trs = "".join(map(_inv_consulta_tr_loc, rows))
+            content = aviso + _INV_TABLA_TODAS_TPL.format(trs=trs)
 
     body = f"""
     <div class="top">
@@ -5190,4 +5762,4 @@ def jefe_inv_consulta(request: Request):
 
     {content}
     """
-    return page("Consulta Inventario", body)
+    return html_page("Consulta Inventario", body)